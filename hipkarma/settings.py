@@ -40,6 +40,9 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'karma.middleware.MetricsMiddleware',
+    'karma.middleware.WebhookRecorderMiddleware',
+    'karma.middleware.ProfilerMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
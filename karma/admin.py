@@ -1,7 +1,9 @@
 from django.contrib import admin
-from .models import Instance, Group, KarmicEntity, Karma
+from .models import Instance, Group, KarmicEntity, Karma, KarmaRollup, Notification
 
 admin.site.register(Instance)
 admin.site.register(Group)
 admin.site.register(KarmicEntity)
 admin.site.register(Karma)
+admin.site.register(KarmaRollup)
+admin.site.register(Notification)
@@ -0,0 +1,243 @@
+"""
+Load testing of the webhooks.
+
+Generates synthetic room_message payloads, drives the hooks with them from several threads through Django's test
+client, and measures throughput, latency percentiles and database queries per endpoint. Notifications go to a fake
+HipChat API (see karma.fakehipchat), so nothing is sent to the real one. Used by the benchmark_hooks management
+command.
+"""
+
+import bisect
+import itertools
+import json
+import queue
+import random
+import threading
+import time
+
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from . import settings, views
+
+
+# The hooks which can be benchmarked, by the name used for them in reports
+ENDPOINTS = {
+    'give': views.give_hook,
+    'show': views.show_hook,
+    'leaderboard': views.leaderboard_hook,
+    'help': views.help_hook,
+}
+
+
+class PayloadGenerator:
+    """Generates realistic room_message webhook payloads
+
+    Each instance is a room in one of several groups. Senders and mentioned users are picked uniformly from the users of
+    the group, while non-user targets follow a Zipf distribution over a vocabulary, so that a few of them are hot.
+    """
+
+    # Words for non-user karma targets. Longer names are made by joining several of them.
+    WORDS = ['coffee', 'friday', 'deploy', 'lunch', 'tests', 'build', 'printer', 'standup', 'release', 'pizza',
+             'wifi', 'docs', 'oncall', 'review', 'rain', 'monday', 'cake', 'vpn', 'demo', 'meeting']
+
+    def __init__(self, instances, users, entities, skew, comment_rate, seed=None):
+        """
+        Args:
+            instances ([(str, int)]): (OAuth client ID, group ID) for each installed instance
+            users (int): The number of users in each group
+            entities (int): The number of distinct non-user targets in each group
+            skew (float): The exponent of the Zipf distribution of non-user targets (0 for uniform)
+            comment_rate (float): The fraction of karma messages with a comment
+            seed: Seed for the generated messages
+        """
+        self.instances = instances
+        self.users = users
+        self.comment_rate = comment_rate
+        self._random = random.Random(seed)
+        self._entities = [self._entity_name(n) for n in range(entities)]
+        weights = [1.0 / (n + 1) ** skew for n in range(entities)]
+        self._cumulative = list(itertools.accumulate(weights))
+
+    def payload(self, endpoint):
+        """Generate a payload for an endpoint
+
+        Args:
+            endpoint (str): One of ENDPOINTS
+        Returns:
+            {}: The webhook payload
+        """
+        client_id, group_id = self._random.choice(self.instances)
+        sender = self._user(group_id)
+        mentions = []
+        text = getattr(self, '_{endpoint}_message'.format(endpoint=endpoint))(group_id, sender, mentions)
+        return {
+            'event': 'room_message',
+            'oauth_client_id': client_id,
+            'item': {
+                'message': {
+                    'message': text,
+                    'mentions': mentions,
+                    'from': sender,
+                },
+            },
+        }
+
+    def _give_message(self, group_id, sender, mentions):
+        operations = []
+        for _ in range(self._random.choice([1, 1, 1, 1, 2, 2, 3])):
+            operations.append(self._target(group_id, mentions) + ('++' if self._random.random() < 0.8 else '--'))
+        text = ' '.join(operations)
+        if self._random.random() < self.comment_rate:
+            text += ' #{word} {word2}'.format(word=self._random.choice(self.WORDS),
+                                              word2=self._random.choice(self.WORDS))
+        return text
+
+    def _show_message(self, group_id, sender, mentions):
+        text = '@{name} for {target}'.format(name=settings.ADDON_CHAT_NAME, target=self._target(group_id, mentions))
+        if self._random.random() < 0.2:
+            text += ' ' + self._random.choice(['today', 'this week', 'this month'])
+        return text
+
+    def _leaderboard_message(self, group_id, sender, mentions):
+        text = '@{name} {direction}'.format(name=settings.ADDON_CHAT_NAME,
+                                            direction=self._random.choice(['top', 'top', 'bottom']))
+        if self._random.random() < 0.3:
+            text += ' {n}'.format(n=self._random.randint(1, settings.LEADERBOARD_MAX))
+        return text
+
+    def _help_message(self, group_id, sender, mentions):
+        return '@{name} help'.format(name=settings.ADDON_CHAT_NAME)
+
+    def _target(self, group_id, mentions):
+        """Pick a karma target, adding a mention to mentions if it is a user
+
+        Returns:
+            str: The target as it would be written in a message
+        """
+        if self._random.random() < 0.4:
+            user = self._user(group_id)
+            if user not in mentions:
+                mentions.append(user)
+            return '@' + user['mention_name']
+        name = self._entities[bisect.bisect_left(self._cumulative, self._random.random() * self._cumulative[-1])]
+        return '({name})'.format(name=name) if ' ' in name else name
+
+    def _user(self, group_id):
+        n = self._random.randrange(self.users)
+        return {'id': group_id * 100000 + n, 'mention_name': 'user{n}'.format(n=n)}
+
+    def _entity_name(self, n):
+        words = []
+        while True:
+            n, word = divmod(n, len(self.WORDS))
+            words.append(self.WORDS[word])
+            if not n:
+                return ' '.join(words)
+            n -= 1
+
+
+class EndpointStats:
+    """Measurements of the requests to one endpoint"""
+
+    def __init__(self):
+        self.latencies = []
+        self.queries = []
+        self.errors = 0
+
+    def record(self, latency, queries, ok):
+        """Record a request
+
+        Args:
+            latency (float): The time taken to respond, in seconds
+            queries (int): The number of database queries made by the request
+            ok (bool): Whether the request succeeded
+        """
+        self.latencies.append(latency)
+        self.queries.append(queries)
+        if not ok:
+            self.errors += 1
+
+    def summary(self, elapsed):
+        """Summarize the measurements
+
+        Args:
+            elapsed (float): The wall time of the whole run, in seconds
+        Returns:
+            {str: float}: The request count, errors, throughput (per second), latency percentiles (in milliseconds)
+                and mean and maximum queries per request
+        """
+        return {
+            'requests': len(self.latencies),
+            'errors': self.errors,
+            'throughput': len(self.latencies) / elapsed if elapsed else 0,
+            'p50_ms': percentile(self.latencies, 50) * 1000,
+            'p95_ms': percentile(self.latencies, 95) * 1000,
+            'p99_ms': percentile(self.latencies, 99) * 1000,
+            'mean_queries': sum(self.queries) / float(len(self.queries)) if self.queries else 0,
+            'max_queries': max(self.queries) if self.queries else 0,
+        }
+
+
+def percentile(values, p):
+    """Get a percentile of some values, by the nearest-rank method
+
+    Args:
+        values ([float]): The values
+        p (float): The percentile, from 0 to 100
+    Returns:
+        float: The value at the percentile, or 0 if there are no values
+    """
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = max(int(-(-len(ordered) * p // 100)), 1)
+    return ordered[rank - 1]
+
+
+def run(requests_, concurrency):
+    """Send requests to the hooks from several threads, measuring each of them
+
+    Args:
+        requests_ ([(str, {})]): (endpoint, payload) for each request, in the order to send them
+        concurrency (int): The number of threads sending requests
+    Returns:
+        ({str: EndpointStats}, float): The measurements for each endpoint, and the wall time of the run in seconds
+    """
+    pending = queue.Queue()
+    for request in requests_:
+        pending.put(request)
+    stats = {endpoint: EndpointStats() for endpoint in ENDPOINTS}
+    urls = {endpoint: reverse(view) for endpoint, view in ENDPOINTS.items()}
+    lock = threading.Lock()
+
+    def work():
+        client = Client()
+        try:
+            while True:
+                try:
+                    endpoint, payload = pending.get_nowait()
+                except queue.Empty:
+                    return
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    try:
+                        response = client.post(urls[endpoint], json.dumps(payload), content_type='application/json')
+                        ok = response.status_code == 200
+                    except Exception:
+                        ok = False
+                    latency = time.perf_counter() - start
+                with lock:
+                    stats[endpoint].record(latency, len(queries), ok)
+        finally:
+            # Each thread has its own database connection
+            connection.close()
+
+    threads = [threading.Thread(target=work, name='benchmark-{n}'.format(n=n)) for n in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {endpoint: s for endpoint, s in stats.items() if s.latencies}, time.perf_counter() - start
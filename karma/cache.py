@@ -0,0 +1,75 @@
+"""
+Caching helpers for the Karma app.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A thread-safe, size-bounded, in-process cache with least-recently-used eviction and an optional time to live"""
+
+    # Returned by get() on a miss, so that None can be cached
+    MISSING = object()
+
+    def __init__(self, maxsize, ttl=None):
+        """
+        Args:
+            maxsize (int): The maximum number of entries to keep
+            ttl (float): The number of seconds an entry stays valid, or None for no expiry
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a value from the cache
+
+        Args:
+            key: The key to look up
+        Returns:
+            The cached value, or LRUCache.MISSING if there is no valid entry for the key
+        """
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except KeyError:
+                return self.MISSING
+            if expires is not None and expires <= time.monotonic():
+                return self.MISSING
+            # Re-insert to mark as most recently used
+            self._entries[key] = value, expires
+            return value
+
+    def set(self, key, value):
+        """Put a value in the cache, evicting the least recently used entry if the cache is full
+
+        Args:
+            key: The key to store the value under
+            value: The value to store
+        """
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value, expires
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove a key from the cache, if it is there
+
+        Args:
+            key: The key to remove
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove everything from the cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
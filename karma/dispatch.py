@@ -0,0 +1,135 @@
+"""
+Sends room notifications off the webhook request path.
+
+Views put their notifications in the outbox (see karma.models.Notification) and hand them to the dispatcher, then return
+to HipChat immediately. A small pool of worker threads per process delivers them in the background. Anything the
+dispatcher cannot deliver stays in the outbox for the drain_notifications command. In 'sync' mode (used by tests)
+notifications are delivered before returning.
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+
+from django.db import close_old_connections
+from . import settings
+from .models import Notification
+
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationDispatcher:
+    """Delivers outbox notifications from a bounded queue using a pool of worker threads"""
+
+    # Queued in place of a notification to tell a worker to exit
+    _STOP = object()
+
+    def __init__(self, workers, queue_size):
+        """
+        Args:
+            workers (int): The number of worker threads to run
+            queue_size (int): The maximum number of notifications waiting to be sent
+        """
+        self._worker_count = workers
+        self._queue_size = queue_size
+        self._queue = None
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def deliver(self, notification):
+        """Deliver a notification from the outbox
+
+        In async mode this returns as soon as the notification is queued. If the queue is full the notification is left
+        in the outbox, where the drain_notifications command will find it once its claim expires.
+
+        Args:
+            notification (Notification): A saved notification, claimed by the caller
+        """
+        if settings.NOTIFICATION_DISPATCH_MODE == 'sync':
+            notification.deliver()
+            return
+
+        self._start()
+        try:
+            self._queue.put_nowait(notification)
+        except queue.Full:
+            logger.warning('Notification queue is full, leaving notification {pk} in the outbox'
+                           .format(pk=notification.pk))
+
+    def shutdown(self, timeout=None):
+        """Deliver everything already queued, then stop the worker threads
+
+        Args:
+            timeout (float): The maximum number of seconds to wait for each worker to finish
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            for _ in self._threads:
+                self._queue.put(self._STOP)
+            for thread in self._threads:
+                thread.join(timeout)
+            self._threads = []
+            self._pid = None
+
+    def _start(self):
+        """Start the worker threads if they are not running in this process
+
+        Threads are started lazily so that they are created in each gunicorn worker after it forks.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self._queue_size)
+            self._threads = [threading.Thread(target=self._work, name='notification-dispatcher-{n}'.format(n=n),
+                                              daemon=True)
+                             for n in range(self._worker_count)]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def _work(self):
+        """Worker thread main loop"""
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            try:
+                item.deliver()
+            except Exception:
+                # Unexpected errors leave the notification in the outbox to be retried by the drain command
+                logger.exception('Failed to deliver notification {pk}'.format(pk=item.pk))
+            finally:
+                # Each thread has its own database connection, which would otherwise never be cleaned up
+                close_old_connections()
+
+
+dispatcher = NotificationDispatcher(settings.NOTIFICATION_DISPATCH_WORKERS, settings.NOTIFICATION_DISPATCH_QUEUE_SIZE)
+
+# Flush pending notifications when the worker process exits
+atexit.register(dispatcher.shutdown, settings.NOTIFICATION_DISPATCH_SHUTDOWN_TIMEOUT)
+
+
+def deliver(notification):
+    """Deliver a notification from the outbox using the shared dispatcher
+
+    Args:
+        notification (Notification): A saved notification, claimed by the caller
+    """
+    dispatcher.deliver(notification)
+
+
+def send_room_notification(instance, message):
+    """Put a notification in the outbox and deliver it using the shared dispatcher
+
+    Args:
+        instance (Instance): The instance whose room the notification is for
+        message (str): The text of the message
+    """
+    dispatcher.deliver(Notification.create(instance, message))
@@ -0,0 +1,327 @@
+"""
+A fake HipChat API server for tests, benchmarks and failure-mode experiments.
+
+It implements the parts of the API HipKarma uses: client credentials tokens (/oauth/token), room notifications
+(/room/{id}/notification) and the capabilities descriptor (/capabilities). Latency and error responses can be injected,
+and every call is recorded. Start it in-process with FakeHipChat().start(), or as a local process with the
+run_fake_hipchat management command, and point settings.HIPCHAT_API_URL (the HIPCHAT_API_URL environment variable) at
+its url.
+
+While running as a separate process it can be controlled over HTTP:
+    GET /_fake/calls                  The recorded calls, as JSON
+    POST /_fake/fail                  Fail the next calls, with a JSON body like {"status": 503, "count": 2}
+    POST /_fake/reset                 Forget the recorded calls and pending failures
+"""
+
+import base64
+import itertools
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class Call:
+    """A call to the fake server
+
+    Attributes:
+        method (str): The HTTP method
+        path (str): The path, without the API prefix
+        headers ({str: str}): The request headers
+        body: The decoded JSON body, or None
+        status (int): The status of the response
+        time (float): When the call was received (time.time())
+    """
+
+    def __init__(self, method, path, headers, body, status):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self.status = status
+        self.time = time.time()
+
+    def as_dict(self):
+        return {'method': self.method, 'path': self.path, 'headers': self.headers, 'body': self.body,
+                'status': self.status, 'time': self.time}
+
+
+class FakeHipChat:
+    """A fake HipChat API
+
+    Attributes:
+        latency (float): The mean delay in seconds before each response (exponentially distributed)
+        error_rates ({int: float}): For some error statuses (e.g. 401, 403, 500 or 503), the fraction of calls which
+            fail with that status
+        calls ([Call]): The calls received so far, if recording
+    """
+    PREFIX = '/v2'
+    TOKEN_LIFETIME = 3600
+
+    # Rate limit reported to clients, per token and per RATE_LIMIT_PERIOD seconds
+    RATE_LIMIT = 100
+    RATE_LIMIT_PERIOD = 300
+
+    _NOTIFICATION = re.compile(r'^/room/([^/]+)/notification$')
+
+    def __init__(self, clients=None, default_group=1, latency=0, error_rates=None, record=True, seed=None,
+                 host='127.0.0.1', port=0):
+        """
+        Args:
+            clients ({str: int}): The group ID for each OAuth client ID which may get a token, or None to let any
+                client get a token for default_group
+            default_group (int): The group of clients not in clients
+            latency (float): See latency
+            error_rates ({int: float}): See error_rates
+            record (bool): Whether to record calls
+            seed: Seed for the random delays and errors
+            host (str): The address to listen on
+            port (int): The port to listen on, or 0 for any free port
+        """
+        self.clients = clients
+        self.default_group = default_group
+        self.latency = latency
+        self.error_rates = dict(error_rates or {})
+        self.record = record
+        self.calls = []
+        self.host = host
+        self.port = port
+        self._failures = []
+        self._tokens = {}
+        self._token_numbers = itertools.count()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        """The base URL of the API, to use as settings.HIPCHAT_API_URL"""
+        return 'http://{host}:{port}{prefix}'.format(host=self.host, port=self.port, prefix=self.PREFIX)
+
+    def start(self):
+        """Start serving from a background thread
+
+        Returns:
+            FakeHipChat: This server, for chaining
+        """
+        self._bind()
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-hipchat', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Serve from the current thread until interrupted"""
+        self._bind()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def _bind(self):
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+
+    def stop(self):
+        """Stop serving"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def fail_next(self, status, count=1):
+        """Make the next calls fail
+
+        Args:
+            status (int): The status to respond with, e.g. 401, 403, 500 or 503
+            count (int): The number of calls to fail
+        """
+        with self._lock:
+            self._failures.extend([status] * count)
+
+    def reset(self):
+        """Forget the recorded calls and pending failures"""
+        with self._lock:
+            self.calls = []
+            self._failures = []
+
+    def notifications(self, room=None):
+        """Get the notifications which were accepted
+
+        Args:
+            room (str): Only get notifications for this room ID
+        Returns:
+            [(str, str)]: (room, message) for each notification, in the order they were received
+        """
+        with self._lock:
+            calls = list(self.calls)
+        notifications = []
+        for call in calls:
+            match = self._NOTIFICATION.match(call.path)
+            if call.status == 204 and match and (room is None or match.group(1) == str(room)):
+                notifications.append((match.group(1), call.body['message']))
+        return notifications
+
+    def handle(self, method, path, headers, body):
+        """Work out the response to a call
+
+        Args:
+            method (str): The HTTP method
+            path (str): The path, including the API prefix
+            headers ({str: str}): The request headers
+            body: The decoded JSON body, or None
+        Returns:
+            (int, {str: str}, object): The status, extra headers and JSON body (or None) of the response
+        """
+        if path.startswith('/_fake/'):
+            return self._control(method, path, body)
+
+        with self._lock:
+            delay = self._random.expovariate(1.0 / self.latency) if self.latency else 0
+            failure = self._failures.pop(0) if self._failures else None
+            point = self._random.random()
+            for status, rate in sorted(self.error_rates.items()):
+                if failure is None and point < rate:
+                    failure = status
+                point -= rate
+        if delay:
+            time.sleep(delay)
+
+        path = path[len(self.PREFIX):] if path.startswith(self.PREFIX) else path
+        if failure is not None:
+            response = self._error(failure)
+        else:
+            response = self._route(method, path, headers, body)
+
+        if self.record:
+            with self._lock:
+                self.calls.append(Call(method, path, headers, body, response[0]))
+        return response
+
+    def _route(self, method, path, headers, body):
+        if method == 'POST' and path == '/oauth/token':
+            return self._token(headers, body)
+        match = self._NOTIFICATION.match(path)
+        if method == 'POST' and match:
+            return self._notification(headers, body)
+        if method == 'GET' and path in ('/capabilities', '/capabilities/'):
+            return 200, {}, {
+                'name': 'Fake HipChat',
+                'links': {'self': self.url + '/capabilities', 'api': self.url},
+                'capabilities': {
+                    'oauth2Provider': {'tokenUrl': self.url + '/oauth/token'},
+                },
+            }
+        return self._error(404)
+
+    def _token(self, headers, body):
+        try:
+            scheme, credentials = headers['Authorization'].split()
+            client_id, _ = base64.b64decode(credentials).decode().split(':', 1)
+        except (KeyError, ValueError):
+            return self._error(401)
+        if scheme != 'Basic' or (self.clients is not None and client_id not in self.clients):
+            return self._error(401)
+        if not body or body.get('grant_type') != 'client_credentials':
+            return self._error(400)
+
+        group_id = self.clients[client_id] if self.clients is not None else self.default_group
+        with self._lock:
+            token = 'fake-token-{n}'.format(n=next(self._token_numbers))
+            self._tokens[token] = client_id
+        return 200, {}, {
+            'access_token': token,
+            'expires_in': self.TOKEN_LIFETIME,
+            'group_id': group_id,
+            'group_name': 'Group {group_id}'.format(group_id=group_id),
+            'scope': body.get('scope', ''),
+            'token_type': 'bearer',
+        }
+
+    def _notification(self, headers, body):
+        scheme, _, token = headers.get('Authorization', '').partition(' ')
+        with self._lock:
+            known = token in self._tokens
+        if scheme != 'Bearer' or not known:
+            return self._error(401)
+        if not body or not body.get('message'):
+            return self._error(400)
+        return 204, self._rate_limit_headers(self.RATE_LIMIT - 1), None
+
+    def _error(self, status):
+        headers = self._rate_limit_headers(0) if status == 403 else {}
+        return status, headers, {'error': {'code': status, 'message': 'Fake HipChat error', 'type': 'Fake'}}
+
+    def _rate_limit_headers(self, remaining):
+        # When throttling, tell clients to back off for a second
+        reset = time.time() + (self.RATE_LIMIT_PERIOD if remaining else 1)
+        return {
+            'X-Ratelimit-Limit': str(self.RATE_LIMIT),
+            'X-Ratelimit-Remaining': str(remaining),
+            'X-Ratelimit-Reset': str(int(reset)),
+        }
+
+    def _control(self, method, path, body):
+        if method == 'GET' and path == '/_fake/calls':
+            with self._lock:
+                return 200, {}, [call.as_dict() for call in self.calls]
+        if method == 'POST' and path == '/_fake/fail':
+            try:
+                self.fail_next(int(body['status']), int(body.get('count', 1)))
+            except (KeyError, TypeError, ValueError):
+                return 400, {}, {'error': 'Expected {"status": ..., "count": ...}'}
+            return 204, {}, None
+        if method == 'POST' and path == '/_fake/reset':
+            self.reset()
+            return 204, {}, None
+        return 404, {}, None
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Passes requests to the FakeHipChat of the server"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_POST(self):
+        self._respond('POST')
+
+    def _respond(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        try:
+            body = json.loads(raw.decode()) if raw else None
+        except ValueError:
+            body = None
+        status, headers, response = self.server.fake.handle(method, self.path, dict(self.headers.items()), body)
+
+        content = json.dumps(response).encode() if response is not None else b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if content:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # Calls are recorded instead
+        pass
@@ -1,8 +1,13 @@
 import json
+import os
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import AuthBase, HTTPBasicAuth
-from . import settings
+from . import metrics, settings
+from .cache import LRUCache
 
 
 class BearerAuth(AuthBase):
@@ -16,8 +21,126 @@ class BearerAuth(AuthBase):
         return r
 
 
+class CircuitBreaker:
+    """Stops calls to a service which keeps failing, so callers fail fast instead of waiting on it
+
+    The breaker is closed (calls go through) until failure_threshold consecutive failures are recorded. It then opens,
+    and calls are refused until reset_timeout seconds have passed. After that a single trial call is let through
+    (half-open): if it succeeds the breaker closes, and if it fails the breaker opens again.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        """
+        Args:
+            failure_threshold (int): The number of consecutive failures which opens the breaker
+            reset_timeout (float): The number of seconds to stay open before allowing a trial call
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Check whether a call may be made now
+
+        Returns:
+            bool: True if the call may go ahead
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_in_progress or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial_in_progress = True
+            return True
+
+    def record_success(self):
+        """Record a successful call, closing the breaker"""
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        """Record a failed call, opening the breaker if there have been too many"""
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_progress or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+
+class TokenBucket:
+    """A token bucket rate limiter
+
+    Holds up to capacity tokens, refilled evenly over period seconds. Callers reserve a token before each request, and
+    either wait for as long as they are told to or cancel the reservation. Reservations may run the bucket into debt,
+    so that waiting callers are spaced out rather than all retrying at once.
+    """
+
+    def __init__(self, capacity, period):
+        """
+        Args:
+            capacity (float): The maximum number of requests in a burst
+            period (float): The number of seconds it takes to refill the bucket
+        """
+        self.capacity = capacity
+        self.rate = capacity / float(period)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Reserve a token
+
+        Returns:
+            float: The number of seconds to wait before making the request (0 if it can be made now)
+        """
+        with self._lock:
+            now = self._refill()
+            self._tokens -= 1
+            return max(0, -self._tokens / self.rate, self._blocked_until - now)
+
+    def cancel(self):
+        """Give back a token from a reservation which will not be used"""
+        with self._lock:
+            self._tokens = min(self._tokens + 1, self.capacity)
+
+    def block(self, seconds):
+        """Empty the bucket and refuse requests for a while, e.g. because the server told us we have run out
+
+        Args:
+            seconds (float): How long to refuse requests for
+        """
+        with self._lock:
+            now = self._refill()
+            self._tokens = min(self._tokens, 0)
+            self._blocked_until = max(self._blocked_until, now + seconds)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._updated) * self.rate, self.capacity)
+        self._updated = now
+        return now
+
+
 class HipChat:
-    """Provides access to the HipChat API"""
+    """Provides access to the HipChat API
+
+    All instances in a process share one pooled, keep-alive HTTP session, so requests after the first reuse a warm
+    connection instead of paying for a new TCP and TLS handshake.
+    """
+    _session = None
+    _session_pid = None
+    _session_lock = threading.Lock()
+    breaker = CircuitBreaker(settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD, settings.CIRCUIT_BREAKER_RESET_TIMEOUT)
+    # Rate limiters for rooms and tokens, keyed by ('room', room) or ('token', token)
+    _buckets = LRUCache(settings.RATE_LIMIT_BUCKETS)
+    _buckets_lock = threading.Lock()
+
     def __init__(self, token):
         """
         Args:
@@ -25,6 +148,66 @@ class HipChat:
         """
         self._token = token
 
+    @classmethod
+    def session(cls):
+        """Get the HTTP session shared by all HipChat clients in this process
+
+        The session is created lazily, and recreated after a fork so that worker processes never share sockets.
+
+        Returns:
+            requests.Session: The shared session
+        """
+        pid = os.getpid()
+        if cls._session is None or cls._session_pid != pid:
+            with cls._session_lock:
+                if cls._session is None or cls._session_pid != pid:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=settings.HTTP_POOL_SIZE,
+                                          max_retries=settings.HTTP_MAX_RETRIES)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    cls._session = session
+                    cls._session_pid = pid
+        return cls._session
+
+    @classmethod
+    def _post(cls, url, payload, auth, endpoint):
+        """POST a JSON payload to HipChat over the shared session, recording the latency of the call
+
+        Args:
+            url (str): The URL to post to
+            payload: The payload, which will be serialized as JSON
+            auth (AuthBase): The authentication to use
+            endpoint (str): The name of the API endpoint, for metrics
+        Returns:
+            requests.Response: The response
+        Exceptions:
+            CircuitOpen: If HipChat has been failing and we are not currently calling it
+        """
+        data = json.dumps(payload)
+        if not cls.breaker.allow():
+            raise cls.CircuitOpen
+
+        headers = {'content-type': 'application/json'}
+        start = time.perf_counter()
+        try:
+            response = cls.session().post(url, data=data, auth=auth, headers=headers,
+                                          timeout=(settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT))
+        except Exception:
+            # Not only requests' own errors: anything which escapes (e.g. a raw socket error) must still be recorded,
+            # or a trial call would leave the breaker half-open for good
+            metrics.observe_hipchat(endpoint, 'error', time.perf_counter() - start)
+            cls.breaker.record_failure()
+            raise
+        metrics.observe_hipchat(endpoint, response.status_code, time.perf_counter() - start)
+
+        if response.status_code >= 500:
+            cls.breaker.record_failure()
+        else:
+            cls.breaker.record_success()
+        return response
+
     @classmethod
     def authenticate(cls, client_id, secret):
         """Authenticate to HipChat with a client ID and secret
@@ -33,7 +216,8 @@ class HipChat:
             client_id (str): The OAuth client ID
             secret (str): The OAuth secret
         Returns:
-            (int, str): The group ID that you have authenticated for, and your access token
+            (int, str, int): The group ID that you have authenticated for, your access token, and the number of
+                seconds until the token expires
         Exceptions:
             HipChatApiError: If an error occurs with the authentication
         """
@@ -42,36 +226,40 @@ class HipChat:
             'grant_type': 'client_credentials',
             'scope': settings.SCOPES
         }
-        headers = {'content-type': 'application/json'}
-        response = requests.post(url, data=json.dumps(payload), auth=HTTPBasicAuth(client_id, secret), headers=headers)
+        response = cls._post(url, payload, HTTPBasicAuth(client_id, secret), 'oauth_token')
         if response.status_code != 200:
             raise cls._exception_from_response(response)
 
         response_dict = json.loads(response.text)
-        return response_dict['group_id'], response_dict['access_token']
+        return response_dict['group_id'], response_dict['access_token'], response_dict['expires_in']
 
     @classmethod
     def validate_capabilities(cls, url):
         """Validate the capabilities of HipChat itself
 
-        Currently just checks that the url given is the url for hipchat.com's capabilities
-        because HipKarma doesn't support self-hosted instances of hipchat.
+        Currently just checks that the url given is the url for the capabilities of the API at settings.HIPCHAT_API_URL
+        (hipchat.com's, unless a fake server is being used) because HipKarma doesn't support self-hosted instances of
+        hipchat.
 
         Args:
             url (str): The URL of the capabilities descriptor to validate
         Exceptions:
             HipChatApiError: If an error occurs sending the notification
         """
-        return url == 'https://api.hipchat.com/v2/capabilities'
+        return url == '{api_url}/capabilities'.format(api_url=settings.HIPCHAT_API_URL)
 
     def send_room_notification(self, room, message):
         """Sends a notification to a room
 
+        Notifications are paced to HipChat's rate limits for the room and for our token. Rather than waiting for the
+        limit, a notification which cannot be sent now fails with RateLimit, saying when to try again, so that the
+        caller can reschedule it without holding up anything else.
+
         Args:
             room (int, str): The ID or name of the room
             message (str): The text of the message
-            token (str): The OAuth token to use
         Exceptions:
+            RateLimit: If we are being rate limited, by ourselves or by HipChat
             HipChatApiError: If the request to send the notification is unsuccessful.
         """
         url = '{api_url}/room/{room}/notification'.format(api_url=settings.HIPCHAT_API_URL, room=room)
@@ -81,11 +269,73 @@ class HipChat:
             'message_format': 'text',
             'notify': False
         }
-        headers = {'content-type': 'application/json'}
-        response = requests.post(url, data=json.dumps(payload), auth=BearerAuth(self._token), headers=headers)
+        self._check_rate_limit(room)
+        response = self._post(url, payload, BearerAuth(self._token), 'room_notification')
+        retry_after = self._observe_rate_limit(response)
+        if response.status_code == 403:
+            raise self.RateLimit(retry_after)
         if response.status_code != 204:
             raise self._exception_from_response(response)
 
+    @classmethod
+    def _bucket(cls, key, limit, period):
+        """Get the rate limiter for a room or token, creating it if necessary
+
+        Args:
+            key: ('room', room) or ('token', token)
+            limit (int): The limit for all processes together
+            period (float): The period of the limit, in seconds
+        Returns:
+            TokenBucket: This process's share of the limit
+        """
+        with cls._buckets_lock:
+            bucket = cls._buckets.get(key)
+            if bucket is LRUCache.MISSING:
+                bucket = TokenBucket(max(limit / float(settings.RATE_LIMIT_PROCESSES), 1), period)
+                cls._buckets.set(key, bucket)
+            return bucket
+
+    def _check_rate_limit(self, room):
+        """Take a token for sending another notification to a room, if we are allowed to send one now
+
+        Args:
+            room (int, str): The ID or name of the room
+        Exceptions:
+            RateLimit: If we are not, saying how long until we are
+        """
+        buckets = [
+            self._bucket(('room', room), settings.ROOM_RATE_LIMIT, settings.ROOM_RATE_PERIOD),
+            self._bucket(('token', self._token), settings.TOKEN_RATE_LIMIT, settings.TOKEN_RATE_PERIOD),
+        ]
+        wait = max(bucket.reserve() for bucket in buckets)
+        if wait:
+            for bucket in buckets:
+                bucket.cancel()
+            raise self.RateLimit(wait)
+
+    def _observe_rate_limit(self, response):
+        """Update our token's rate limiter from the rate limit headers in a response
+
+        Args:
+            response (requests.Response): A response from HipChat
+        Returns:
+            float: The number of seconds until the token may be used again (0 if it may be used now)
+        """
+        try:
+            remaining = int(response.headers['X-Ratelimit-Remaining'])
+            reset = float(response.headers['X-Ratelimit-Reset'])
+        except (KeyError, ValueError):
+            if response.status_code != 403:
+                return 0
+            # Throttled without telling us for how long
+            remaining, reset = 0, time.time() + settings.RATE_LIMIT_DEFAULT_WAIT
+
+        if remaining > 0 and response.status_code != 403:
+            return 0
+        delay = max(reset - time.time(), 0)
+        self._bucket(('token', self._token), settings.TOKEN_RATE_LIMIT, settings.TOKEN_RATE_PERIOD).block(delay)
+        return delay
+
     class HipChatApiError(Exception):
         """Base class for HipChat API exceptions"""
 
@@ -108,7 +358,14 @@ class HipChat:
             return 'The authentication you provided is invalid.'
 
     class RateLimit(HipChatApiError):
-        """You have exceeded the rate limit."""
+        """You have exceeded the rate limit.
+
+        Attributes:
+            retry_after (float): Seconds until the request may be made again, if known
+        """
+
+        def __init__(self, retry_after=None):
+            self.retry_after = retry_after
 
         def __str__(self):
             return 'You have exceeded the rate limit.'
@@ -131,6 +388,12 @@ class HipChat:
         def __str__(self):
             return 'HipChat is unavailable.'
 
+    class CircuitOpen(HipChatApiError):
+        """HipChat has been failing, so the request was not attempted."""
+
+        def __str__(self):
+            return 'HipChat has been failing, so the request was not attempted.'
+
     _status_code_map = {
         400: BadRequest,
         401: Unauthorized,
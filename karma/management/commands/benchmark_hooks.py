@@ -0,0 +1,235 @@
+import json
+import random
+from optparse import make_option
+from unittest import mock
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from karma import benchmark, dispatch, settings
+from karma.fakehipchat import FakeHipChat
+from karma.models import Group, Instance
+
+
+# Metrics reported for each endpoint, and whether a higher value is better
+METRICS = [
+    ('requests', True),
+    ('errors', False),
+    ('throughput', True),
+    ('p50_ms', False),
+    ('p95_ms', False),
+    ('p99_ms', False),
+    ('mean_queries', False),
+    ('max_queries', False),
+]
+
+
+class Command(BaseCommand):
+    help = ('Load test the webhooks with synthetic messages against a fake HipChat API, and report throughput, '
+            'latency percentiles and database queries per endpoint. Runs against a throwaway test database, which '
+            'must be PostgreSQL.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--requests',
+                    type='int',
+                    default=2000,
+                    help='Number of requests to measure (default 2000)'),
+        make_option('--warmup',
+                    type='int',
+                    default=200,
+                    help='Number of requests to send before measuring, which also build up karma history '
+                         '(default 200)'),
+        make_option('--concurrency',
+                    type='int',
+                    default=8,
+                    help='Number of threads sending requests (default 8)'),
+        make_option('--mix',
+                    default='give=70,show=15,leaderboard=10,help=5',
+                    help='Relative weights of the endpoints (default give=70,show=15,leaderboard=10,help=5)'),
+        make_option('--groups',
+                    type='int',
+                    default=5,
+                    help='Number of HipChat groups (default 5)'),
+        make_option('--rooms',
+                    type='int',
+                    default=2,
+                    help='Number of rooms with the add-on installed in each group (default 2)'),
+        make_option('--users',
+                    type='int',
+                    default=50,
+                    help='Number of users in each group (default 50)'),
+        make_option('--entities',
+                    type='int',
+                    default=200,
+                    help='Number of distinct non-user karma targets in each group (default 200)'),
+        make_option('--skew',
+                    type='float',
+                    default=1.1,
+                    help='Zipf exponent of the popularity of non-user targets, 0 for uniform (default 1.1)'),
+        make_option('--comment-rate',
+                    type='float',
+                    default=0.5,
+                    help='Fraction of karma messages with a comment (default 0.5)'),
+        make_option('--latency',
+                    type='float',
+                    default=0.05,
+                    help='Mean latency of the fake HipChat API in seconds (default 0.05)'),
+        make_option('--error-rate',
+                    type='float',
+                    default=0,
+                    help='Fraction of HipChat calls which fail with a 500 or 503 (default 0)'),
+        make_option('--hipchat-url',
+                    default=None,
+                    help='Use the fake HipChat API already running at this URL (see run_fake_hipchat) instead of '
+                         'starting one. It must give tokens for any client. --latency and --error-rate are ignored.'),
+        make_option('--dispatch',
+                    choices=['sync', 'async'],
+                    default='sync',
+                    help='Send notifications before responding (sync, the default) or from background threads (async)'),
+        make_option('--rate-limits',
+                    action='store_true',
+                    default=False,
+                    help='Apply the configured client-side HipChat rate limits, which otherwise dominate latency'),
+        make_option('--seed',
+                    type='int',
+                    default=None,
+                    help='Seed for the generated traffic, to repeat a run exactly'),
+        make_option('--save',
+                    default=None,
+                    help='Save the results as a baseline in this JSON file'),
+        make_option('--compare',
+                    default=None,
+                    help='Compare the results with a baseline saved in this JSON file'),
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('The benchmark sends requests from several threads, which needs PostgreSQL.')
+        try:
+            mix = {endpoint: float(weight) for endpoint, weight in
+                   (part.split('=') for part in options['mix'].split(','))}
+        except ValueError:
+            raise CommandError('Invalid mix: {mix}'.format(mix=options['mix']))
+        unknown = set(mix) - set(benchmark.ENDPOINTS)
+        if unknown:
+            raise CommandError('Unknown endpoints in mix: {unknown}'.format(unknown=', '.join(sorted(unknown))))
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        verbosity = int(options['verbosity'])
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=verbosity, autoclobber=True)
+        try:
+            results = self.benchmark(mix, options)
+        finally:
+            dispatch.dispatcher.shutdown()
+            connection.close()
+            connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+            teardown_test_environment()
+
+        self.report(results, baseline)
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write('Saved baseline to {path}'.format(path=options['save']))
+
+    def benchmark(self, mix, options):
+        """Set up the groups and instances, warm up, and then measure
+
+        Args:
+            mix ({str: float}): The relative weight of each endpoint
+            options ({}): The command's options
+        Returns:
+            {}: The options of the run, and the summary of the measurements of each endpoint
+        """
+        instances = []
+        for g in range(1, options['groups'] + 1):
+            group = Group.objects.create(group_id=g)
+            for r in range(options['rooms']):
+                # No token yet, so the first notification for each instance also gets a token from the fake API
+                instance = Instance.objects.create(oauth_client_id='benchmark-{g}-{r}'.format(g=g, r=r),
+                                                   oauth_secret='secret', room_id=g * 1000 + r, group=group)
+                instances.append((instance.oauth_client_id, g))
+
+        generator = benchmark.PayloadGenerator(instances, options['users'], options['entities'], options['skew'],
+                                               options['comment_rate'], options['seed'])
+        choose = random.Random(options['seed'])
+        endpoints = sorted(mix)
+        weights = [mix[endpoint] for endpoint in endpoints]
+
+        def generate(count):
+            return [(endpoint, generator.payload(endpoint))
+                    for endpoint in (self.choose(choose, endpoints, weights) for _ in range(count))]
+
+        fake = None
+        if options['hipchat_url'] is None:
+            error_rates = {500: options['error_rate'] / 2, 503: options['error_rate'] / 2}
+            fake = FakeHipChat(dict(instances), latency=options['latency'], error_rates=error_rates,
+                               seed=options['seed']).start()
+        patches = [mock.patch.object(settings, 'HIPCHAT_API_URL', options['hipchat_url'] or fake.url),
+                   mock.patch.object(settings, 'NOTIFICATION_DISPATCH_MODE', options['dispatch'])]
+        if not options['rate_limits']:
+            patches += [mock.patch.object(settings, 'ROOM_RATE_LIMIT', 10 ** 9),
+                        mock.patch.object(settings, 'TOKEN_RATE_LIMIT', 10 ** 9)]
+        for patch in patches:
+            patch.start()
+        try:
+            if options['warmup']:
+                benchmark.run(generate(options['warmup']), options['concurrency'])
+            stats, elapsed = benchmark.run(generate(options['requests']), options['concurrency'])
+        finally:
+            for patch in patches:
+                patch.stop()
+            if fake is not None:
+                fake.stop()
+
+        return {
+            'options': {name: options[name] for name in ('requests', 'concurrency', 'mix', 'groups', 'rooms', 'users',
+                                                         'entities', 'skew', 'comment_rate', 'latency', 'error_rate',
+                                                         'dispatch', 'rate_limits', 'seed', 'hipchat_url')},
+            'elapsed': elapsed,
+            'hipchat_calls': len(fake.calls) if fake is not None else None,
+            'endpoints': {endpoint: s.summary(elapsed) for endpoint, s in stats.items()},
+        }
+
+    @staticmethod
+    def choose(rand, items, weights):
+        """Pick an item at random, in proportion to its weight"""
+        point = rand.random() * sum(weights)
+        for item, weight in zip(items, weights):
+            point -= weight
+            if point < 0:
+                return item
+        return items[-1]
+
+    def report(self, results, baseline=None):
+        """Write a table of the results, with the change from the baseline if there is one
+
+        Args:
+            results ({}): The results of this run
+            baseline ({}): The results of an earlier run, or None
+        """
+        self.stdout.write('{requests} requests in {elapsed:.1f}s{calls}'.format(
+            requests=sum(summary['requests'] for summary in results['endpoints'].values()),
+            elapsed=results['elapsed'],
+            calls=(' ({calls} HipChat calls)'.format(calls=results['hipchat_calls'])
+                   if results['hipchat_calls'] is not None else ''),
+        ))
+        if baseline is not None and baseline.get('options') != results['options']:
+            self.stdout.write('Warning: the baseline was run with different options')
+
+        for endpoint, summary in sorted(results['endpoints'].items()):
+            self.stdout.write('\n{endpoint}'.format(endpoint=endpoint))
+            old = baseline['endpoints'].get(endpoint) if baseline is not None else None
+            for metric, higher_is_better in METRICS:
+                line = '  {metric:<14}{value:>12.2f}'.format(metric=metric, value=summary[metric])
+                if old is not None and metric in old:
+                    change = summary[metric] - old[metric]
+                    relative = ' ({percent:+.1f}%)'.format(percent=change * 100 / old[metric]) if old[metric] else ''
+                    better = change > 0 if higher_is_better else change < 0
+                    verdict = ' better' if better else (' worse' if change else '')
+                    line += '  was {old:.2f}{relative}{verdict}'.format(old=old[metric], relative=relative,
+                                                                        verdict=verdict)
+                self.stdout.write(line)
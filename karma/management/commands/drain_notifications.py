@@ -0,0 +1,68 @@
+import logging
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from karma.models import Notification
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Deliver notifications waiting in the outbox, retrying failures with backoff'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop',
+                    action='store_true',
+                    default=False,
+                    help='Keep draining the outbox until interrupted'),
+        make_option('--interval',
+                    type='float',
+                    default=5,
+                    help='Seconds to wait between polls of an empty outbox when looping (default 5)'),
+        make_option('--batch-size',
+                    type='int',
+                    default=100,
+                    help='Maximum number of notifications to fetch at once (default 100)'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            delivered, failed = self.drain(options['batch_size'])
+            if delivered or failed:
+                self.stdout.write('Delivered {delivered}, failed {failed}'.format(delivered=delivered, failed=failed))
+            if not options['loop']:
+                return
+            if not delivered and not failed:
+                close_old_connections()
+                time.sleep(options['interval'])
+
+    @staticmethod
+    def drain(batch_size):
+        """Deliver one batch of due notifications
+
+        Args:
+            batch_size (int): The maximum number of notifications to deliver
+        Returns:
+            (int, int): The number of notifications delivered, and the number which failed
+        """
+        delivered = failed = 0
+        for notification in Notification.due(batch_size):
+            # Someone else (a dispatcher thread or another drainer) may have got there first
+            if not notification.claim():
+                continue
+            try:
+                success = notification.deliver()
+            except Exception as e:
+                # Something unexpected, like the instance being uninstalled meanwhile. Count it as an attempt, so that
+                # a notification which always fails is eventually dropped instead of stopping the drain every time.
+                logger.exception('Failed to deliver notification {pk}'.format(pk=notification.pk))
+                notification.fail(e)
+                success = False
+            if success:
+                delivered += 1
+            else:
+                failed += 1
+        return delivered, failed
@@ -0,0 +1,98 @@
+import csv
+import json
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from karma.models import Group, Karma, KarmicEntity
+from karma.streaming import stream_queryset
+
+
+# Fields of the records written by export_karma and read by import_karma. Entity records come first, then karma records
+# in the order the karma was given.
+ENTITY_FIELDS = ['record', 'name', 'type', 'mention_name', 'karma', 'max_karma', 'min_karma']
+KARMA_FIELDS = ['record', 'recipient_name', 'recipient_type', 'sender_name', 'sender_type', 'value', 'when', 'comment']
+CSV_FIELDS = ENTITY_FIELDS + [field for field in KARMA_FIELDS if field not in ENTITY_FIELDS]
+
+
+class Command(BaseCommand):
+    args = '<group_id>'
+    help = ('Export the entities and karma ledger of a group as NDJSON or CSV, streaming them from the database so '
+            'that any amount of history can be exported.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format',
+                    choices=['ndjson', 'csv'],
+                    default='ndjson',
+                    help='Output format, ndjson (default) or csv'),
+        make_option('--output',
+                    default=None,
+                    help='File to write to (default standard output)'),
+        make_option('--batch-size',
+                    type='int',
+                    default=2000,
+                    help='Number of rows to fetch from the database at a time (default 2000)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: export_karma {args}'.format(args=self.args))
+        try:
+            group = Group.objects.get(group_id=int(args[0]))
+        except (ValueError, Group.DoesNotExist):
+            raise CommandError('No such group: {group_id}'.format(group_id=args[0]))
+
+        output = open(options['output'], 'w', newline='') if options['output'] else sys.stdout
+        try:
+            write = self.csv_writer(output) if options['format'] == 'csv' else self.ndjson_writer(output)
+            count = self.export(group, write, options['batch_size'])
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        self.stderr.write('Exported {count} records'.format(count=count))
+
+    @staticmethod
+    def export(group, write, batch_size):
+        """Write all of a group's entities and then its karma ledger
+
+        Args:
+            group (Group): The group to export
+            write (callable): Called with a dict for each record
+            batch_size (int): The number of rows to fetch from the database at a time
+        Returns:
+            int: The number of records written
+        """
+        count = 0
+        # Fold the shards of sharded entities, so that their exported totals include them
+        KarmicEntity.fold_shards()
+        # One transaction, so that the entities and the ledger are a consistent snapshot and the cursors stay open
+        with transaction.atomic():
+            entities = KarmicEntity.objects.filter(group=group).order_by('pk') \
+                                   .values_list(*ENTITY_FIELDS[1:])
+            for row in stream_queryset(entities, batch_size):
+                write(dict(zip(ENTITY_FIELDS, ('entity',) + row)))
+                count += 1
+
+            karmas = Karma.objects.filter(recipient__group=group).order_by('pk') \
+                          .values_list('recipient__name', 'recipient__type', 'sender__name', 'sender__type', 'value',
+                                       'when', 'comment')
+            for row in stream_queryset(karmas, batch_size):
+                record = dict(zip(KARMA_FIELDS, ('karma',) + row))
+                record['when'] = record['when'].isoformat()
+                write(record)
+                count += 1
+        return count
+
+    @staticmethod
+    def ndjson_writer(output):
+        def write(record):
+            output.write(json.dumps(record))
+            output.write('\n')
+        return write
+
+    @staticmethod
+    def csv_writer(output):
+        writer = csv.DictWriter(output, CSV_FIELDS)
+        writer.writeheader()
+        return writer.writerow
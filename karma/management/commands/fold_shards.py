@@ -0,0 +1,32 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from karma.models import KarmicEntity
+
+
+class Command(BaseCommand):
+    help = ('Fold the shards of hot entities into the entities, and stop sharding entities which have cooled down. '
+            'Run this periodically (or with --loop) when SHARD_COUNT is set.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--loop',
+                    action='store_true',
+                    default=False,
+                    help='Keep folding until interrupted'),
+        make_option('--interval',
+                    type='float',
+                    default=30,
+                    help='Seconds to wait between folds when looping (default 30)'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            folded = KarmicEntity.fold_shards()
+            if folded:
+                self.stdout.write('Folded the shards of {folded} entities'.format(folded=folded))
+            if not options['loop']:
+                return
+            close_old_connections()
+            time.sleep(options['interval'])
@@ -0,0 +1,110 @@
+import csv
+import json
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+from karma.models import Group, Karma, KarmicEntity
+
+
+class Command(BaseCommand):
+    args = '<group_id> [file]'
+    help = ('Import entities and karma exported by export_karma into a group, reading from the file (or standard '
+            'input) as a stream and inserting karma in batches. Totals are recomputed from the imported ledger, so the '
+            'totals in the entity records are ignored. The group must not have any karma yet, so that nothing is '
+            'imported twice.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format',
+                    choices=['ndjson', 'csv'],
+                    default='ndjson',
+                    help='Input format, ndjson (default) or csv'),
+        make_option('--batch-size',
+                    type='int',
+                    default=2000,
+                    help='Number of records to import per transaction (default 2000)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) not in (1, 2):
+            raise CommandError('Usage: import_karma {args}'.format(args=self.args))
+        try:
+            group_id = int(args[0])
+        except ValueError:
+            raise CommandError('Invalid group ID: {group_id}'.format(group_id=args[0]))
+        # Importing is how karma is moved to a new installation, so the group may not exist yet
+        group, _ = Group.objects.get_or_create(group_id=group_id)
+        # Karma has no natural key to recognise it by, so importing into a group with karma could count some twice
+        if Karma.objects.filter(recipient__group=group).exists():
+            raise CommandError('Group {group_id} already has karma. Import into a group without any, so that nothing '
+                               'is imported twice.'.format(group_id=group_id))
+
+        source = open(args[1], newline='') if len(args) == 2 else sys.stdin
+        try:
+            records = csv.DictReader(source) if options['format'] == 'csv' else (json.loads(line) for line in source
+                                                                                 if line.strip())
+            entities = karmas = 0
+            batch = []
+            for record in records:
+                batch.append(record)
+                if len(batch) >= options['batch_size']:
+                    imported = self.import_batch(group, batch)
+                    entities, karmas = entities + imported[0], karmas + imported[1]
+                    batch = []
+                    self.stderr.write('Imported {entities} entities and {karmas} karmas'
+                                      .format(entities=entities, karmas=karmas))
+            imported = self.import_batch(group, batch)
+            entities, karmas = entities + imported[0], karmas + imported[1]
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            # The leaderboards are not updated as karma is imported, so rebuild them from the new totals
+            KarmicEntity.invalidate_leaderboards(group.pk)
+
+        self.stderr.write('Imported {entities} entities and {karmas} karmas'.format(entities=entities, karmas=karmas))
+
+    @staticmethod
+    @transaction.atomic
+    def import_batch(group, records):
+        """Import a batch of records
+
+        All the entities the batch refers to are resolved (and created if necessary) together, and the karma is
+        inserted with bulk statements.
+
+        Args:
+            group (Group): The group to import into
+            records ([{}]): Records as written by export_karma
+        Returns:
+            (int, int): The number of entity records and karma records imported
+        """
+        entity_records = [record for record in records if record['record'] == 'entity']
+        karma_records = [record for record in records if record['record'] == 'karma']
+
+        keys = [(record['name'], record['type']) for record in entity_records]
+        for record in karma_records:
+            keys.append((record['recipient_name'], record['recipient_type']))
+            keys.append((record['sender_name'], record['sender_type']))
+        entities = KarmicEntity.resolve(group, keys)
+
+        # Keep mention names we don't have yet
+        mentions = [{'id': record['name'], 'mention_name': record['mention_name']} for record in entity_records
+                    if record['type'] == KarmicEntity.USER and record['mention_name'] and
+                    not entities[(record['name'], record['type'])].mention_name]
+        KarmicEntity.update_mentions(group, mentions)
+
+        karmas = []
+        for record in karma_records:
+            when = parse_datetime(record['when'])
+            if when is None:
+                raise CommandError('Invalid time: {when}'.format(when=record['when']))
+            karmas.append(Karma(recipient=entities[(record['recipient_name'], record['recipient_type'])],
+                                sender=entities[(record['sender_name'], record['sender_type'])],
+                                value=record['value'],
+                                when=when,
+                                comment=record['comment'] or None))
+        # History is not karma being given now, so it must not make its recipients look hot
+        Karma.insert_batch(karmas, count_writes=False)
+
+        return len(entity_records), len(karma_records)
@@ -0,0 +1,99 @@
+import io
+import os
+import pstats
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from karma import settings
+
+
+class Command(BaseCommand):
+    args = '[<webhook> ...]'
+    help = ('Merge the .pstats dumps written by the profiler (see PROFILE_DIR) for each webhook, e.g. hooks.give, and '
+            'print the functions which took the most time. Summarizes every webhook if none are given.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dir',
+                    default=None,
+                    help='Directory of the dumps (default PROFILE_DIR)'),
+        make_option('--since',
+                    type='float',
+                    default=None,
+                    help='Only merge dumps written in the last this many hours'),
+        make_option('--sort',
+                    default='cumulative',
+                    help='Order of the functions, as for pstats, e.g. cumulative, tottime or ncalls '
+                         '(default cumulative)'),
+        make_option('--limit',
+                    type='int',
+                    default=30,
+                    help='Number of functions to print for each webhook (default 30)'),
+        make_option('--output',
+                    default=None,
+                    help='Also save the merged profile of each webhook as <output>/<webhook>.pstats, for viewers like '
+                         'snakeviz'),
+    )
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or settings.PROFILE_DIR
+        if not directory or not os.path.isdir(directory):
+            raise CommandError('No profiles directory; set PROFILE_DIR or use --dir')
+        webhooks = args or sorted(entry for entry in os.listdir(directory)
+                                  if os.path.isdir(os.path.join(directory, entry)))
+        if not webhooks:
+            raise CommandError('No profiles in {directory}'.format(directory=directory))
+        since = time.time() - options['since'] * 3600 if options['since'] is not None else None
+
+        for webhook in webhooks:
+            stats, count = self.merge(os.path.join(directory, webhook), since)
+            if stats is None:
+                self.stdout.write('{webhook}: no profiles'.format(webhook=webhook))
+                continue
+            self.stdout.write('{webhook}: {count} profiles, {seconds:.3f}s per request'.format(
+                webhook=webhook, count=count, seconds=stats.total_tt / count))
+
+            # pstats writes partial lines, which OutputWrapper would break up
+            buffer = io.StringIO()
+            stats.stream = buffer
+            # The number of dumps is printed instead of every file name
+            stats.files = []
+            try:
+                stats.sort_stats(options['sort'])
+            except KeyError:
+                raise CommandError('Unknown sort key: {sort}'.format(sort=options['sort']))
+            stats.print_stats(options['limit'])
+            self.stdout.write(buffer.getvalue())
+
+            if options['output']:
+                os.makedirs(options['output'], exist_ok=True)
+                stats.dump_stats(os.path.join(options['output'], '{webhook}.pstats'.format(webhook=webhook)))
+
+    def merge(self, directory, since=None):
+        """Merge the dumps in a directory
+
+        Args:
+            directory (str): The directory of a webhook's dumps
+            since (float): If not None, ignore dumps older than this time (time.time())
+        Returns:
+            (pstats.Stats, int): The merged stats (None if there were no dumps), and the number of dumps merged
+        """
+        if not os.path.isdir(directory):
+            return None, 0
+        stats = None
+        count = 0
+        for entry in sorted(os.listdir(directory)):
+            path = os.path.join(directory, entry)
+            if not entry.endswith('.pstats') or (since is not None and os.path.getmtime(path) < since):
+                continue
+            try:
+                if stats is None:
+                    stats = pstats.Stats(path, stream=io.StringIO())
+                else:
+                    stats.add(path)
+            except (EOFError, TypeError, ValueError, OSError):
+                # Pruned or unreadable
+                self.stderr.write('Skipping {path}'.format(path=path))
+                continue
+            count += 1
+        return stats, count
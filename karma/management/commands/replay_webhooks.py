@@ -0,0 +1,166 @@
+import glob
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from optparse import make_option
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.core.management.base import BaseCommand, CommandError
+from karma.benchmark import percentile
+
+
+class Command(BaseCommand):
+    args = '<file or glob> [<file or glob> ...]'
+    help = ('Replay webhook traffic recorded with WEBHOOK_RECORD_DIR against a deployment, keeping the original timing '
+            'between requests (optionally sped up), and compare its latency and errors with the recording.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--target',
+                    default='http://localhost:5000',
+                    help='Base URL of the deployment to send the requests to (default http://localhost:5000)'),
+        make_option('--speed',
+                    type='float',
+                    default=1,
+                    help='Replay this many times faster than recorded, or 0 to send requests as fast as possible '
+                         '(default 1)'),
+        make_option('--concurrency',
+                    type='int',
+                    default=32,
+                    help='Maximum number of requests in flight (default 32)'),
+        make_option('--client-id',
+                    default=None,
+                    help='Send every request as this OAuth client ID, e.g. an instance installed on the target'),
+        make_option('--limit',
+                    type='int',
+                    default=None,
+                    help='Only replay the first this many requests'),
+        make_option('--timeout',
+                    type='float',
+                    default=30,
+                    help='Seconds to wait for each response (default 30)'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Usage: replay_webhooks {args}'.format(args=self.args))
+        if options['speed'] < 0:
+            raise CommandError('--speed must not be negative')
+        paths = sorted({path for pattern in args for path in glob.glob(pattern)})
+        if not paths:
+            raise CommandError('No recordings found')
+
+        records = self.load(paths, options['client_id'])[:options['limit']]
+        if not records:
+            raise CommandError('The recordings are empty')
+        self.stdout.write('Replaying {count} requests from {files} files'.format(count=len(records), files=len(paths)))
+
+        replayed, lag, elapsed = self.replay(records, options)
+        self.report(records, replayed, lag, elapsed)
+
+    @staticmethod
+    def load(paths, client_id=None):
+        """Read recorded requests from NDJSON files
+
+        Args:
+            paths ([str]): The files to read
+            client_id (str): If not None, the OAuth client ID to put in every payload
+        Returns:
+            [{}]: The records, in the order the requests arrived
+        """
+        records = []
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if client_id is not None and isinstance(record['body'], dict):
+                        record['body']['oauth_client_id'] = client_id
+                    records.append(record)
+        records.sort(key=lambda record: record['time'])
+        return records
+
+    @staticmethod
+    def replay(records, options):
+        """Send the requests, each at its original offset from the first (divided by the speed)
+
+        Args:
+            records ([{}]): The records, in order
+            options ({}): The command's options
+        Returns:
+            ([(float, int)], float, float): The latency in seconds and status (None if the request failed) of each
+                request, the furthest requests fell behind schedule in seconds, and the wall time of the replay
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=options['concurrency'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        target = options['target'].rstrip('/')
+        results = [None] * len(records)
+        lag = 0
+
+        def send(i, record):
+            start = time.perf_counter()
+            try:
+                response = session.post(target + record['path'], params=record['query'],
+                                        data=json.dumps(record['body']),
+                                        headers={'content-type': 'application/json'}, timeout=options['timeout'])
+                status = response.status_code
+            except Exception:
+                # Any failure to send (not only requests' own errors, e.g. an unparseable URL) counts as an error, so
+                # that every request has a result to report
+                status = None
+            results[i] = (time.perf_counter() - start, status)
+
+        first = records[0]['time']
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            for i, record in enumerate(records):
+                if options['speed']:
+                    due = (record['time'] - first) / options['speed']
+                    wait = due - (time.perf_counter() - start)
+                    if wait > 0:
+                        time.sleep(wait)
+                    else:
+                        lag = max(lag, -wait)
+                executor.submit(send, i, record)
+        return results, lag, time.perf_counter() - start
+
+    def report(self, records, replayed, lag, elapsed):
+        """Write the latency and errors of each endpoint in the recording and in the replay
+
+        Args:
+            records ([{}]): The recorded requests
+            replayed ([(float, int)]): The latency and status of each replayed request
+            lag (float): The furthest requests fell behind schedule, in seconds
+            elapsed (float): The wall time of the replay, in seconds
+        """
+        self.stdout.write('Replayed in {elapsed:.1f}s, at most {lag:.2f}s behind schedule'.format(elapsed=elapsed,
+                                                                                                  lag=lag))
+        endpoints = {}
+        for record, (latency, status) in zip(records, replayed):
+            recorded, new = endpoints.setdefault(record['path'], ([], []))
+            recorded.append((record['duration'], record['status']))
+            new.append((latency, status))
+
+        for path, (recorded, new) in sorted(endpoints.items()):
+            self.stdout.write('\n{path} ({count} requests)'.format(path=path, count=len(new)))
+            self.stdout.write('  {metric:<10}{recorded:>12}{replayed:>12}{delta:>12}'.format(
+                metric='', recorded='recorded', replayed='replayed', delta='change'))
+            rows = [('errors', self.errors(recorded), self.errors(new), '{value:d}')]
+            for p in (50, 95, 99):
+                rows.append(('p{p}_ms'.format(p=p), percentile([latency for latency, _ in recorded], p) * 1000,
+                             percentile([latency for latency, _ in new], p) * 1000, '{value:.1f}'))
+            for metric, old, value, number in rows:
+                self.stdout.write('  {metric:<10}{recorded:>12}{replayed:>12}{delta:>12}'.format(
+                    metric=metric,
+                    recorded=number.format(value=old),
+                    replayed=number.format(value=value),
+                    delta=('+' if value >= old else '') + number.format(value=value - old),
+                ))
+
+    @staticmethod
+    def errors(results):
+        """Count the requests which failed or did not respond with 200"""
+        return sum(1 for _, status in results if status != 200)
@@ -0,0 +1,68 @@
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from karma import settings
+from karma.models import Karma, KarmaRollup, KarmaRollupMark
+
+
+class Command(BaseCommand):
+    help = ('Catch the daily karma rollups up with the Karma ledger, starting from where the last run finished. '
+            'Use --rebuild to recompute them from scratch (e.g. once after enabling ROLLUP_LIVE on existing data).')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild',
+                    action='store_true',
+                    default=False,
+                    help='Delete all rollups and rebuild them from the whole ledger'),
+        make_option('--batch-size',
+                    type='int',
+                    default=10000,
+                    help='Number of Karmas to roll up per transaction (default 10000)'),
+    )
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            with transaction.atomic():
+                KarmaRollup.objects.all().delete()
+                KarmaRollupMark.objects.update_or_create(pk=1, defaults={'last_karma_id': 0})
+        elif settings.ROLLUP_LIVE:
+            raise CommandError('Rollups are updated live (ROLLUP_LIVE), catching up would count karma twice. '
+                               'Use --rebuild to recompute them instead.')
+
+        # During a rebuild with live rollups, karma newer than this is being counted as it arrives. Karma applied while
+        # the old rollups are being deleted may be counted twice, so rebuild while the rooms are quiet.
+        cutoff = timezone.now() - timedelta(seconds=0 if options['rebuild'] else settings.ROLLUP_CATCHUP_DELAY)
+        total = 0
+        while True:
+            count = self.catch_up(cutoff, options['batch_size'])
+            if not count:
+                break
+            total += count
+            self.stdout.write('Rolled up {total} karmas'.format(total=total))
+
+    @staticmethod
+    @transaction.atomic
+    def catch_up(cutoff, batch_size):
+        """Roll up the next batch of Karmas after the high-water mark
+
+        Args:
+            cutoff (datetime): Only Karmas from before this time are rolled up
+            batch_size (int): The maximum number of Karmas to roll up
+        Returns:
+            int: The number of Karmas rolled up
+        """
+        mark = KarmaRollupMark.get()
+        karmas = list(Karma.objects.filter(pk__gt=mark.last_karma_id, when__lt=cutoff)
+                                   .order_by('pk')
+                                   .values_list('pk', 'recipient__group_id', 'recipient_id', 'value', 'when')
+                                   [:batch_size])
+        if not karmas:
+            return 0
+
+        KarmaRollup.record((group_id, entity_id, value, when) for _, group_id, entity_id, value, when in karmas)
+        mark.last_karma_id = karmas[-1][0]
+        mark.save()
+        return len(karmas)
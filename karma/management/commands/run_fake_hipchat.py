@@ -0,0 +1,53 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from karma.fakehipchat import FakeHipChat
+
+
+class Command(BaseCommand):
+    help = ('Run a fake HipChat API server locally, for working offline. Point HIPCHAT_API_URL at the URL it prints. '
+            'Failures can be injected with --error-rate, or while it is running by POSTing {"status": 503, "count": 2} '
+            'to /_fake/fail.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--host',
+                    default='127.0.0.1',
+                    help='Address to listen on (default 127.0.0.1)'),
+        make_option('--port',
+                    type='int',
+                    default=8099,
+                    help='Port to listen on (default 8099)'),
+        make_option('--group',
+                    type='int',
+                    default=1,
+                    help='Group ID to give tokens for (default 1)'),
+        make_option('--latency',
+                    type='float',
+                    default=0,
+                    help='Mean response latency in seconds (default 0)'),
+        make_option('--error-rate',
+                    action='append',
+                    default=[],
+                    metavar='STATUS=RATE',
+                    help='Fail this fraction of calls with this status, e.g. 503=0.1 (may be repeated)'),
+        make_option('--no-record',
+                    action='store_false',
+                    dest='record',
+                    default=True,
+                    help='Do not record calls, e.g. for long capacity runs'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            error_rates = {int(status): float(rate) for status, rate in
+                           (error_rate.split('=') for error_rate in options['error_rate'])}
+        except ValueError:
+            raise CommandError('Error rates must look like STATUS=RATE, e.g. 503=0.1')
+
+        fake = FakeHipChat(default_group=options['group'], latency=options['latency'], error_rates=error_rates,
+                           record=options['record'], host=options['host'], port=options['port'])
+        self.stdout.write('Fake HipChat API at {url}'.format(url=fake.url))
+        try:
+            fake.serve_forever()
+        except KeyboardInterrupt:
+            pass
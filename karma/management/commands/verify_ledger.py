@@ -0,0 +1,160 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F, Max, Min, Sum
+from karma.models import Karma, KarmicEntity, Leaderboard
+from karma.streaming import stream_queryset
+
+
+class Command(BaseCommand):
+    help = ('Replay the Karma ledger to check the karma, max_karma and min_karma of every entity, and optionally '
+            'repair them. Uses constant memory regardless of the size of the ledger (apart from the repairs).')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repair',
+                    action='store_true',
+                    default=False,
+                    help='Fix entities whose totals do not match the ledger'),
+        make_option('--group',
+                    type='int',
+                    default=None,
+                    help='Only check entities in the group with this ID'),
+        make_option('--batch-size',
+                    type='int',
+                    default=2000,
+                    help='Number of rows to fetch, and entities to repair, at a time (default 2000)'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        checked = mismatched = 0
+        repairs = []
+
+        # Fold the shards of sharded entities first, so that their totals are (almost all) in their own rows. Karma
+        # which reaches their shards meanwhile is still counted below.
+        KarmicEntity.fold_shards()
+
+        # Both streams must come from one snapshot, or karma given while they are read would show up as mismatches. On
+        # PostgreSQL that takes a REPEATABLE READ transaction; at READ COMMITTED each cursor would see its own snapshot.
+        # (It can only be set by the first statement of a transaction, so not if we are already in one, e.g. in tests.)
+        outermost = not connection.in_atomic_block
+        with transaction.atomic():
+            if connection.vendor == 'postgresql' and outermost:
+                with connection.cursor() as cursor:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+
+            entities = KarmicEntity.objects.order_by('pk')
+            ledger = Karma.objects.order_by('recipient', 'when', 'pk')
+            if options['group'] is not None:
+                entities = entities.filter(group_id=options['group'])
+                ledger = ledger.filter(recipient__group_id=options['group'])
+
+            expected = self.replay(stream_queryset(ledger.values_list('recipient_id', 'value'), batch_size))
+            entities = entities.annotate(shard_karma=Sum('shards__karma'), shard_max_karma=Max('shards__max_karma'),
+                                         shard_min_karma=Min('shards__min_karma'))
+            entity_rows = stream_queryset(entities.values_list('pk', 'karma', 'max_karma', 'min_karma', 'shard_karma',
+                                                               'shard_max_karma', 'shard_min_karma'), batch_size)
+
+            # Merge the two streams, which are both ordered by entity ID
+            next_expected = next(expected, None)
+            for pk, karma, max_karma, min_karma, shard_karma, shard_max_karma, shard_min_karma in entity_rows:
+                if shard_karma is not None:
+                    # Compare the entity's total including its shards, as KarmicEntity.aggregate_totals does
+                    karma += shard_karma
+                    max_karma = max(max_karma, karma, shard_max_karma)
+                    min_karma = min(min_karma, karma, shard_min_karma)
+
+                while next_expected is not None and next_expected[0] < pk:
+                    # Karma for an entity which does not exist can only happen if the database is inconsistent
+                    self.stderr.write('Karma received by missing entity {pk}'.format(pk=next_expected[0]))
+                    next_expected = next(expected, None)
+
+                if next_expected is not None and next_expected[0] == pk:
+                    totals = next_expected[1:]
+                    next_expected = next(expected, None)
+                else:
+                    totals = (0, 0, 0)
+
+                checked += 1
+                if totals != (karma, max_karma, min_karma):
+                    mismatched += 1
+                    self.stdout.write('Entity {pk}: has {actual}, ledger says {expected}'.format(
+                        pk=pk, actual=(karma, max_karma, min_karma), expected=totals
+                    ))
+                    if options['repair']:
+                        repairs.append((pk, totals[0] - karma, totals[1], totals[2]))
+
+        # Repair outside the snapshot, in short transactions, so that each batch only holds its row locks briefly
+        for start in range(0, len(repairs), batch_size):
+            with transaction.atomic():
+                self.repair(repairs[start:start + batch_size])
+
+        if options['repair'] and mismatched:
+            # The leaderboards were built from the wrong totals, so have them rebuilt
+            leaderboards = Leaderboard.objects.all()
+            if options['group'] is not None:
+                leaderboards = leaderboards.filter(group_id=options['group'])
+            leaderboards.delete()
+
+        self.stdout.write('Checked {checked} entities, {mismatched} did not match the ledger{repaired}.'.format(
+            checked=checked,
+            mismatched=mismatched,
+            repaired=' and were repaired' if options['repair'] and mismatched else '',
+        ))
+
+    @staticmethod
+    def replay(rows):
+        """Replay ledger rows ordered by recipient, working out each recipient's totals
+
+        Args:
+            rows: An iterable of (recipient ID, value) tuples, ordered by recipient and then time
+        Returns:
+            iterator: (recipient ID, karma, max_karma, min_karma) for each recipient, in order
+        """
+        current = None
+        karma = max_karma = min_karma = 0
+        for recipient_id, value in rows:
+            if recipient_id != current:
+                if current is not None:
+                    yield current, karma, max_karma, min_karma
+                current = recipient_id
+                karma = max_karma = min_karma = 0
+            karma += {Karma.GOOD: 1, Karma.BAD: -1}.get(value, 0)
+            max_karma = max(max_karma, karma)
+            min_karma = min(min_karma, karma)
+        if current is not None:
+            yield current, karma, max_karma, min_karma
+
+    @staticmethod
+    def repair(repairs):
+        """Fix the totals of a batch of entities
+
+        The karma total is corrected by the difference from the ledger rather than overwritten, so karma applied since
+        the snapshot was taken (including karma in the shards of sharded entities) is not lost. The extremes are set
+        from the ledger, widened to include the new total.
+
+        Args:
+            repairs ([(int, int, int, int)]): (entity ID, karma correction, max_karma, min_karma) for each entity
+        """
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'UPDATE {table} AS e SET karma = e.karma + v.correction, '
+                    'max_karma = GREATEST(v.max_karma, e.karma + v.correction), '
+                    'min_karma = LEAST(v.min_karma, e.karma + v.correction) '
+                    'FROM (VALUES {values}) AS v (id, correction, max_karma, min_karma) '
+                    'WHERE e.id = v.id'.format(
+                        table=KarmicEntity._meta.db_table,
+                        values=', '.join(['(%s, %s, %s, %s)'] * len(repairs))
+                    ),
+                    [x for repair in repairs for x in repair]
+                )
+            return
+
+        # Fallback for other databases (e.g. sqlite in development)
+        for pk, correction, max_karma, min_karma in repairs:
+            entity = KarmicEntity.objects.filter(pk=pk)
+            entity.update(karma=F('karma') + correction, max_karma=max_karma, min_karma=min_karma)
+            entity.filter(max_karma__lt=F('karma')).update(max_karma=F('karma'))
+            entity.filter(min_karma__gt=F('karma')).update(min_karma=F('karma'))
@@ -0,0 +1,236 @@
+"""
+In-process performance metrics, rendered in the Prometheus text format.
+
+Each process keeps its own metrics, so with several gunicorn workers a scrape of the metrics URL only sees the worker
+which served it. The metrics view labels every sample with the dyno and process ID, so that samples from different
+workers are never mistaken for the same series. The MetricsMiddleware records requests, and HipChat records its API
+calls with observe_hipchat.
+"""
+
+import threading
+
+
+# Bucket upper bounds for latencies in seconds, and for query counts
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{name}="{value}"'.format(name=name, value=_escape(value)) for name, value in pairs) + '}'
+
+
+def _format_number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """A count of events, for each combination of label values"""
+    type = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        """
+        Args:
+            name (str): The name of the metric
+            help_text (str): What the metric counts
+            labels ((str)): The names of the labels
+        """
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """Count events
+
+        Args:
+            label_values: The value of each label, in order
+            amount (float): The number of events
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        """Get the number of events counted with some label values"""
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def samples(self, extra=()):
+        """Get the samples of the metric
+
+        Args:
+            extra ([(str, str)]): Names and values of labels to add to every sample
+        Returns:
+            [str]: The sample lines, in the Prometheus text format
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['{name}{labels} {value}'.format(name=self.name, labels=_format_labels(self.labels, label_values, extra),
+                                                value=_format_number(value))
+                for label_values, value in values]
+
+
+class Histogram:
+    """The distribution of observed values in cumulative buckets, for each combination of label values"""
+    type = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            name (str): The name of the metric
+            help_text (str): What the metric measures
+            labels ((str)): The names of the labels
+            buckets ((float)): The upper bounds of the buckets, in increasing order
+        """
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """Record an observed value
+
+        Args:
+            value (float): The value
+            label_values: The value of each label, in order
+        """
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * len(self.buckets), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def count(self, *label_values):
+        """Get the number of values observed with some label values"""
+        with self._lock:
+            state = self._values.get(label_values)
+            return state[2] if state is not None else 0
+
+    def samples(self, extra=()):
+        """Get the samples of the metric
+
+        Args:
+            extra ([(str, str)]): Names and values of labels to add to every sample
+        Returns:
+            [str]: The sample lines, in the Prometheus text format
+        """
+        extra = list(extra)
+        with self._lock:
+            values = sorted((label_values, list(counts), total, count)
+                            for label_values, (counts, total, count) in self._values.items())
+        lines = []
+        for label_values, counts, total, count in values:
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts + [count]):
+                le = '+Inf' if bound == float('inf') else _format_number(bound)
+                lines.append('{name}_bucket{labels} {count}'.format(
+                    name=self.name, labels=_format_labels(self.labels, label_values, extra + [('le', le)]),
+                    count=bucket_count))
+            labels = _format_labels(self.labels, label_values, extra)
+            lines.append('{name}_sum{labels} {total}'.format(name=self.name, labels=labels,
+                                                             total=_format_number(total)))
+            lines.append('{name}_count{labels} {count}'.format(name=self.name, labels=labels, count=count))
+        return lines
+
+
+class Registry:
+    """A set of metrics to render together"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """Add a metric
+
+        Args:
+            metric (Counter | Histogram): The metric
+        Returns:
+            The metric, for assigning
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, labels=()):
+        """Get all the metrics in the Prometheus text format
+
+        Args:
+            labels ([(str, str)]): Names and values of labels to add to every sample, e.g. to tell processes apart
+        Returns:
+            str: The metrics
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {name} {help}'.format(name=metric.name, help=metric.help_text))
+            lines.append('# TYPE {name} {type}'.format(name=metric.name, type=metric.type))
+            lines.extend(metric.samples(labels))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    'karma_requests_total', 'Requests handled, by view and response status', ('view', 'status')))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'karma_request_duration_seconds', 'Wall time to handle a request, by view', ('view',)))
+REQUEST_DB_SECONDS = REGISTRY.register(Histogram(
+    'karma_request_db_duration_seconds', 'Time spent in database queries while handling a request, by view', ('view',)))
+REQUEST_DB_QUERIES = REGISTRY.register(Histogram(
+    'karma_request_db_queries', 'Database queries made while handling a request, by view', ('view',), QUERY_BUCKETS))
+REQUEST_HIPCHAT_SECONDS = REGISTRY.register(Histogram(
+    'karma_request_hipchat_duration_seconds', 'Time spent calling the HipChat API while handling a request, by view',
+    ('view',)))
+HIPCHAT_SECONDS = REGISTRY.register(Histogram(
+    'karma_hipchat_request_duration_seconds',
+    'Latency of HipChat API calls, by endpoint, response status, and whether they were made while handling a request '
+    '(context="request") or in the background, e.g. by the notification dispatcher (context="background")',
+    ('endpoint', 'status', 'context')))
+
+
+# The HipChat calls made by the request being handled on each thread
+_request = threading.local()
+
+
+def start_request():
+    """Start totalling the HipChat calls made from this thread, for the request it is handling"""
+    _request.hipchat = [0, 0.0]
+
+
+def finish_request():
+    """Stop totalling the HipChat calls made from this thread
+
+    Returns:
+        (int, float): The number of HipChat calls made since start_request, and the seconds they took
+    """
+    calls, seconds = getattr(_request, 'hipchat', None) or (0, 0.0)
+    _request.hipchat = None
+    return calls, seconds
+
+
+def observe_hipchat(endpoint, status, seconds):
+    """Record a call to the HipChat API
+
+    Calls made on a thread handling a request also count towards that request's HipChat time. Calls made on other
+    threads (notifications sent by the dispatcher threads, which is the default) are only recorded as background calls.
+
+    Args:
+        endpoint (str): Which API endpoint was called, e.g. 'room_notification'
+        status: The status of the response, or 'error' if there was none
+        seconds (float): How long the call took
+    """
+    totals = getattr(_request, 'hipchat', None)
+    HIPCHAT_SECONDS.observe(seconds, endpoint, str(status), 'request' if totals is not None else 'background')
+    if totals is not None:
+        totals[0] += 1
+        totals[1] += seconds
@@ -0,0 +1,233 @@
+"""
+Middleware for the Karma app.
+"""
+
+import cProfile
+import json
+import logging
+import logging.handlers
+import os
+import random
+import re
+import threading
+import time
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.utils.crypto import constant_time_compare
+from . import metrics, settings
+
+
+logger = logging.getLogger(__name__)
+
+
+# Keys whose values are redacted from recorded payloads, wherever they appear
+_SECRET_KEY = re.compile(r'secret|token|password|authorization|signature|signed_request|jwt', re.IGNORECASE)
+REDACTED = '[REDACTED]'
+
+
+def redact(value):
+    """Replace the values of secret-looking keys in a decoded JSON payload
+
+    Args:
+        value: The payload
+    Returns:
+        A copy of the payload with the secrets replaced by REDACTED
+    """
+    if isinstance(value, dict):
+        return {key: REDACTED if _SECRET_KEY.search(key) else redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+class WebhookRecorderMiddleware:
+    """Records webhook requests to NDJSON files, for replaying with the replay_webhooks command
+
+    Only enabled if settings.WEBHOOK_RECORD_DIR is set. Each record has the time the request arrived, its path and
+    query, its JSON payload with secrets redacted, and the status and duration of the response. Each process writes
+    its own file, which is rotated when it reaches settings.WEBHOOK_RECORD_MAX_BYTES.
+    """
+
+    def __init__(self):
+        if not settings.WEBHOOK_RECORD_DIR:
+            raise MiddlewareNotUsed
+        self._handler = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def process_request(self, request):
+        request.karma_record_start = (time.time(), time.perf_counter())
+
+    def process_response(self, request, response):
+        # Only record webhooks, which are all named hooks.*
+        match = getattr(request, 'resolver_match', None)
+        start = getattr(request, 'karma_record_start', None)
+        if request.method != 'POST' or match is None or start is None:
+            return response
+        if not (match.url_name or '').startswith('hooks.'):
+            return response
+
+        try:
+            body = redact(json.loads(request.body.decode()))
+        except ValueError:
+            body = None
+        query = {key: REDACTED if _SECRET_KEY.search(key) else value for key, value in request.GET.items()}
+        record = {
+            'time': start[0],
+            'path': request.path,
+            'query': query,
+            'body': body,
+            'status': response.status_code,
+            'duration': time.perf_counter() - start[1],
+        }
+        self._recorder().handle(logging.makeLogRecord({'msg': json.dumps(record, sort_keys=True)}))
+        return response
+
+    def _recorder(self):
+        """Get the log handler writing this process's recording file, opening the file if necessary
+
+        The file is opened lazily, so that each worker process forked by gunicorn writes its own file.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    os.makedirs(settings.WEBHOOK_RECORD_DIR, exist_ok=True)
+                    path = os.path.join(settings.WEBHOOK_RECORD_DIR, 'webhooks-{pid}.ndjson'.format(pid=pid))
+                    handler = logging.handlers.RotatingFileHandler(path, maxBytes=settings.WEBHOOK_RECORD_MAX_BYTES,
+                                                                   backupCount=settings.WEBHOOK_RECORD_BACKUPS)
+                    handler.setFormatter(logging.Formatter('%(message)s'))
+                    self._handler = handler
+                    self._pid = pid
+        return self._handler
+
+
+class MetricsMiddleware:
+    """Records the wall time, database queries and HipChat calls of each request in karma.metrics
+
+    Only enabled if settings.METRICS_ENABLED. Requests are labelled with the name of their view. Requests slower than
+    settings.SLOW_REQUEST_THRESHOLD seconds are logged with how their time was split between the database, HipChat
+    and everything else (parsing, rendering and so on). Only HipChat calls made on the request's own thread count
+    towards it: notifications handed to the dispatcher are sent after the response, and are recorded in
+    karma.metrics.HIPCHAT_SECONDS as background calls.
+
+    Django 1.7 only times queries through its debug cursor, so the cursor is switched on for each request and the
+    queries it logged are dropped again afterwards, unless something else (DEBUG or a test) wanted them.
+    """
+
+    def __init__(self):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+
+    def process_request(self, request):
+        metrics.start_request()
+        request.karma_metrics_start = (time.perf_counter(), len(connection.queries), connection.use_debug_cursor)
+        connection.use_debug_cursor = True
+
+    def process_response(self, request, response):
+        start = getattr(request, 'karma_metrics_start', None)
+        if start is None:
+            return response
+        started, first_query, use_debug_cursor = start
+        duration = time.perf_counter() - started
+        hipchat_calls, hipchat_seconds = metrics.finish_request()
+
+        queries = connection.queries[first_query:]
+        db_seconds = sum(float(query['time']) for query in queries)
+        connection.use_debug_cursor = use_debug_cursor
+        if not connection.queries_logged:
+            del connection.queries[first_query:]
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match is not None else 'unmatched'
+        metrics.REQUESTS.inc(view, str(response.status_code))
+        metrics.REQUEST_SECONDS.observe(duration, view)
+        metrics.REQUEST_DB_SECONDS.observe(db_seconds, view)
+        metrics.REQUEST_DB_QUERIES.observe(len(queries), view)
+        metrics.REQUEST_HIPCHAT_SECONDS.observe(hipchat_seconds, view)
+
+        if settings.SLOW_REQUEST_THRESHOLD and duration > settings.SLOW_REQUEST_THRESHOLD:
+            logger.warning('Slow request to {view} ({status}): {duration:.3f}s, of which {queries} queries took '
+                           '{db:.3f}s, {calls} HipChat calls took {hipchat:.3f}s and the rest took {other:.3f}s'
+                           .format(view=view, status=response.status_code, duration=duration, queries=len(queries),
+                                   db=db_seconds, calls=hipchat_calls, hipchat=hipchat_seconds,
+                                   other=max(duration - db_seconds - hipchat_seconds, 0)))
+        return response
+
+
+class ProfilerMiddleware:
+    """Profiles a sample of webhook requests with cProfile, writing a .pstats dump of each
+
+    Only enabled if settings.PROFILE_DIR is set, so it costs nothing otherwise. A fraction settings.PROFILE_SAMPLE_RATE
+    of webhook requests is profiled, as is any webhook request whose X-Karma-Profile header matches
+    settings.PROFILE_TOKEN (the dump's file name is then returned in the same header). Dumps go in a subdirectory of
+    PROFILE_DIR for each webhook, which keeps the newest settings.PROFILE_MAX_FILES. Summarize them with the
+    merge_profiles command.
+    """
+    HEADER = 'X-Karma-Profile'
+
+    def __init__(self):
+        if not settings.PROFILE_DIR:
+            raise MiddlewareNotUsed
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        name = request.resolver_match.url_name or ''
+        if not name.startswith('hooks.'):
+            return None
+        token = request.META.get('HTTP_X_KARMA_PROFILE')
+        requested = bool(settings.PROFILE_TOKEN and token and constant_time_compare(token, settings.PROFILE_TOKEN))
+        if not requested and random.random() >= settings.PROFILE_SAMPLE_RATE:
+            return None
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running
+            return None
+        request.karma_profile = (profiler, name, requested)
+        return None
+
+    def process_response(self, request, response):
+        profile = getattr(request, 'karma_profile', None)
+        if profile is None:
+            return response
+        profiler, name, requested = profile
+        profiler.disable()
+        del request.karma_profile
+
+        path = self._dump(profiler, name)
+        if requested:
+            response[self.HEADER] = os.path.basename(path)
+        return response
+
+    @staticmethod
+    def _dump(profiler, name):
+        """Write a profile to the webhook's directory, and delete the oldest profiles there beyond the limit
+
+        Args:
+            profiler (cProfile.Profile): The finished profile
+            name (str): The name of the webhook's URL
+        Returns:
+            str: The path of the dump
+        """
+        directory = os.path.join(settings.PROFILE_DIR, name)
+        os.makedirs(directory, exist_ok=True)
+        now = time.time()
+        filename = '{time}-{micro:06d}-{pid}-{thread}.pstats'.format(
+            time=time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)), micro=int(now % 1 * 1000000), pid=os.getpid(),
+            thread=threading.get_ident())
+        path = os.path.join(directory, filename)
+        # Write under a temporary name, so that merge_profiles never reads a partial dump
+        profiler.dump_stats(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+        dumps = sorted(entry for entry in os.listdir(directory) if entry.endswith('.pstats'))
+        for old in dumps[:max(len(dumps) - settings.PROFILE_MAX_FILES, 0)]:
+            try:
+                os.remove(os.path.join(directory, old))
+            except FileNotFoundError:
+                # Another process pruned it first
+                pass
+        return path
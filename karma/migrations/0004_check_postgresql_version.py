@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# Upserts (INSERT ... ON CONFLICT) need PostgreSQL 9.5
+MIN_POSTGRESQL_VERSION = 90500
+
+
+def check_postgresql_version(apps, schema_editor):
+    """Refuse to migrate a PostgreSQL database which is too old for the upserts karma is written with
+
+    Every later migration depends on this one, so an old database is left untouched instead of half migrated.
+    """
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql' and connection.pg_version < MIN_POSTGRESQL_VERSION:
+        raise RuntimeError('HipKarma needs PostgreSQL 9.5 or later, but the database is version {version}'.format(
+            version=connection.pg_version))
+
+
+def skip_check(apps, schema_editor):
+    """Nothing to undo"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0003_karmicentity_mention_name'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_postgresql_version, skip_check),
+    ]
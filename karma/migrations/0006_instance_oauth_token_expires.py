@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0005_notification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='instance',
+            name='oauth_token_expires',
+            field=models.DateTimeField(blank=True, null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0006_instance_oauth_token_expires'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='recipient',
+            field=models.ForeignKey(to='karma.KarmicEntity', related_name='+', blank=True, null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0007_notification_recipient'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='karmicentity',
+            index_together=set([('group', 'name', 'type'), ('group', 'karma')]),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0008_karmicentity_leaderboard_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KarmaRollup',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID', auto_created=True)),
+                ('day', models.DateField()),
+                ('good', models.IntegerField(default=0)),
+                ('bad', models.IntegerField(default=0)),
+                ('entity', models.ForeignKey(to='karma.KarmicEntity', related_name='rollups')),
+                ('group', models.ForeignKey(to='karma.Group', related_name='+')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='karmarollup',
+            unique_together=set([('entity', 'day')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='karmarollup',
+            index_together=set([('group', 'day')]),
+        ),
+        migrations.CreateModel(
+            name='KarmaRollupMark',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID', auto_created=True)),
+                ('last_karma_id', models.IntegerField(default=0)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
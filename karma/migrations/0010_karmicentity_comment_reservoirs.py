@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import models, migrations
+from karma import settings
+
+
+def fill_reservoirs(apps, schema_editor):
+    """Fill the comment reservoirs of existing entities with a random sample of the comments they have received
+
+    Each sample is stored as [sender ID, comment].
+    """
+    KarmicEntity = apps.get_model('karma', 'KarmicEntity')
+    Karma = apps.get_model('karma', 'Karma')
+
+    recipients = Karma.objects.filter(comment__isnull=False).values_list('recipient_id', flat=True).distinct()
+    for pk in recipients.iterator():
+        fields = {}
+        for prefix, value in (('good', 'G'), ('bad', 'B')):
+            comments = Karma.objects.filter(recipient_id=pk, value=value, comment__isnull=False)
+            sample = comments.order_by('?').values_list('sender_id', 'comment')[:settings.RESERVOIR_SIZE]
+            fields[prefix + '_comments'] = json.dumps([list(comment) for comment in sample])
+            fields[prefix + '_comments_seen'] = comments.count()
+        KarmicEntity.objects.filter(pk=pk).update(**fields)
+
+
+def forget_reservoirs(apps, schema_editor):
+    """Nothing to undo: reversing the AddFields drops the reservoirs"""
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0009_karmarollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='karmicentity',
+            name='good_comments',
+            field=models.TextField(default='[]'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='karmicentity',
+            name='good_comments_seen',
+            field=models.IntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='karmicentity',
+            name='bad_comments',
+            field=models.TextField(default='[]'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='karmicentity',
+            name='bad_comments_seen',
+            field=models.IntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.RunPython(fill_reservoirs, forget_reservoirs),
+    ]
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import random
+
+from django.db import models, migrations
+from django.db.models import Count, F
+
+
+# Reservoir size used when merging. Later karma fills reservoirs up to settings.RESERVOIR_SIZE.
+RESERVOIR_SIZE = 10
+
+
+def merge_entities(entity_model, karma_model, rollup_model, notification_model, keep, others, reservoir_size):
+    """Merge entities into one, as karma.models.merge_entities did when this migration was written
+
+    Args:
+        entity_model, karma_model, rollup_model, notification_model: The historical KarmicEntity, Karma, KarmaRollup
+            and Notification models
+        keep (int): The primary key of the entity to merge into
+        others ([int]): The primary keys of the entities to merge into it
+        reservoir_size (int): The number of comments to keep in each of the merged entity's comment reservoirs
+    """
+    # Move the ledger
+    karma_model.objects.filter(recipient__in=others).update(recipient=keep)
+    karma_model.objects.filter(sender__in=others).update(sender=keep)
+    notification_model.objects.filter(recipient__in=others).update(recipient=keep)
+
+    # Add the rollups into the kept entity's rollups for the same days
+    for rollup in rollup_model.objects.filter(entity__in=others):
+        updated = rollup_model.objects.filter(entity=keep, day=rollup.day).update(good=F('good') + rollup.good,
+                                                                                  bad=F('bad') + rollup.bad)
+        if not updated:
+            rollup_model.objects.create(group_id=rollup.group_id, entity_id=keep, day=rollup.day, good=rollup.good,
+                                        bad=rollup.bad)
+    rollup_model.objects.filter(entity__in=others).delete()
+
+    # Recompute the totals from the merged ledger
+    karma = max_karma = min_karma = 0
+    for value in karma_model.objects.filter(recipient=keep).order_by('when', 'pk').values_list('value', flat=True) \
+                                                                                  .iterator():
+        karma += 1 if value == 'G' else -1
+        max_karma = max(max_karma, karma)
+        min_karma = min(min_karma, karma)
+
+    # Pool the comment reservoirs, weighting each entity's sample by how many comments it has seen
+    entities = list(entity_model.objects.filter(pk__in=[keep] + list(others)).order_by('-pk'))
+    fields = {'karma': karma, 'max_karma': max_karma, 'min_karma': min_karma}
+    for prefix in ('good', 'bad'):
+        pool = []
+        for entity in entities:
+            comments = json.loads(getattr(entity, prefix + '_comments'))
+            # The count may not include comments still counted in shards, but it is at least the number sampled
+            seen = max(getattr(entity, prefix + '_comments_seen'), len(comments))
+            pool.extend((random.random() ** (len(comments) / float(seen)), comment) for comment in comments)
+        fields[prefix + '_comments'] = json.dumps([comment for _, comment in sorted(pool, reverse=True)
+                                                   [:reservoir_size]])
+        fields[prefix + '_comments_seen'] = sum(getattr(entity, prefix + '_comments_seen') for entity in entities)
+
+    # Keep the most recently created mention name
+    mention_names = [entity.mention_name for entity in entities if entity.mention_name]
+    if mention_names:
+        fields['mention_name'] = mention_names[0]
+
+    entity_model.objects.filter(pk=keep).update(**fields)
+    entity_model.objects.filter(pk__in=others).delete()
+
+    # Reservoirs refer to senders by ID, so point comments the others sent at the kept entity. Each sample is stored as
+    # [sender ID, comment], so look for reservoirs with one starting with one of their IDs.
+    group_id = entity_model.objects.filter(pk=keep).values_list('group_id', flat=True).get()
+    query = models.Q()
+    for other in others:
+        pattern = '[{pk}, '.format(pk=other)
+        query |= models.Q(good_comments__contains=pattern) | models.Q(bad_comments__contains=pattern)
+    for pk, good_comments, bad_comments in entity_model.objects.filter(query, group_id=group_id) \
+                                                               .values_list('pk', 'good_comments', 'bad_comments'):
+        fields = {}
+        for prefix, reservoir in (('good', good_comments), ('bad', bad_comments)):
+            fields[prefix + '_comments'] = json.dumps([[keep if sender_id in others else sender_id, comment]
+                                                       for sender_id, comment in json.loads(reservoir)])
+        entity_model.objects.filter(pk=pk).update(**fields)
+
+
+def merge_duplicates(apps, schema_editor):
+    """Merge entities with the same group, name and type, so that they can be made unique"""
+    KarmicEntity = apps.get_model('karma', 'KarmicEntity')
+    duplicates = KarmicEntity.objects.values('group', 'name', 'type').annotate(count=Count('pk')).filter(count__gt=1)
+    for duplicate in duplicates:
+        pks = list(KarmicEntity.objects.filter(group=duplicate['group'], name=duplicate['name'], type=duplicate['type'])
+                                       .order_by('pk')
+                                       .values_list('pk', flat=True))
+        merge_entities(KarmicEntity,
+                       apps.get_model('karma', 'Karma'),
+                       apps.get_model('karma', 'KarmaRollup'),
+                       apps.get_model('karma', 'Notification'),
+                       pks[0], pks[1:], RESERVOIR_SIZE)
+
+
+def keep_merged(apps, schema_editor):
+    """Nothing to undo: merged entities cannot be told apart again"""
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0010_karmicentity_comment_reservoirs'),
+    ]
+
+    # The constraints are added by the next migration. Moving the foreign keys and deleting the duplicates leaves
+    # deferred constraint checks pending until commit, and PostgreSQL will not alter a table while they are.
+    operations = [
+        migrations.RunPython(merge_duplicates, keep_merged),
+    ]
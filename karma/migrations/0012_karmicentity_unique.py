@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0011_merge_duplicate_karmicentities'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='karmicentity',
+            unique_together=set([('group', 'name', 'type')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='karmicentity',
+            index_together=set([('group', 'karma')]),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0012_karmicentity_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='karmicentity',
+            name='sharded',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+        migrations.CreateModel(
+            name='KarmicEntityShard',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID', auto_created=True)),
+                ('shard', models.IntegerField()),
+                ('karma', models.IntegerField(default=0)),
+                ('max_karma', models.IntegerField(default=0)),
+                ('min_karma', models.IntegerField(default=0)),
+                ('good_comments_seen', models.IntegerField(default=0)),
+                ('bad_comments_seen', models.IntegerField(default=0)),
+                ('entity', models.ForeignKey(to='karma.KarmicEntity', related_name='shards')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='karmicentityshard',
+            unique_together=set([('entity', 'shard')]),
+        ),
+    ]
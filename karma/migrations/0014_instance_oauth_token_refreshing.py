@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0013_karmicentity_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='instance',
+            name='oauth_token_refreshing',
+            field=models.DateTimeField(blank=True, null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0014_instance_oauth_token_refreshing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomActivity',
+            fields=[
+                ('instance', models.OneToOneField(primary_key=True, serialize=False, to='karma.Instance',
+                                                  related_name='+')),
+                ('window_number', models.BigIntegerField()),
+                ('count', models.IntegerField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterField(
+            model_name='notification',
+            name='recipient',
+            field=models.ForeignKey(to='karma.KarmicEntity', related_name='+', blank=True, null=True,
+                                    on_delete=models.deletion.SET_NULL),
+            preserve_default=True,
+        ),
+    ]
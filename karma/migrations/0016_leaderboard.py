@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0015_roomactivity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Leaderboard',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID', auto_created=True)),
+                ('direction', models.CharField(max_length=6)),
+                ('entries', models.TextField(default='[]')),
+                ('complete', models.BooleanField(default=False)),
+                ('rebuilt', models.DateTimeField(auto_now=True)),
+                ('group', models.ForeignKey(to='karma.Group', related_name='+')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='leaderboard',
+            unique_together=set([('group', 'direction')]),
+        ),
+    ]
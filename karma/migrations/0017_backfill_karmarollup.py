@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Max
+from django.utils import timezone
+
+
+def backfill_rollups(apps, schema_editor):
+    """Rebuild the daily rollups from the whole Karma ledger, and move the rollup_karma high-water mark past it
+
+    Rollups are updated live by default, but nothing filled them in for karma given before they existed, so queries for
+    a period would silently miss it.
+    """
+    Karma = apps.get_model('karma', 'Karma')
+    KarmaRollup = apps.get_model('karma', 'KarmaRollup')
+    KarmaRollupMark = apps.get_model('karma', 'KarmaRollupMark')
+    KarmicEntity = apps.get_model('karma', 'KarmicEntity')
+
+    last_karma_id = Karma.objects.aggregate(last=Max('pk'))['last'] or 0
+    KarmaRollup.objects.all().delete()
+
+    if schema_editor.connection.vendor == 'postgresql':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {rollups} (group_id, entity_id, day, good, bad) '
+                'SELECT e.group_id, k.recipient_id, (k."when" AT TIME ZONE \'UTC\')::date, '
+                'SUM(CASE WHEN k.value = \'G\' THEN 1 ELSE 0 END), SUM(CASE WHEN k.value = \'B\' THEN 1 ELSE 0 END) '
+                'FROM {karma} AS k JOIN {entities} AS e ON e.id = k.recipient_id '
+                'WHERE k.id <= %s '
+                'GROUP BY e.group_id, k.recipient_id, (k."when" AT TIME ZONE \'UTC\')::date'.format(
+                    rollups=KarmaRollup._meta.db_table,
+                    karma=Karma._meta.db_table,
+                    entities=KarmicEntity._meta.db_table,
+                ),
+                [last_karma_id]
+            )
+    else:
+        # Fallback for other databases (e.g. sqlite in development)
+        counts = {}
+        karmas = Karma.objects.filter(pk__lte=last_karma_id).values_list('recipient__group_id', 'recipient_id',
+                                                                         'value', 'when')
+        for group_id, entity_id, value, when in karmas.iterator():
+            day = timezone.localtime(when, timezone.utc).date()
+            count = counts.setdefault((group_id, entity_id, day), [0, 0])
+            count[0 if value == 'G' else 1] += 1
+        KarmaRollup.objects.bulk_create([
+            KarmaRollup(group_id=group_id, entity_id=entity_id, day=day, good=good, bad=bad)
+            for (group_id, entity_id, day), (good, bad) in counts.items()
+        ])
+
+    KarmaRollupMark.objects.update_or_create(pk=1, defaults={'last_karma_id': last_karma_id})
+
+
+def keep_rollups(apps, schema_editor):
+    """Nothing to undo: the rollups are correct whether or not they were backfilled"""
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0016_leaderboard'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_rollups, keep_rollups),
+    ]
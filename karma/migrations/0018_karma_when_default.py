@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0017_backfill_karmarollup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='karma',
+            name='when',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('karma', '0018_karma_when_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='karmicentity',
+            name='write_window',
+            field=models.BigIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='karmicentity',
+            name='write_count',
+            field=models.IntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='karmicentity',
+            name='previous_write_count',
+            field=models.IntegerField(null=True, default=None),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='karmicentityshard',
+            name='write_window',
+            field=models.BigIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='karmicentityshard',
+            name='write_count',
+            field=models.IntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='karmicentityshard',
+            name='previous_write_count',
+            field=models.IntegerField(default=0),
+            preserve_default=True,
+        ),
+    ]
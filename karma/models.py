@@ -1,9 +1,156 @@
+import copy
+import json
+import logging
 import random
+import threading
+import time
+from datetime import timedelta
 
-from django.db import models
+import requests
+from django.core.cache import cache
+from django.db import connection, models, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from karma import settings
+from karma.cache import LRUCache
 from karma.hipchat import HipChat
 
 
+logger = logging.getLogger(__name__)
+
+
+def merge_entities(entity_model, karma_model, rollup_model, notification_model, keep, others, reservoir_size):
+    """Merge KarmicEntities into one. See KarmicEntity.merge.
+
+    This takes the models to use as arguments so that a data migration can copy it and call it with historical models,
+    so it may only use plain queryset operations on them. Call it in a transaction.
+
+    Args:
+        entity_model, karma_model, rollup_model, notification_model: The KarmicEntity, Karma, KarmaRollup and
+            Notification models
+        keep (int): The primary key of the entity to merge into
+        others ([int]): The primary keys of the entities to merge into it
+        reservoir_size (int): The number of comments to keep in each of the merged entity's comment reservoirs
+    """
+    # Move the ledger
+    karma_model.objects.filter(recipient__in=others).update(recipient=keep)
+    karma_model.objects.filter(sender__in=others).update(sender=keep)
+    notification_model.objects.filter(recipient__in=others).update(recipient=keep)
+
+    # Add the rollups into the kept entity's rollups for the same days
+    for rollup in rollup_model.objects.filter(entity__in=others):
+        updated = rollup_model.objects.filter(entity=keep, day=rollup.day).update(good=F('good') + rollup.good,
+                                                                                  bad=F('bad') + rollup.bad)
+        if not updated:
+            rollup_model.objects.create(group_id=rollup.group_id, entity_id=keep, day=rollup.day, good=rollup.good,
+                                        bad=rollup.bad)
+    rollup_model.objects.filter(entity__in=others).delete()
+
+    # Recompute the totals from the merged ledger
+    karma = max_karma = min_karma = 0
+    for value in karma_model.objects.filter(recipient=keep).order_by('when', 'pk').values_list('value', flat=True) \
+                                                                                  .iterator():
+        karma += 1 if value == 'G' else -1
+        max_karma = max(max_karma, karma)
+        min_karma = min(min_karma, karma)
+
+    # Pool the comment reservoirs, weighting each entity's sample by how many comments it has seen
+    entities = list(entity_model.objects.filter(pk__in=[keep] + list(others)).order_by('-pk'))
+    fields = {'karma': karma, 'max_karma': max_karma, 'min_karma': min_karma}
+    for prefix in ('good', 'bad'):
+        pool = []
+        for entity in entities:
+            comments = json.loads(getattr(entity, prefix + '_comments'))
+            # The count may not include comments still counted in shards, but it is at least the number sampled
+            seen = max(getattr(entity, prefix + '_comments_seen'), len(comments))
+            pool.extend((random.random() ** (len(comments) / float(seen)), comment) for comment in comments)
+        fields[prefix + '_comments'] = json.dumps([comment for _, comment in sorted(pool, reverse=True)
+                                                   [:reservoir_size]])
+        fields[prefix + '_comments_seen'] = sum(getattr(entity, prefix + '_comments_seen') for entity in entities)
+
+    # Keep the most recently created mention name
+    mention_names = [entity.mention_name for entity in entities if entity.mention_name]
+    if mention_names:
+        fields['mention_name'] = mention_names[0]
+
+    entity_model.objects.filter(pk=keep).update(**fields)
+    entity_model.objects.filter(pk__in=others).delete()
+
+    # Reservoirs refer to senders by ID, so point comments the others sent at the kept entity. Each sample is stored as
+    # [sender ID, comment], so look for reservoirs with one starting with one of their IDs.
+    group_id = entity_model.objects.filter(pk=keep).values_list('group_id', flat=True).get()
+    query = models.Q()
+    for other in others:
+        pattern = '[{pk}, '.format(pk=other)
+        query |= models.Q(good_comments__contains=pattern) | models.Q(bad_comments__contains=pattern)
+    for pk, good_comments, bad_comments in entity_model.objects.filter(query, group_id=group_id) \
+                                                               .values_list('pk', 'good_comments', 'bad_comments'):
+        fields = {}
+        for prefix, reservoir in (('good', good_comments), ('bad', bad_comments)):
+            fields[prefix + '_comments'] = json.dumps([[keep if sender_id in others else sender_id, comment]
+                                                       for sender_id, comment in json.loads(reservoir)])
+        entity_model.objects.filter(pk=pk).update(**fields)
+
+
+def current_write_window():
+    """Get the number of the window of settings.SHARD_PROMOTE_WINDOW seconds (from the epoch) karma is counted in now"""
+    return int(time.time() // settings.SHARD_PROMOTE_WINDOW)
+
+
+def _count_writes_sql(alias, window, count):
+    """Get SQL assignments which add karmas to the write counts of a KarmicEntity or KarmicEntityShard row
+
+    The counts move on to the given window first, if the row was last counted in an earlier one.
+
+    Args:
+        alias (str): The alias of the row's table
+        window (str): SQL for the window the karmas were applied in
+        count (str): SQL for the number of karmas
+    Returns:
+        str: The SET assignments
+    """
+    return ('write_count = CASE WHEN {t}.write_window = {w} THEN {t}.write_count + {c} ELSE {c} END, '
+            'previous_write_count = CASE WHEN {t}.write_window = {w} THEN {t}.previous_write_count '
+            'WHEN {t}.write_window = {w} - 1 THEN {t}.write_count ELSE 0 END, '
+            'write_window = {w}').format(t=alias, w=window, c=count)
+
+
+def _count_writes(rows, window, count):
+    """Add karmas to the write counts of the rows of a queryset, like the SQL from _count_writes_sql
+
+    Args:
+        rows (QuerySet): KarmicEntities or KarmicEntityShards
+        window (int): The window the karmas were applied in
+        count (int): The number of karmas
+    """
+    rows.filter(write_window=window).update(write_count=F('write_count') + count)
+    rows.filter(write_window=window - 1).update(previous_write_count=F('write_count'), write_count=count,
+                                                write_window=window)
+    rows.exclude(write_window=window).update(previous_write_count=0, write_count=count, write_window=window)
+
+
+def _window_counts(write_window, write_count, previous_write_count, window):
+    """Get the karmas counted in a KarmicEntity or KarmicEntityShard row for a window and the one before it
+
+    Args:
+        write_window (int): The window the row was last counted in, or 0 if it has never been counted
+        write_count (int): The count for write_window
+        previous_write_count (int): The count for the window before write_window, or None if unknown
+        window (int): The window to get the counts for
+    Returns:
+        (int, int): The count for the window, and for the one before it (None if unknown)
+    """
+    if write_window == window:
+        return write_count, previous_write_count
+    if write_window == window - 1:
+        return 0, write_count
+    if write_window == 0:
+        return 0, None
+    return 0, 0
+
+
 class Group(models.Model):
     """A group for which HipKarma has at least one installation.
 
@@ -27,18 +174,108 @@ class Instance(models.Model):
         oauth_client_id (str): The OAuth client ID for this instance
         oauth-secret (str): The OAuth secret for this instance
         oauth_token (str): The OAuth token for this instance
+        oauth_token_expires (datetime): When oauth_token expires, or None if unknown
+        oauth_token_refreshing (datetime): Until when a process has the lease to refresh oauth_token, or None
         room_id (int): The ID of the room this instance is installed in
         group (Group): The HipChat group this instance is installed in
     """
     oauth_client_id = models.CharField(max_length=50, primary_key=True)
     oauth_secret = models.CharField(max_length=50)
     oauth_token = models.CharField(max_length=50)
+    oauth_token_expires = models.DateTimeField(blank=True, null=True)
+    oauth_token_refreshing = models.DateTimeField(blank=True, null=True)
     room_id = models.IntegerField()
     group = models.ForeignKey(Group, related_name='instances')
 
+    # One lock per client ID, so that only one thread in a process refreshes a given instance's token at a time
+    _refresh_locks = {}
+    _refresh_locks_lock = threading.Lock()
+    # Seconds between looks at the database while another process refreshes the token
+    _REFRESH_POLL_INTERVAL = 0.1
+
+    # In-process cache of instances by client ID, in front of the shared Django cache
+    _cache = LRUCache(settings.INSTANCE_CACHE_SIZE, settings.INSTANCE_CACHE_TTL)
+    # Whether this instance came from a cache, and may have been uninstalled since
+    _from_cache = False
+
     class InvalidCapabilities(Exception):
         pass
 
+    @classmethod
+    def get_cached(cls, client_id):
+        """Get an instance by its OAuth client ID, with its group already loaded.
+
+        Looks in this process's cache, then Django's cache, then the database. Instances only change when they are
+        installed or uninstalled (or their token is refreshed), which invalidates the cache. Each call returns its own
+        copy of the instance, so the caller may change it without affecting other threads.
+
+        Other processes only find out about an uninstall when their copy expires, so check_installed must be called
+        before saving anything which refers to the instance.
+
+        Args:
+            client_id (str): The OAuth client ID
+        Returns:
+            Instance: The instance
+        Exceptions:
+            Instance.DoesNotExist: If there is no instance with that client ID
+        """
+        instance = cls._cache.get(client_id)
+        if instance is not LRUCache.MISSING:
+            return instance._copy(True)
+
+        key = cls._cache_key(client_id)
+        instance = cache.get(key)
+        from_cache = instance is not None
+        if not from_cache:
+            instance = cls.objects.select_related('group').get(oauth_client_id=client_id)
+            cache.set(key, instance, settings.INSTANCE_SHARED_CACHE_TTL)
+        cls._cache.set(client_id, instance)
+        return instance._copy(from_cache)
+
+    def _copy(self, from_cache):
+        """Copy this instance, for handing out from the cache
+
+        Args:
+            from_cache (bool): Whether the copy may be out of date, so check_installed should check the database
+        Returns:
+            Instance: The copy
+        """
+        instance = copy.copy(self)
+        instance._state = copy.copy(self._state)
+        instance._from_cache = from_cache
+        return instance
+
+    def check_installed(self):
+        """Make sure this instance has not been uninstalled since it was cached
+
+        Only looks in the database if the instance came from the cache, and only once.
+
+        Exceptions:
+            Instance.DoesNotExist: If the instance has been uninstalled
+        """
+        if not self._from_cache:
+            return
+        if not Instance.objects.filter(pk=self.pk).exists():
+            self.invalidate_cache(self.oauth_client_id)
+            raise Instance.DoesNotExist('{instance} has been uninstalled'.format(instance=self))
+        self._from_cache = False
+
+    @classmethod
+    def invalidate_cache(cls, client_id):
+        """Remove an instance from the cache, in this process and in Django's cache
+
+        Other processes may keep using their copy until it expires from their own cache.
+
+        Args:
+            client_id (str): The OAuth client ID of the instance
+        """
+        cls._cache.delete(client_id)
+        cache.delete(cls._cache_key(client_id))
+
+    @staticmethod
+    def _cache_key(client_id):
+        return 'karma:instance:{client_id}'.format(client_id=client_id)
+
     @classmethod
     def install(cls, client_id, secret, room_id, capabilities_url=None):
         """Create a new Instance with the information provided by HipChat upon addon installation
@@ -65,6 +302,7 @@ class Instance(models.Model):
             group = Group.objects.create(group_id=group_id)
         instance.group = group
         instance.save()
+        cls.invalidate_cache(client_id)
         return instance
 
     def refresh_token(self, save=True):
@@ -72,36 +310,121 @@ class Instance(models.Model):
 
         Returns the group ID of the group the token is valid for because bizarrely, the only way to get the group ID
         from HipChat is through the token endpoint, when you generate a token.
-        By default, causes this Instance to be saved.
+        By default, causes the token to be saved.
 
         Args:
             save (bool): If True, will save after refreshing the token. Defaults to True.
         Returns:
             int: The group ID of the group the token is valid for
         """
-        group_id, self.oauth_token = HipChat.authenticate(self.oauth_client_id, self.oauth_secret)
+        group_id, self.oauth_token, expires_in = HipChat.authenticate(self.oauth_client_id, self.oauth_secret)
+        self.oauth_token_expires = timezone.now() + timedelta(seconds=expires_in)
         if save:
-            self.save()
+            self.save(update_fields=['oauth_token', 'oauth_token_expires'])
+            # Make sure other processes do not pick up the old token from the shared cache
+            self.invalidate_cache(self.oauth_client_id)
         return group_id
 
+    def get_token(self, rejected_token=None):
+        """Get an OAuth token for this instance which is not about to expire, refreshing it if necessary.
+
+        Refreshing is single-flight: within a process only one thread refreshes a given instance at a time, and across
+        processes the refresher takes a lease on the token (oauth_token_refreshing) in a short transaction. The lease
+        is held for at most TOKEN_REFRESH_LEASE seconds, and no row lock is held while HipChat is called. Whoever
+        waited then reuses the new token instead of refreshing again.
+
+        Args:
+            rejected_token (str): A token HipChat has rejected. It will be replaced even if it has not expired.
+        Returns:
+            str: The token
+        Exceptions:
+            HipChatApiError, requests.RequestException: If the token had to be refreshed and that failed
+        """
+        if self._token_is_usable(rejected_token):
+            return self.oauth_token
+
+        with self._refresh_lock():
+            while not self._lease_token_refresh(rejected_token):
+                if self._token_is_usable(rejected_token):
+                    # Someone else refreshed the token while we were waiting
+                    return self.oauth_token
+                time.sleep(self._REFRESH_POLL_INTERVAL)
+
+            try:
+                self.refresh_token(False)
+            except Exception:
+                Instance.objects.filter(pk=self.pk).update(oauth_token_refreshing=None)
+                raise
+            self.oauth_token_refreshing = None
+            self.save(update_fields=['oauth_token', 'oauth_token_expires', 'oauth_token_refreshing'])
+            # Make sure other processes do not pick up the old token from the shared cache
+            self.invalidate_cache(self.oauth_client_id)
+        return self.oauth_token
+
+    def _lease_token_refresh(self, rejected_token=None):
+        """Take the lease to refresh the token, unless the token is usable or another process holds the lease
+
+        Loads the current token from the database, in a transaction which only lasts as long as that.
+
+        Args:
+            rejected_token (str): A token HipChat has rejected
+        Returns:
+            bool: True if we took the lease, so must refresh the token
+        """
+        with transaction.atomic():
+            current = Instance.objects.select_for_update() \
+                                      .only('oauth_token', 'oauth_token_expires', 'oauth_token_refreshing') \
+                                      .get(pk=self.pk)
+            self.oauth_token = current.oauth_token
+            self.oauth_token_expires = current.oauth_token_expires
+            now = timezone.now()
+            if self._token_is_usable(rejected_token) or \
+                    (current.oauth_token_refreshing is not None and current.oauth_token_refreshing > now):
+                return False
+            self.oauth_token_refreshing = now + timedelta(seconds=settings.TOKEN_REFRESH_LEASE)
+            Instance.objects.filter(pk=self.pk).update(oauth_token_refreshing=self.oauth_token_refreshing)
+            return True
+
+    def _token_is_usable(self, rejected_token=None):
+        """Check whether our current token can be used
+
+        Args:
+            rejected_token (str): A token HipChat has rejected
+        Returns:
+            bool: True if we have a token which has not been rejected and will not expire soon
+        """
+        return (bool(self.oauth_token) and
+                self.oauth_token != rejected_token and
+                self.oauth_token_expires is not None and
+                self.oauth_token_expires > timezone.now() + timedelta(seconds=settings.TOKEN_REFRESH_MARGIN))
+
+    def _refresh_lock(self):
+        """Get the lock guarding token refreshes for this instance within this process
+
+        Returns:
+            threading.Lock: The lock
+        """
+        with self._refresh_locks_lock:
+            return self._refresh_locks.setdefault(self.oauth_client_id, threading.Lock())
+
     def send_room_notification(self, message):
         """Sends a notification to a room
 
+        The token is refreshed first if it is about to expire.
+
         Args:
-            room (int, str): The ID or name of the room
             message (str): The text of the message
         Exceptions:
             HipChatApiError: If the request to send the notification is unsuccessful.
         """
+        token = self.get_token()
         try:
-            hipchat = HipChat(self.oauth_token)
-            hipchat.send_room_notification(self.room_id, message)
+            HipChat(token).send_room_notification(self.room_id, message)
         except HipChat.Unauthorized:
-            # If authentication fails, refresh token and try once more, because probably the token expired.
+            # If authentication fails, refresh token and try once more, because the token may have been revoked.
             # If it still fails just throw the exception because refreshing the token again is unlikely to help
-            self.refresh_token()
-            hipchat = HipChat(self.oauth_token)
-            hipchat.send_room_notification(self.room_id, message)
+            token = self.get_token(rejected_token=token)
+            HipChat(token).send_room_notification(self.room_id, message)
 
     def __str__(self):
         return "Instance (Client ID: {client_id})".format(client_id=self.oauth_client_id)
@@ -123,6 +446,18 @@ class KarmicEntity(models.Model):
         karma (int): This entity's current karma
         max_karma (int): The highest value karma has ever reached
         min_karma (int): The lowest value karma has ever reached
+        good_comments (str): JSON list of up to settings.RESERVOIR_SIZE [sender ID, comment] pairs, a uniform random
+            sample of the comments on the good karma this entity has received
+        good_comments_seen (int): The number of commented good karmas this entity has received
+        bad_comments (str): Like good_comments, for bad karma
+        bad_comments_seen (int): Like good_comments_seen, for bad karma
+        sharded (bool): Whether karma for this entity is currently written to its shards (see KarmicEntityShard)
+            instead of this row. The totals of a sharded entity are only up to date after load_totals.
+        write_window (int): The window (see current_write_window) karma for this entity was last counted in, or 0 if
+            it has not been counted yet
+        write_count (int): The number of karmas applied to this row in write_window, plus any folded from its shards
+        previous_write_count (int): Like write_count, for the window before write_window. None if unknown, because the
+            entity was not being counted then.
     """
     USER = 'U'
     STRING = 'S'
@@ -138,74 +473,705 @@ class KarmicEntity(models.Model):
     karma = models.IntegerField(default=0)
     max_karma = models.IntegerField(default=0)
     min_karma = models.IntegerField(default=0)
+    good_comments = models.TextField(default='[]')
+    good_comments_seen = models.IntegerField(default=0)
+    bad_comments = models.TextField(default='[]')
+    bad_comments_seen = models.IntegerField(default=0)
+    sharded = models.BooleanField(default=False)
+    write_window = models.BigIntegerField(default=0)
+    write_count = models.IntegerField(default=0)
+    previous_write_count = models.IntegerField(null=True, default=None)
+
+    # In-process cache of (group ID, name, type) -> (primary key, mention name, sharded), in front of resolve
+    _resolve_cache = LRUCache(settings.ENTITY_CACHE_SIZE, settings.ENTITY_CACHE_TTL)
+
+    # Directions of the leaderboard, and the order in which the database sorts each (see _leaderboard_sort_key)
+    TOP = 'top'
+    BOTTOM = 'bottom'
+    _LEADERBOARD_ORDER = {TOP: ('-karma', 'pk'), BOTTOM: ('karma', 'pk')}
 
     class Meta:
+        unique_together = [
+            ['group', 'name', 'type'],
+        ]
         index_together = [
-            ['group', 'name', 'type']
+            ['group', 'karma'],
         ]
 
     @classmethod
     def update_mentions(cls, group, mentions):
         """Given a list of mentions, update the mention names of any extant KarmicEntities
 
+        Entities which do not exist yet are created. All existing entities are fetched with one query, entities whose
+        mention name is already current are left alone, and the rest are written with bulk statements.
+
         Args:
             group: The group within which to look for entities
             mentions ([{}]): A list of dicts representing mentions. Each dict must have 'id' and 'mention_name' keys.
         """
-        for mention in mentions:
-            try:
-                entity = cls.objects.get(group=group, name=mention['id'], type=cls.USER)
-                entity.mention_name = mention['mention_name']
-                entity.save()
-            except KarmicEntity.DoesNotExist:
-                cls.objects.create(group=group, name=mention['id'], type=cls.USER,
-                                   mention_name=mention['mention_name'])
+        # Later mentions of the same user win, as they would have with one save per mention
+        mention_names = {str(mention['id']): mention['mention_name'] for mention in mentions}
+        if not mention_names:
+            return
+
+        if connection.vendor == 'postgresql':
+            # One upsert, which only writes rows that are new or whose mention name has changed
+            entities = [cls(group=group, name=name, type=cls.USER, mention_name=mention_name)
+                        for name, mention_name in sorted(mention_names.items())]
+            rows = cls._upsert(entities, ['(xmax = 0)', 'e.id', 'e.name', 'e.mention_name', 'e.sharded'],
+                               'mention_name = EXCLUDED.mention_name',
+                               'e.mention_name IS DISTINCT FROM EXCLUDED.mention_name')
+            for inserted, pk, name, mention_name, sharded in rows:
+                # As in resolve, entities created in this transaction are not cached
+                if not inserted:
+                    cls._resolve_cache.set((group.pk, name, cls.USER), (pk, mention_name, sharded))
+            cls._add_to_leaderboards(group.pk, [pk for inserted, pk, _, _, _ in rows if inserted])
+            return
+
+        existing = cls.objects.filter(group=group, type=cls.USER, name__in=list(mention_names)) \
+                              .values_list('pk', 'name', 'mention_name')
+
+        # Group the stale entities by their new mention name so each distinct name costs one UPDATE
+        stale = {}
+        found = set()
+        for pk, name, mention_name in existing:
+            found.add(name)
+            if mention_name != mention_names[name]:
+                stale.setdefault(mention_names[name], []).append(pk)
+
+        for mention_name, pks in stale.items():
+            cls.objects.filter(pk__in=pks).update(mention_name=mention_name)
+        for name in found:
+            cls._resolve_cache.delete((group.pk, name, cls.USER))
+
+        # Anything not found did not exist yet
+        missing = [cls(group=group, name=name, type=cls.USER, mention_name=mention_name)
+                   for name, mention_name in mention_names.items() if name not in found]
+        if missing:
+            cls.objects.bulk_create(missing)
+            # bulk_create does not give us primary keys
+            cls._add_to_leaderboards(group.pk, cls.objects.filter(group=group, type=cls.USER,
+                                                                  name__in=[entity.name for entity in missing])
+                                                          .values_list('pk', flat=True))
 
-    def give_karma(self, value):
-        """Apply karma to this entity.
+    @classmethod
+    def resolve(cls, group, keys):
+        """Get the entities for several (name, type) pairs at once, creating any which do not exist yet
+
+        Entities this process has resolved recently come from a cache without any queries. Those entities only have
+        their primary key, group, name, type, mention name and sharded loaded; the rest of their fields have default
+        values.
+        The others are fetched with one query, and any which do not exist yet are inserted with a single statement on
+        PostgreSQL, which is safe against concurrent creation of the same entity.
 
-        Automatically saves this entity after applying the karma.
+        New entities are not added to the leaderboards, since they are usually about to receive karma. The caller must
+        update the leaderboards with them (see update_leaderboards) once they have been committed.
 
         Args:
-            karma (str): The type of karma. One of Karma.KARMA_VALUES.
+            group (Group): The group the entities belong to
+            keys ([(str, str)]): (name, type) pairs, where type is one of KARMIC_ENTITY_TYPES
+        Returns:
+            {(str, str): KarmicEntity}: The entity for each pair. Names in the keys are converted to str.
         """
-        new_karma = self.karma
-        if value == Karma.GOOD:
-            new_karma += 1
-        elif value == Karma.BAD:
-            new_karma -= 1
+        entities = {}
+        misses = set()
+        for name, type_ in keys:
+            key = (str(name), type_)
+            cached = cls._resolve_cache.get((group.pk,) + key)
+            if cached is LRUCache.MISSING:
+                misses.add(key)
+            else:
+                entity = cls(pk=cached[0], group=group, name=key[0], type=type_, mention_name=cached[1],
+                             sharded=cached[2])
+                entity._state.adding = False
+                entity._state.db = connection.alias
+                entities[key] = entity
 
-        if new_karma > self.max_karma:
-            self.max_karma = new_karma
-        elif new_karma < self.min_karma:
-            self.min_karma = new_karma
-        self.karma = new_karma
-        self.save()
+        if misses:
+            resolved, created = cls._resolve_uncached(group, misses)
+            for (name, type_), entity in resolved.items():
+                # Entities created in this transaction would not exist if it were rolled back, so only cache them once
+                # they have been found in the database
+                if (name, type_) not in created:
+                    cls._resolve_cache.set((group.pk, name, type_), (entity.pk, entity.mention_name, entity.sharded))
+            entities.update(resolved)
+        return entities
 
-    def get_karma_sample(self, n):
-        """Get a sampling of karma for this entity.
+    @classmethod
+    def _resolve_uncached(cls, group, keys):
+        """Get or create the entities for (name, type) pairs from the database. See resolve.
 
-        Takes a random sample of up to n of the Karmas given to this user (samples good and bad separately and returns n
-        Karmas of each type.)
+        Args:
+            group (Group): The group the entities belong to
+            keys ({(str, str)}): (name, type) pairs, with names already converted to str
+        Returns:
+            ({(str, str): KarmicEntity}, {(str, str)}): The entity for each pair, and the pairs whose entities were
+                created
+        """
+        # Sorted, so that concurrent inserts lock rows in the same order
+        keys = sorted(keys)
+
+        def fetch(keys_):
+            query = models.Q()
+            for type_ in {type_ for _, type_ in keys_}:
+                query |= models.Q(type=type_, name__in=[name for name, t in keys_ if t == type_])
+            return {(entity.name, entity.type): entity for entity in cls.objects.filter(query, group=group)}
+
+        entities = fetch(keys)
+        missing = [key for key in keys if key not in entities]
+        if not missing:
+            return entities, set()
+
+        if connection.vendor == 'postgresql':
+            # Existing entities are left alone, so they are neither written nor locked. Entities which someone else
+            # inserts concurrently are skipped, and fetched again once the insert has waited for them to be committed.
+            fields = cls._meta.concrete_fields
+            rows = cls._upsert([cls(group=group, name=name, type=type_) for name, type_ in missing],
+                               ['e.' + field.column for field in fields])
+            created = set()
+            for values in rows:
+                entity = cls(**{field.attname: value for field, value in zip(fields, values)})
+                entity._state.adding = False
+                entity._state.db = connection.alias
+                entities[(entity.name, entity.type)] = entity
+                created.add((entity.name, entity.type))
+            skipped = [key for key in missing if key not in created]
+            if skipped:
+                entities.update(fetch(skipped))
+            return entities, created
+
+        # Fallback for other databases (e.g. sqlite in development)
+        # bulk_create does not give us primary keys, so fetch the new entities again
+        cls.objects.bulk_create([cls(group=group, name=name, type=type_) for name, type_ in missing])
+        entities.update(fetch(missing))
+        return entities, set(missing)
+
+    @classmethod
+    def _upsert(cls, entities, returning, update=None, where=None):
+        """Insert entities, or update them if they already exist, in one statement (PostgreSQL 9.5 or later only)
+
+        Args:
+            entities ([KarmicEntity]): Unsaved entities
+            returning ([str]): SQL expressions to return for each inserted or updated row
+            update (str): SQL for the SET clause used when an entity already exists, or None to leave existing entities
+                alone. The table is aliased as e, and the entity which was to be inserted is EXCLUDED.
+            where (str): SQL condition for updating an existing entity, or None to always update
+        Returns:
+            [tuple]: The returned values for each inserted or updated row
+        """
+        fields = [field for field in cls._meta.concrete_fields if not isinstance(field, models.AutoField)]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {table} AS e ({columns}) VALUES {values} '
+                'ON CONFLICT (group_id, name, type) DO {action} '
+                'RETURNING {returning}'.format(
+                    table=cls._meta.db_table,
+                    columns=', '.join(field.column for field in fields),
+                    values=', '.join(['({params})'.format(params=', '.join(['%s'] * len(fields)))] * len(entities)),
+                    action='NOTHING' if update is None else 'UPDATE SET {update}{where}'.format(
+                        update=update, where=' WHERE {where}'.format(where=where) if where else ''),
+                    returning=', '.join(returning),
+                ),
+                [field.get_db_prep_save(field.pre_save(entity, True), connection)
+                 for entity in entities for field in fields]
+            )
+            return cursor.fetchall()
+
+    @classmethod
+    @transaction.atomic
+    def merge(cls, entities):
+        """Merge several entities which are really the same thing into the first of them
+
+        All their karma (given and received), rollups and held announcements are moved to the first entity, its totals
+        are recomputed from its ledger, and the others are deleted.
+
+        Args:
+            entities ([KarmicEntity]): The entities to merge, all in the same group
+        Returns:
+            KarmicEntity: The merged entity, reloaded
+        """
+        keep, others = entities[0], entities[1:]
+        # Lock the entities, so no new shards can be added for them (which would reference their rows) between folding
+        # and deleting the others
+        pks = sorted(entity.pk for entity in entities)
+        list(cls.objects.select_for_update().filter(pk__in=pks).order_by('pk').values_list('pk', flat=True))
+        # Their totals are about to be recomputed from the ledger, but the comment counts in their shards are needed
+        cls.fold_shards(pks)
+        merge_entities(cls, Karma, KarmaRollup, Notification, keep.pk, [other.pk for other in others],
+                       settings.RESERVOIR_SIZE)
+        cls.invalidate_leaderboards(keep.group_id)
+        # The merged entity's mention name may have changed. The others are forgotten as they are deleted.
+        cls._resolve_cache.delete((keep.group_id, keep.name, keep.type))
+        return cls.objects.get(pk=keep.pk)
+
+    @classmethod
+    def apply_karma(cls, changes, sharded=(), count_writes=True):
+        """Apply karma to several entities at once.
+
+        The new totals and running max/min of all the entities are written in a single atomic UPDATE (on PostgreSQL),
+        so concurrent karma for the same entity is never lost. Karma for sharded entities is added to one of their
+        shards instead, so that it does not wait for other transactions giving karma to the same entity.
+
+        The karmas are counted in the rows or shards they were applied to, and entities which have received more than
+        settings.SHARD_PROMOTE_THRESHOLD in the current window are promoted to shards (if settings.SHARD_COUNT is set).
+
+        Args:
+            changes ({int: [str]}): For each entity's primary key, the values (from Karma.KARMA_VALUES) of the karma to
+                apply to it, in order
+            sharded ({int}): The primary keys of the entities which are sharded
+            count_writes (bool): Whether to count the karma and promote hot entities. False for karma which is not
+                being given now, e.g. when importing history.
+        Returns:
+            {int: (int, int, int)}: For each entity's primary key, its new karma, max_karma and min_karma
+        """
+        # Boil each entity's karma down to the overall change and the highest and lowest points along the way
+        rows = []
+        shard_rows = []
+        for pk, values in changes.items():
+            delta = peak = trough = 0
+            for value in values:
+                delta += {Karma.GOOD: 1, Karma.BAD: -1}.get(value, 0)
+                peak = max(peak, delta)
+                trough = min(trough, delta)
+            writes = len(values) if count_writes else 0
+            if pk in sharded and settings.SHARD_COUNT:
+                shard_rows.append((pk, delta, peak, trough, writes))
+            else:
+                rows.append((pk, delta, peak, trough, writes))
+
+        window = current_write_window()
+        updated = cls._apply_to_rows(rows, window) if rows else []
+        totals = {pk: (karma, max_karma, min_karma) for pk, _, karma, max_karma, min_karma, _ in updated}
+        if shard_rows:
+            totals.update((pk, (karma, max_karma, min_karma))
+                          for pk, _, karma, max_karma, min_karma in cls._apply_to_shards(shard_rows, window))
+
+        # Shard the entities which are getting too much karma to share one row
+        hot = [pk for pk, _, _, _, _, writes in updated if writes > settings.SHARD_PROMOTE_THRESHOLD]
+        if hot and settings.SHARD_COUNT and count_writes:
+            cls.objects.filter(pk__in=hot).update(sharded=True)
+            for pk, group_id, name, type_ in cls.objects.filter(pk__in=hot) \
+                                                        .values_list('pk', 'group_id', 'name', 'type'):
+                logger.info('Sharding hot entity {pk}'.format(pk=pk))
+                # Let this process start using the shards straight away. Others will when their cache entry expires.
+                cls._resolve_cache.delete((group_id, name, type_))
+        return totals
+
+    @classmethod
+    def _apply_to_rows(cls, rows, window):
+        """Apply karma to the totals in the entities' own rows, and count it. See apply_karma.
+
+        Args:
+            rows ([(int, int, int, int, int)]): (primary key, change in karma, highest point, lowest point, number of
+                karmas) for each entity, with the highest and lowest points relative to its current karma
+            window (int): The current window, see current_write_window
+        Returns:
+            [(int, int, int, int, int, int)]: (primary key, group ID, karma, max_karma, min_karma, write_count) for each
+                entity
+        """
+        if connection.vendor == 'postgresql':
+            # Within an UPDATE, column references on the right hand side see the old row.
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'UPDATE {table} AS e SET karma = e.karma + v.delta, '
+                    'max_karma = GREATEST(e.max_karma, e.karma + v.peak), '
+                    'min_karma = LEAST(e.min_karma, e.karma + v.trough), {count_writes} '
+                    'FROM (VALUES {values}) AS v (id, delta, peak, trough, writes) '
+                    'WHERE e.id = v.id '
+                    'RETURNING e.id, e.group_id, e.karma, e.max_karma, e.min_karma, e.write_count'.format(
+                        table=cls._meta.db_table,
+                        count_writes=_count_writes_sql('e', int(window), 'v.writes'),
+                        values=', '.join(['(%s, %s, %s, %s, %s)'] * len(rows))
+                    ),
+                    [x for row in rows for x in row]
+                )
+                return cursor.fetchall()
+
+        # Fallback for other databases (e.g. sqlite in development). The first UPDATE for each entity takes the
+        # row lock, so the following statements see a consistent total.
+        updated = []
+        with transaction.atomic():
+            for pk, delta, peak, trough, writes in rows:
+                entity = cls.objects.filter(pk=pk)
+                entity.update(karma=F('karma') + delta)
+                _count_writes(entity, window, writes)
+                # The highest and lowest points relative to the new total
+                high = F('karma') + (peak - delta)
+                low = F('karma') + (trough - delta)
+                entity.filter(max_karma__lt=high).update(max_karma=high)
+                entity.filter(min_karma__gt=low).update(min_karma=low)
+                updated.append(entity.values_list('pk', 'group_id', 'karma', 'max_karma', 'min_karma', 'write_count')
+                                     .get())
+        return updated
+
+    @classmethod
+    def _apply_to_shards(cls, rows, window):
+        """Apply karma to one randomly chosen shard of each of the entities, and count it there. See apply_karma.
+
+        Nothing locks the entities, so the new totals are worked out from the totals read just before, which may miss
+        karma being applied concurrently. The highest and lowest points are therefore only as good as the totals each
+        transaction saw; the verify_ledger command recomputes them exactly.
+
+        Args:
+            rows ([(int, int, int, int, int)]): (primary key, change in karma, highest point, lowest point, number of
+                karmas) for each entity, with the highest and lowest points relative to its current karma
+            window (int): The current window, see current_write_window
+        Returns:
+            [(int, int, int, int, int)]: (primary key, group ID, karma, max_karma, min_karma) for each entity
+        """
+        current = cls.aggregate_totals([pk for pk, _, _, _, _ in rows])
+        updated = []
+        shards = []
+        for pk, delta, peak, trough, writes in rows:
+            group_id, karma, max_karma, min_karma = current[pk]
+            updated.append((pk, group_id, karma + delta, max(max_karma, karma + peak), min(min_karma, karma + trough)))
+            shards.append((pk, random.randrange(settings.SHARD_COUNT), delta, karma + peak, karma + trough, 0, 0,
+                           writes))
+        KarmicEntityShard.add(shards, window)
+        return updated
+
+    @classmethod
+    def aggregate_totals(cls, pks):
+        """Get the totals of entities, including anything in their shards which has not been folded yet
+
+        Args:
+            pks ([int]): The primary keys of the entities
+        Returns:
+            {int: (int, int, int, int)}: For each entity's primary key, its group ID, karma, max_karma and min_karma
+        """
+        rows = cls.objects.filter(pk__in=pks) \
+                          .annotate(shard_karma=models.Sum('shards__karma'),
+                                    shard_max_karma=models.Max('shards__max_karma'),
+                                    shard_min_karma=models.Min('shards__min_karma')) \
+                          .values_list('pk', 'group_id', 'karma', 'max_karma', 'min_karma', 'shard_karma',
+                                       'shard_max_karma', 'shard_min_karma')
+        totals = {}
+        for pk, group_id, karma, max_karma, min_karma, shard_karma, shard_max_karma, shard_min_karma in rows:
+            karma += shard_karma or 0
+            max_karma = max(max_karma, karma, shard_max_karma if shard_max_karma is not None else max_karma)
+            min_karma = min(min_karma, karma, shard_min_karma if shard_min_karma is not None else min_karma)
+            totals[pk] = (group_id, karma, max_karma, min_karma)
+        return totals
+
+    @classmethod
+    def load_totals(cls, entities):
+        """Bring the totals of loaded entities up to date with their shards
+
+        Entities which are not sharded are left alone, so this costs no queries unless some of them are.
+
+        Args:
+            entities ([KarmicEntity]): Entities loaded from the database
+        """
+        sharded = [entity for entity in entities if entity.sharded]
+        if not sharded:
+            return
+        totals = cls.aggregate_totals([entity.pk for entity in sharded])
+        for entity in sharded:
+            _, entity.karma, entity.max_karma, entity.min_karma = totals[entity.pk]
+
+    @classmethod
+    def fold_shards(cls, pks=None):
+        """Fold the shards of entities into their own rows, and stop sharding entities which are no longer hot
+
+        An entity stops being sharded once it received no more than half of settings.SHARD_PROMOTE_THRESHOLD karmas in
+        the last complete window (or sharding has been disabled). Entities which were not being counted for all of
+        that window stay sharded until they have been. Processes which still think an entity is sharded keep writing
+        to its shards until their cache entry expires, and those shards are folded the next time.
 
         Args:
-            n (int): The number of comments to get for each type of karma.
+            pks ([int]): The primary keys of the entities to fold, or None for every entity with shards
         Returns:
-            ([Karma], [Karma]): A list of up to n good Karmas given to this user, and up to n bad ones.
+            int: The number of entities whose shards were folded
+        """
+        with transaction.atomic():
+            window = current_write_window()
+            shards = KarmicEntityShard.objects.all()
+            if pks is not None:
+                shards = shards.filter(entity__in=pks)
+            entity_ids = list(shards.values_list('entity_id', flat=True).distinct())
+            if entity_ids:
+                KarmicEntityShard.fold(entity_ids, window)
+
+            sharded = cls.objects.filter(sharded=True)
+            if pks is not None:
+                sharded = sharded.filter(pk__in=pks)
+            # Start counting sharded entities which have not been counted yet (e.g. since before counts were kept)
+            sharded.filter(write_window=0).update(write_window=window)
+            cooled = []
+            for pk, group_id, name, type_, write_window, write_count, previous_write_count in \
+                    sharded.values_list('pk', 'group_id', 'name', 'type', 'write_window', 'write_count',
+                                        'previous_write_count'):
+                _, writes = _window_counts(write_window, write_count, previous_write_count, window)
+                if not settings.SHARD_COUNT or (writes is not None and writes <= settings.SHARD_PROMOTE_THRESHOLD // 2):
+                    cooled.append(pk)
+                    cls._resolve_cache.delete((group_id, name, type_))
+            if cooled:
+                cls.objects.filter(pk__in=cooled).update(sharded=False)
+        return len(entity_ids)
+
+    @classmethod
+    def get_leaderboard(cls, group, direction, n):
+        """Get the entities with the most or the least karma in a group
+
+        The ranking is kept in a Leaderboard and updated incrementally as karma is applied, so only the n entities
+        themselves are fetched from the database. If it is missing, too short or too old it is rebuilt from the
+        (group, karma) index, which does not include karma in the shards of sharded entities until it is folded.
+
+        Args:
+            group (Group): The group to rank
+            direction (str): TOP for the most karma first, or BOTTOM for the least karma first
+            n (int): The number of entities to get, at most settings.LEADERBOARD_CACHE_SIZE
+        Returns:
+            [KarmicEntity]: Up to n entities, in order
+        """
+        fresh = timezone.now() - timedelta(seconds=settings.LEADERBOARD_CACHE_TTL)
+        leaderboard = Leaderboard.objects.filter(group=group, direction=direction, rebuilt__gt=fresh).first()
+        entries = json.loads(leaderboard.entries) if leaderboard is not None else None
+        if leaderboard is None or (not leaderboard.complete and len(entries) < n):
+            entries = cls._rebuild_leaderboard(group.pk, direction)
+
+        pks = [pk for _, pk in entries[:n]]
+        entities = cls.objects.in_bulk(pks)
+        ranked = [entities[pk] for pk in pks if pk in entities]
+        cls.load_totals(ranked)
+        # The stored totals may be slightly behind, so put the ones we just read in order
+        return sorted(ranked, key=lambda entity: cls._leaderboard_sort_key(direction)((entity.karma, entity.pk)))
+
+    @classmethod
+    def _rebuild_leaderboard(cls, group_id, direction):
+        """Rebuild one of a group's leaderboards from the database
+
+        Args:
+            group_id (int): The ID of the group
+            direction (str): TOP or BOTTOM
+        Returns:
+            [[int, int]]: The new entries, see Leaderboard
+        """
+        size = settings.LEADERBOARD_CACHE_SIZE
+        entries = [list(entry) for entry in cls.objects.filter(group_id=group_id)
+                                                        .order_by(*cls._LEADERBOARD_ORDER[direction])
+                                                        .values_list('karma', 'pk')[:size]]
+        Leaderboard.objects.update_or_create(group_id=group_id, direction=direction,
+                                             defaults={'entries': json.dumps(entries), 'complete': len(entries) < size})
+        return entries
+
+    @classmethod
+    def update_leaderboards(cls, group_id, pks):
+        """Update a group's leaderboards with the current totals of some entities
+
+        Must be called once the transaction which changed their totals (or created them) has committed, so that the
+        leaderboards never show karma which might be rolled back, and are not locked for the whole of that transaction.
+
+        Updates keep the guarantee described in Leaderboard, so a leaderboard may shrink as entities drop out of it,
+        until it is too short and has to be rebuilt. Updates of the same group are serialized by the Leaderboard row
+        locks, and each reads the totals once it holds them, so none are lost.
+
+        Args:
+            group_id (int): The ID of the group
+            pks ([int]): The primary keys of the entities
+        """
+        pks = set(pks)
+        if not pks:
+            return
+        with transaction.atomic():
+            leaderboards = list(Leaderboard.objects.select_for_update().filter(group_id=group_id).order_by('direction'))
+            if not leaderboards:
+                return
+            totals = {pk: karma for pk, (_, karma, _, _) in cls.aggregate_totals(pks).items()}
+            # Entities which no longer exist (e.g. merged away) drop out
+            totals.update({pk: None for pk in pks if pk not in totals})
+
+            for leaderboard in leaderboards:
+                sort_key = cls._leaderboard_sort_key(leaderboard.direction)
+                old_entries = json.loads(leaderboard.entries)
+                entries = [entry for entry in old_entries if entry[1] not in totals]
+                if not leaderboard.complete and not entries:
+                    # Nothing left to compare against, so rebuild it next time
+                    leaderboard.delete()
+                    continue
+
+                # Only entities ranking at least as high as the last remaining entry are known to belong in the list
+                cutoff = sort_key(entries[-1]) if entries else None
+                for pk, karma in totals.items():
+                    if karma is not None and (leaderboard.complete or sort_key((karma, pk)) <= cutoff):
+                        entries.append([karma, pk])
+                entries.sort(key=sort_key)
+
+                complete = leaderboard.complete
+                if len(entries) > settings.LEADERBOARD_CACHE_SIZE:
+                    entries = entries[:settings.LEADERBOARD_CACHE_SIZE]
+                    complete = False
+                if entries != old_entries or complete != leaderboard.complete:
+                    leaderboard.entries = json.dumps(entries)
+                    leaderboard.complete = complete
+                    leaderboard.save(update_fields=['entries', 'complete'])
+
+    @classmethod
+    def _add_to_leaderboards(cls, group_id, pks):
+        """Add new entities to a group's leaderboards, with no karma
+
+        Outside of a transaction they are added straight away. Inside one the leaderboards are dropped instead (to be
+        rebuilt when next needed), rather than being locked until it commits.
+
+        Args:
+            group_id (int): The ID of the group
+            pks ([int]): The primary keys of the new entities
+        """
+        pks = list(pks)
+        if not pks:
+            return
+        if connection.in_atomic_block:
+            cls.invalidate_leaderboards(group_id)
+        else:
+            cls.update_leaderboards(group_id, pks)
+
+    @staticmethod
+    def invalidate_leaderboards(group_id):
+        """Drop a group's leaderboards, so that they are rebuilt when next needed, e.g. after merging entities
+
+        Args:
+            group_id (int): The ID of the group
+        """
+        Leaderboard.objects.filter(group_id=group_id).delete()
+
+    @classmethod
+    def _leaderboard_sort_key(cls, direction):
+        """Get a sort key for (karma, pk) entries which puts the highest ranked first"""
+        if direction == cls.TOP:
+            return lambda entry: (-entry[0], entry[1])
+        return lambda entry: (entry[0], entry[1])
+
+    @classmethod
+    def record_comments(cls, karmas):
+        """Add the comments of new Karmas to their recipients' comment reservoirs
+
+        Uses reservoir sampling, so each reservoir stays a uniform random sample of all the comments its entity has
+        received. Must be called in the transaction which updated the recipients' totals, whose row locks keep
+        concurrent updates of the same reservoir apart. Sharded recipients are not locked by that, so their comments are
+        counted in one of their shards, and their reservoirs are only locked and written when a comment is sampled into
+        them, which gets rarer the more comments they receive.
+
+        Args:
+            karmas ([Karma]): The new Karmas, with their recipients and senders set
         """
-        def reservoir_sample(n_, l):
-            r = []
-            for i, x in enumerate(l):
-                if i < n_:
-                    r.append(x)
-                elif random.random() < n_/float(i+1):
-                    j = random.randint(0, n_-1)
-                    r[j] = x
-            return r
+        commented = [karma for karma in karmas if karma.comment]
+        if not commented:
+            return
 
-        good = self.karma_received.filter(value=Karma.GOOD, comment__isnull=False)
-        bad = self.karma_received.filter(value=Karma.BAD, comment__isnull=False)
-        return reservoir_sample(n, good), reservoir_sample(n, bad)
+        fields = ('good_comments', 'good_comments_seen', 'bad_comments', 'bad_comments_seen')
+        shard_fields = ('shard_good_comments_seen', 'shard_bad_comments_seen')
+        rows = cls.objects.filter(pk__in={karma.recipient.pk for karma in commented}) \
+                          .annotate(shard_good_comments_seen=models.Sum('shards__good_comments_seen'),
+                                    shard_bad_comments_seen=models.Sum('shards__bad_comments_seen')) \
+                          .values_list(*(('pk', 'sharded') + fields + shard_fields))
+        reservoirs = {}
+        sharded = set()
+        for row in rows:
+            reservoir = dict(zip(fields + shard_fields, row[2:]))
+            reservoir['good_comments'] = json.loads(reservoir['good_comments'])
+            reservoir['bad_comments'] = json.loads(reservoir['bad_comments'])
+            reservoirs[row[0]] = reservoir
+            if row[1] and settings.SHARD_COUNT:
+                sharded.add(row[0])
+
+        # For each recipient, the number of comments counted and where in its reservoirs they were put
+        counted = {pk: {'good': 0, 'bad': 0} for pk in reservoirs}
+        placed = {pk: [] for pk in reservoirs}
+        for karma in commented:
+            prefix = 'good' if karma.value == Karma.GOOD else 'bad'
+            pk = karma.recipient.pk
+            reservoir = reservoirs[pk]
+            comments = reservoir[prefix + '_comments']
+            counted[pk][prefix] += 1
+            seen = (reservoir[prefix + '_comments_seen'] + (reservoir['shard_' + prefix + '_comments_seen'] or 0) +
+                    counted[pk][prefix])
+            if len(comments) < settings.RESERVOIR_SIZE:
+                slot = len(comments)
+            else:
+                slot = random.randrange(seen)
+                if slot >= len(comments):
+                    continue
+            sample = [karma.sender.pk, karma.comment]
+            placed[pk].append((prefix, slot, sample))
+            cls._place_comment(comments, slot, sample)
+
+        shards = []
+        for pk, reservoir in reservoirs.items():
+            if pk in sharded:
+                shards.append((pk, random.randrange(settings.SHARD_COUNT), 0, 0, 0, counted[pk]['good'],
+                               counted[pk]['bad'], 0))
+                if not placed[pk]:
+                    continue
+                # Someone else may have written the reservoirs since we read them, so place the comments again in the
+                # reservoirs as they are now
+                current = cls.objects.select_for_update().filter(pk=pk).values_list('good_comments', 'bad_comments') \
+                                     .get()
+                update = {'good_comments': json.loads(current[0]), 'bad_comments': json.loads(current[1])}
+                for prefix, slot, sample in placed[pk]:
+                    cls._place_comment(update[prefix + '_comments'], slot, sample)
+            else:
+                update = {
+                    'good_comments': reservoir['good_comments'],
+                    'good_comments_seen': reservoir['good_comments_seen'] + counted[pk]['good'],
+                    'bad_comments': reservoir['bad_comments'],
+                    'bad_comments_seen': reservoir['bad_comments_seen'] + counted[pk]['bad'],
+                }
+            update['good_comments'] = json.dumps(update['good_comments'])
+            update['bad_comments'] = json.dumps(update['bad_comments'])
+            cls.objects.filter(pk=pk).update(**update)
+        if shards:
+            KarmicEntityShard.add(shards)
+
+    @staticmethod
+    def _place_comment(comments, slot, sample):
+        """Put a sampled comment in a reservoir
+
+        Args:
+            comments (list): The reservoir
+            slot (int): Where to put the comment. If it is past the end, the comment is added if there is still room.
+            sample ([int, str]): The sender's ID and the comment
+        """
+        if slot < len(comments):
+            comments[slot] = sample
+        elif len(comments) < settings.RESERVOIR_SIZE:
+            comments.append(sample)
+
+    def get_reservoir_sample(self, n):
+        """Get a sampling of karma comments for this entity from its comment reservoirs
+
+        The reservoirs refer to the senders by ID, so their current names are looked up, with one query (or none if
+        there are no comments).
+
+        Args:
+            n (int): The number of comments to get for each type of karma, at most settings.RESERVOIR_SIZE
+        Returns:
+            ([(str, str)], [(str, str)]): Up to n (sender name, comment) pairs for good karma, and up to n for bad.
+        """
+        def sample(reservoir):
+            comments = json.loads(reservoir)
+            return random.sample(comments, min(n, len(comments)))
+
+        good, bad = sample(self.good_comments), sample(self.bad_comments)
+        sender_ids = {sender_id for sender_id, _ in good + bad}
+        names = {}
+        if sender_ids:
+            names = {pk: self.display_name(name, type_, mention_name) for pk, name, type_, mention_name in
+                     KarmicEntity.objects.filter(pk__in=sender_ids).values_list('pk', 'name', 'type', 'mention_name')}
+        return ([(names.get(sender_id, 'Unknown'), comment) for sender_id, comment in good],
+                [(names.get(sender_id, 'Unknown'), comment) for sender_id, comment in bad])
+
+    @classmethod
+    def display_name(cls, name, type_, mention_name):
+        """Work out the display name for an entity from its raw fields
+
+        Args:
+            name (str): The entity's name
+            type_ (str): The entity's type, one of KARMIC_ENTITY_TYPES
+            mention_name (str): The entity's mention name, if any
+        Returns:
+            str: The mention name if this is a user, or just the string
+        """
+        return name if type_ == cls.STRING else ('@' + mention_name if mention_name else 'Unknown')
 
     def get_name(self):
         """Return the mention name (if this is a user) or the string
@@ -213,7 +1179,7 @@ class KarmicEntity(models.Model):
         Returns:
             str: The mention name if this is a user, or just the string
         """
-        return self.name if self.type == self.STRING else ('@' + self.mention_name if self.mention_name else 'Unknown')
+        return self.display_name(self.name, self.type, self.mention_name)
 
     def __str__(self):
         return "{type} {name}".format(
@@ -222,6 +1188,203 @@ class KarmicEntity(models.Model):
         )
 
 
+class KarmicEntityShard(models.Model):
+    """Part of the totals of a sharded KarmicEntity.
+
+    Entities which receive karma very often (like "coffee" on a Friday) are sharded: their karma is added to one of
+    settings.SHARD_COUNT shard rows chosen at random, instead of all waiting for the lock on the entity's row. The
+    entity's true totals are its own plus its shards', until the fold_shards command folds the shards into the entity.
+
+    Attributes:
+        entity (KarmicEntity): The entity this is a shard of
+        shard (int): The number of this shard, from 0 to settings.SHARD_COUNT - 1
+        karma (int): The karma applied through this shard since it was last folded
+        max_karma (int): The highest total karma of the entity seen when applying karma through this shard
+        min_karma (int): The lowest total karma of the entity seen when applying karma through this shard
+        good_comments_seen (int): The number of commented good karmas counted in this shard, see
+            KarmicEntity.good_comments_seen
+        bad_comments_seen (int): Like good_comments_seen, for bad karma
+        write_window (int): The window karma was last counted in this shard, see KarmicEntity.write_window
+        write_count (int): The number of karmas applied through this shard in write_window
+        previous_write_count (int): Like write_count, for the window before write_window
+    """
+    entity = models.ForeignKey(KarmicEntity, related_name='shards')
+    shard = models.IntegerField()
+    karma = models.IntegerField(default=0)
+    max_karma = models.IntegerField(default=0)
+    min_karma = models.IntegerField(default=0)
+    good_comments_seen = models.IntegerField(default=0)
+    bad_comments_seen = models.IntegerField(default=0)
+    write_window = models.BigIntegerField(default=0)
+    write_count = models.IntegerField(default=0)
+    previous_write_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [
+            ['entity', 'shard'],
+        ]
+
+    @classmethod
+    def add(cls, rows, window=None):
+        """Add to shards, creating them if they do not exist yet
+
+        The extremes are absolute totals of the entity, which only widen the shard's. Since every entity's max_karma is
+        at least 0 and its min_karma at most 0, passing 0 for them leaves the extremes alone. On PostgreSQL (9.5 or
+        later, for ON CONFLICT) this is a single upsert.
+
+        Args:
+            rows ([(int, int, int, int, int, int, int, int)]): (entity ID, shard, karma, max_karma, min_karma,
+                good_comments_seen, bad_comments_seen, number of karmas) to add for each shard, with no shard more than
+                once
+            window (int): The window the karmas were applied in (see current_write_window), or None for the current one
+        """
+        # Sorted, so that concurrent inserts lock rows in the same order
+        rows = sorted(rows)
+        if window is None:
+            window = current_write_window()
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'INSERT INTO {table} AS s (entity_id, shard, karma, max_karma, min_karma, good_comments_seen, '
+                    'bad_comments_seen, write_count, write_window, previous_write_count) VALUES {values} '
+                    'ON CONFLICT (entity_id, shard) DO UPDATE SET karma = s.karma + EXCLUDED.karma, '
+                    'max_karma = GREATEST(s.max_karma, EXCLUDED.max_karma), '
+                    'min_karma = LEAST(s.min_karma, EXCLUDED.min_karma), '
+                    'good_comments_seen = s.good_comments_seen + EXCLUDED.good_comments_seen, '
+                    'bad_comments_seen = s.bad_comments_seen + EXCLUDED.bad_comments_seen, {count_writes}'.format(
+                        table=cls._meta.db_table,
+                        values=', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s, 0)'] * len(rows)),
+                        count_writes=_count_writes_sql('s', 'EXCLUDED.write_window', 'EXCLUDED.write_count'),
+                    ),
+                    [x for row in rows for x in row + (window,)]
+                )
+            return
+
+        # Fallback for other databases (e.g. sqlite in development)
+        with transaction.atomic():
+            for entity_id, shard, karma, max_karma, min_karma, good_seen, bad_seen, writes in rows:
+                cls.objects.get_or_create(entity_id=entity_id, shard=shard)
+                row = cls.objects.filter(entity_id=entity_id, shard=shard)
+                row.update(karma=F('karma') + karma, good_comments_seen=F('good_comments_seen') + good_seen,
+                           bad_comments_seen=F('bad_comments_seen') + bad_seen)
+                _count_writes(row, window, writes)
+                row.filter(max_karma__lt=max_karma).update(max_karma=max_karma)
+                row.filter(min_karma__gt=min_karma).update(min_karma=min_karma)
+
+    @classmethod
+    def fold(cls, entity_ids, window=None):
+        """Move everything in the shards of entities into the entities' own rows, and delete the shards
+
+        The write counts of the shards are added to the entities' for the same windows.
+
+        Args:
+            entity_ids ([int]): The IDs of the entities
+            window (int): The current window (see current_write_window), or None to look it up
+        """
+        if window is None:
+            window = current_write_window()
+        if connection.vendor == 'postgresql':
+            # Deleting the shards waits for anyone still adding to them, and returns what they added
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'WITH s AS (DELETE FROM {shard_table} WHERE entity_id IN ({ids}) '
+                    'RETURNING entity_id, karma, max_karma, min_karma, good_comments_seen, bad_comments_seen, '
+                    'write_window, write_count, previous_write_count), '
+                    'v AS (SELECT entity_id, SUM(karma) AS karma, MAX(max_karma) AS max_karma, '
+                    'MIN(min_karma) AS min_karma, SUM(good_comments_seen) AS good_comments_seen, '
+                    'SUM(bad_comments_seen) AS bad_comments_seen, '
+                    'SUM(CASE WHEN write_window = {window} THEN write_count ELSE 0 END) AS write_count, '
+                    'SUM(CASE WHEN write_window = {window} THEN previous_write_count '
+                    'WHEN write_window = {window} - 1 THEN write_count ELSE 0 END) AS previous_write_count '
+                    'FROM s GROUP BY entity_id) '
+                    'UPDATE {entity_table} AS e SET karma = e.karma + v.karma, '
+                    'max_karma = GREATEST(e.max_karma, v.max_karma, e.karma + v.karma), '
+                    'min_karma = LEAST(e.min_karma, v.min_karma, e.karma + v.karma), '
+                    'good_comments_seen = e.good_comments_seen + v.good_comments_seen, '
+                    'bad_comments_seen = e.bad_comments_seen + v.bad_comments_seen, '
+                    'write_count = CASE WHEN e.write_window = {window} THEN e.write_count ELSE 0 END + v.write_count, '
+                    'previous_write_count = CASE WHEN e.write_window = {window} THEN e.previous_write_count '
+                    'WHEN e.write_window = {window} - 1 THEN e.write_count '
+                    'WHEN e.write_window = 0 THEN NULL ELSE 0 END + v.previous_write_count, '
+                    'write_window = {window} '
+                    'FROM v WHERE e.id = v.entity_id'.format(
+                        shard_table=cls._meta.db_table,
+                        entity_table=KarmicEntity._meta.db_table,
+                        ids=', '.join(['%s'] * len(entity_ids)),
+                        window=int(window),
+                    ),
+                    list(entity_ids)
+                )
+            return
+
+        # Fallback for other databases (e.g. sqlite in development)
+        with transaction.atomic():
+            for entity in KarmicEntity.objects.select_for_update().filter(pk__in=entity_ids):
+                shards = list(cls.objects.filter(entity=entity))
+                if not shards:
+                    continue
+                entity.karma += sum(shard.karma for shard in shards)
+                entity.max_karma = max([entity.max_karma, entity.karma] + [shard.max_karma for shard in shards])
+                entity.min_karma = min([entity.min_karma, entity.karma] + [shard.min_karma for shard in shards])
+                entity.good_comments_seen += sum(shard.good_comments_seen for shard in shards)
+                entity.bad_comments_seen += sum(shard.bad_comments_seen for shard in shards)
+                writes, previous_writes = _window_counts(entity.write_window, entity.write_count,
+                                                         entity.previous_write_count, window)
+                for shard in shards:
+                    shard_writes, shard_previous_writes = _window_counts(shard.write_window, shard.write_count,
+                                                                         shard.previous_write_count, window)
+                    writes += shard_writes
+                    if previous_writes is not None:
+                        previous_writes += shard_previous_writes or 0
+                entity.write_window, entity.write_count, entity.previous_write_count = window, writes, previous_writes
+                entity.save(update_fields=['karma', 'max_karma', 'min_karma', 'good_comments_seen',
+                                           'bad_comments_seen', 'write_window', 'write_count',
+                                           'previous_write_count'])
+                cls.objects.filter(pk__in=[shard.pk for shard in shards]).delete()
+
+    def __str__(self):
+        return "Shard {shard} of {entity}".format(shard=self.shard, entity=str(self.entity))
+
+
+class Leaderboard(models.Model):
+    """The top of a group's ranking by karma, in one direction, kept up to date as karma is applied.
+
+    It is stored in the database so that every process sees the same ranking. See KarmicEntity.get_leaderboard.
+
+    Attributes:
+        group (Group): The group which is ranked
+        direction (str): KarmicEntity.TOP or KarmicEntity.BOTTOM
+        entries (str): JSON list of [karma, pk] entries, highest ranked first. Either the list is complete (every entity
+            in the group is in it), or every entity not in it ranks no higher than its last entry.
+        complete (bool): Whether every entity in the group is in entries
+        rebuilt (datetime): When the leaderboard was last rebuilt from scratch. It is rebuilt again once that was
+            settings.LEADERBOARD_CACHE_TTL seconds ago.
+    """
+    group = models.ForeignKey(Group, related_name='+')
+    direction = models.CharField(max_length=6)
+    entries = models.TextField(default='[]')
+    complete = models.BooleanField(default=False)
+    rebuilt = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [
+            ['group', 'direction'],
+        ]
+
+    def __str__(self):
+        return "{direction} of {group}".format(direction=self.direction, group=str(self.group))
+
+
+@receiver(post_delete, sender=KarmicEntity)
+def forget_deleted_entity(sender, instance, **kwargs):
+    """Remove deleted (including merged) entities from this process's resolve cache
+
+    Other processes may keep resolving them until their cache entries expire.
+    """
+    KarmicEntity._resolve_cache.delete((instance.group_id, instance.name, instance.type))
+
+
 class Karma(models.Model):
     """An instance of karma being given to some entity.
 
@@ -247,59 +1410,483 @@ class Karma(models.Model):
     recipient = models.ForeignKey(KarmicEntity, related_name='karma_received', db_index=True)
     sender = models.ForeignKey(KarmicEntity, related_name='karma_sent', db_index=True)
     value = models.CharField(max_length=1, choices=KARMA_VALUES)
-    when = models.DateTimeField(auto_now_add=True)
+    when = models.DateTimeField(default=timezone.now)
     comment = models.TextField(blank=True, null=True)
 
-    class SelfKarma(Exception):
-        pass
-
     @classmethod
-    def apply_new(cls, instance, sender, recipient, recipient_type, value, comment=None):
-        """Apply new karma.
+    @transaction.atomic
+    def apply_batch(cls, instance, sender, operations, comment=None):
+        """Apply several new karmas from one sender at once, e.g. from a message like "@alice++ @bob++ #thanks".
 
-        Creates/saves (as necessary) model objects for the sender and recipient.
-        The returned Karma object is also automatically saved.
+        All the entities involved are resolved together, the Karmas are inserted with one statement and the totals are
+        updated with another, all in a single transaction. The recipients of the returned Karmas have their new totals.
+        Operations which would give a user good karma from themselves are rejected and left out.
 
         Args:
             instance (Instance): The instance for which we are applying karma
             sender (int): The user ID of the sender of the karma
-            recipient (str, int): The user ID (if user) or string of the recipient of the karma
-            recipient_type (str): One of KarmicEntity.KARMIC_ENTITY_TYPES, the type of the recipient
-            value: One of Karma.KARMA_VALUES, the value of the karma
-            comment: An optional comment for the karma
-        Exceptions:
-            SelfKarma: If the sender and the recipient are the same
+            operations ([(str, str, str)]): (recipient, recipient_type, value) for each karma, in order: the user ID (if
+                user) or string of the recipient, one of KarmicEntity.KARMIC_ENTITY_TYPES and one of Karma.KARMA_VALUES
+            comment: An optional comment for all of the karma
+        Returns:
+            ([Karma], [(str, str, str)]): The new Karmas, in order, and the operations which were rejected. The Karmas
+                have no primary keys, because bulk_create does not return them.
         """
         group = instance.group
 
         # Disallow giving karma to oneself
-        if recipient_type == KarmicEntity.USER and value != Karma.BAD and sender == recipient:
-            raise cls.SelfKarma
+        accepted = []
+        rejected = []
+        for operation in operations:
+            recipient, recipient_type, value = operation
+            if recipient_type == KarmicEntity.USER and value != Karma.BAD and str(sender) == str(recipient):
+                rejected.append(operation)
+            else:
+                accepted.append(operation)
+        if not accepted:
+            return [], rejected
 
-        # Get or create the KarmicEntity for the recipient
-        try:
-            recipient_entity = KarmicEntity.objects.get(group=group, name=recipient, type=recipient_type)
-        except KarmicEntity.DoesNotExist:
-            recipient_entity = KarmicEntity.objects.create(group=group, name=recipient, type=recipient_type)
+        # Get or create the KarmicEntities for the sender and all the recipients
+        keys = [(sender, KarmicEntity.USER)] + [(recipient, type_) for recipient, type_, _ in accepted]
+        entities = KarmicEntity.resolve(group, keys)
+        sender_entity = entities[(str(sender), KarmicEntity.USER)]
 
-        # Get or create the KarmicEntity for the sender
-        try:
-            sender_entity = KarmicEntity.objects.get(group=group, name=sender, type=KarmicEntity.USER)
-        except KarmicEntity.DoesNotExist:
-            sender_entity = KarmicEntity.objects.create(group=group, name=sender, type=KarmicEntity.USER)
+        # Save new karmas with the data
+        karmas = [Karma(recipient=entities[(str(recipient), type_)], sender=sender_entity, value=value, comment=comment)
+                  for recipient, type_, value in accepted]
+        cls.insert_batch(karmas)
+
+        return karmas, rejected
+
+    @classmethod
+    @transaction.atomic
+    def insert_batch(cls, karmas, count_writes=True):
+        """Save new Karmas and apply them to everything derived from the ledger.
+
+        The Karmas are inserted with one statement, and their recipients' totals (which are loaded back into the
+        recipient objects), the comment reservoirs and the daily rollups are updated, all in a single transaction. The
+        caller must update the leaderboards (see KarmicEntity.update_leaderboards) once that transaction has committed.
+
+        Args:
+            karmas ([Karma]): Unsaved Karmas, with their recipients and senders set, in the order they were given. Their
+                'when' is when they were created, unless it was set (e.g. when importing).
+            count_writes (bool): Whether the Karmas are being given now, and so count towards sharding their recipients
+                (see KarmicEntity.apply_karma). False when importing history.
+        """
+        if not karmas:
+            return
 
-        # Save a new karma with the data
-        karma = Karma.objects.create(recipient=recipient_entity,
-                                     sender=sender_entity,
-                                     value=value,
-                                     comment=comment)
+        cls.objects.bulk_create(karmas)
 
-        # Update karma totals on recipient
-        recipient_entity.give_karma(value)
+        # Update karma totals on recipients
+        changes = {}
+        for karma in karmas:
+            changes.setdefault(karma.recipient.pk, []).append(karma.value)
+        sharded = {karma.recipient.pk for karma in karmas if karma.recipient.sharded}
+        totals = KarmicEntity.apply_karma(changes, sharded, count_writes)
+        for karma in karmas:
+            karma.recipient.karma, karma.recipient.max_karma, karma.recipient.min_karma = totals[karma.recipient.pk]
 
-        return karma
+        # Sample the comments, while the recipients are still locked by the update of their totals
+        KarmicEntity.record_comments(karmas)
+
+        # Update daily rollups, unless the rollup_karma command is doing that
+        if settings.ROLLUP_LIVE:
+            KarmaRollup.record((karma.recipient.group_id, karma.recipient.pk, karma.value, karma.when)
+                               for karma in karmas)
 
     def __str__(self):
         return "{sender}->{recipient} ({value})".format(sender=str(self.sender),
                                                         recipient=str(self.recipient),
                                                         value=dict(Karma.KARMA_VALUES)[self.value])
+
+
+class KarmaRollup(models.Model):
+    """The karma an entity received on one day, maintained incrementally from the Karma ledger.
+
+    Rollups are updated as karma is applied if settings.ROLLUP_LIVE is set. Otherwise the rollup_karma management
+    command catches them up from the ledger, starting after the high-water mark in KarmaRollupMark. Days are in UTC.
+    Karma given before rollups existed was rolled up by migration 0017.
+
+    Attributes:
+        group (Group): The group of the entity
+        entity (KarmicEntity): The entity which received the karma
+        day (date): The day the karma was received
+        good (int): The number of good karmas received that day
+        bad (int): The number of bad karmas received that day
+    """
+    group = models.ForeignKey(Group, related_name='+')
+    entity = models.ForeignKey(KarmicEntity, related_name='rollups')
+    day = models.DateField()
+    good = models.IntegerField(default=0)
+    bad = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [
+            ['entity', 'day'],
+        ]
+        index_together = [
+            ['group', 'day'],
+        ]
+
+    @classmethod
+    def record(cls, karmas):
+        """Add karmas to the rollups
+
+        On PostgreSQL the rollups are upserted with one statement, which needs PostgreSQL 9.5 or later.
+
+        Args:
+            karmas: An iterable of (group ID, recipient ID, value, when) tuples for the karmas
+        """
+        counts = {}
+        for group_id, entity_id, value, when in karmas:
+            day = timezone.localtime(when, timezone.utc).date()
+            count = counts.setdefault((group_id, entity_id, day), [0, 0])
+            count[0 if value == Karma.GOOD else 1] += 1
+        if not counts:
+            return
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'INSERT INTO {table} (group_id, entity_id, day, good, bad) VALUES {values} '
+                    'ON CONFLICT (entity_id, day) DO UPDATE '
+                    'SET good = {table}.good + EXCLUDED.good, bad = {table}.bad + EXCLUDED.bad'.format(
+                        table=cls._meta.db_table,
+                        values=', '.join(['(%s, %s, %s, %s, %s)'] * len(counts))
+                    ),
+                    [x for key, count in counts.items() for x in key + tuple(count)]
+                )
+            return
+
+        # Fallback for other databases (e.g. sqlite in development)
+        with transaction.atomic():
+            for (group_id, entity_id, day), (good, bad) in counts.items():
+                updated = cls.objects.filter(entity_id=entity_id, day=day).update(good=F('good') + good,
+                                                                                  bad=F('bad') + bad)
+                if not updated:
+                    cls.objects.create(group_id=group_id, entity_id=entity_id, day=day, good=good, bad=bad)
+
+    @classmethod
+    def totals(cls, entity, since):
+        """Get the karma an entity has received since a day, from its rollups
+
+        Args:
+            entity (KarmicEntity): The entity
+            since (date): The first day to include
+        Returns:
+            (int, int): The number of good and bad karmas received
+        """
+        totals = cls.objects.filter(entity=entity, day__gte=since).aggregate(good=models.Sum('good'),
+                                                                             bad=models.Sum('bad'))
+        return totals['good'] or 0, totals['bad'] or 0
+
+    def __str__(self):
+        return "{entity} on {day} (+{good}/-{bad})".format(entity=str(self.entity), day=self.day, good=self.good,
+                                                          bad=self.bad)
+
+
+class KarmaRollupMark(models.Model):
+    """How far the rollup_karma command has got through the Karma ledger. There is only ever one of these.
+
+    Attributes:
+        last_karma_id (int): The ID of the last Karma included in the rollups
+    """
+    last_karma_id = models.IntegerField(default=0)
+
+    @classmethod
+    def get(cls):
+        """Get the mark, locked for update until the end of the current transaction
+
+        Returns:
+            KarmaRollupMark: The mark
+        """
+        cls.objects.get_or_create(pk=1)
+        return cls.objects.select_for_update().get(pk=1)
+
+    def __str__(self):
+        return "Rollups up to Karma {last_karma_id}".format(last_karma_id=self.last_karma_id)
+
+
+class RoomActivity(models.Model):
+    """How many karma announcements a room has had recently, for deciding whether to coalesce them.
+
+    Announcements are counted in fixed windows of settings.COALESCE_WINDOW seconds, numbered from the epoch. The count
+    is kept in the database so that every process sees the same one.
+
+    Attributes:
+        instance (Instance): The instance whose room it is
+        window_number (int): The window being counted
+        count (int): The number of announcements in that window so far
+    """
+    instance = models.OneToOneField(Instance, primary_key=True, related_name='+')
+    window_number = models.BigIntegerField()
+    count = models.IntegerField()
+
+    @classmethod
+    def count_announcement(cls, instance):
+        """Count a karma announcement for a room
+
+        Should be called outside of any long transaction, since it locks the room's row until commit. Uses ON CONFLICT
+        on PostgreSQL, so needs 9.5 or later there.
+
+        Args:
+            instance (Instance): The instance whose room the announcement is for
+        Returns:
+            int: The number of announcements in the current window, including this one
+        """
+        window_number = int(time.time() // settings.COALESCE_WINDOW)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'INSERT INTO {table} (instance_id, window_number, count) VALUES (%s, %s, 1) '
+                    'ON CONFLICT (instance_id) DO UPDATE '
+                    'SET count = CASE WHEN {table}.window_number = EXCLUDED.window_number '
+                    'THEN {table}.count + 1 ELSE 1 END, window_number = EXCLUDED.window_number '
+                    'RETURNING count'.format(table=cls._meta.db_table),
+                    [instance.pk, window_number]
+                )
+                return cursor.fetchone()[0]
+
+        # Fallback for other databases (e.g. sqlite in development)
+        with transaction.atomic():
+            activity, created = cls.objects.select_for_update().get_or_create(
+                instance_id=instance.pk, defaults={'window_number': window_number, 'count': 1})
+            if not created:
+                if activity.window_number == window_number:
+                    activity.count += 1
+                else:
+                    activity.window_number, activity.count = window_number, 1
+                activity.save()
+            return activity.count
+
+    def __str__(self):
+        return "{count} announcements in window {window} for {instance}".format(
+            count=self.count, window=self.window_number, instance=self.instance_id)
+
+
+class Notification(models.Model):
+    """A room notification in the outbox, waiting to be delivered.
+
+    Notifications are saved before they are sent (in the same transaction as whatever they announce) and deleted once
+    HipChat has accepted them, so they survive HipChat outages and process restarts. Failed deliveries are retried
+    with exponential backoff by the drain_notifications management command.
+
+    Karma announcements for a busy room are held back for settings.COALESCE_WINDOW seconds, and when the first of them
+    is delivered all of the room's due announcements are merged into one summary with the latest totals.
+
+    Attributes:
+        KARMA_TOTAL_MESSAGE (str): Format of the announcement of an entity's new karma total
+        instance (Instance): The instance whose room the notification is for
+        recipient (KarmicEntity): For held karma announcements, the entity whose total is being announced. If the
+            entity is deleted it is set to None, and the announcement is delivered as it was written.
+        message (str): The text of the message
+        created (datetime): When the notification was created
+        attempts (int): How many delivery attempts have failed so far
+        next_attempt (datetime): The notification will not be delivered before this time. While a delivery is in
+            progress it is pushed into the future, so that nobody else tries to deliver it at the same time.
+        last_error (str): The error from the most recent failed attempt, if any
+    """
+    KARMA_TOTAL_MESSAGE = '{recipient} has {total} total karma.'
+
+    instance = models.ForeignKey(Instance, related_name='notifications')
+    recipient = models.ForeignKey(KarmicEntity, related_name='+', blank=True, null=True, on_delete=models.SET_NULL)
+    message = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+    last_error = models.TextField(blank=True, null=True)
+
+    @classmethod
+    def create(cls, instance, message):
+        """Add a notification to the outbox, already claimed for delivery by the caller
+
+        Args:
+            instance (Instance): The instance whose room the notification is for
+            message (str): The text of the message
+        Returns:
+            Notification: The saved notification
+        Exceptions:
+            Instance.DoesNotExist: If the instance has been uninstalled
+        """
+        instance.check_installed()
+        return cls.objects.create(instance=instance, message=message,
+                                  next_attempt=timezone.now() + timedelta(seconds=settings.OUTBOX_LEASE))
+
+    @staticmethod
+    def room_is_busy(instance):
+        """Count a karma announcement for a room, and check whether the room is busy
+
+        Should be called before the transaction which announces the karma, so that the room's count is not locked
+        until it commits.
+
+        Args:
+            instance (Instance): The instance whose room to check
+        Returns:
+            bool: True if coalescing is enabled and there have been more than settings.COALESCE_THRESHOLD
+                announcements in this window
+        """
+        if not settings.COALESCE_WINDOW:
+            return False
+        return RoomActivity.count_announcement(instance) > settings.COALESCE_THRESHOLD
+
+    @classmethod
+    def announce_karma(cls, instance, recipients, busy=False):
+        """Add an announcement of the new karma totals of one or more entities to the outbox
+
+        If the room is quiet a single announcement of all the totals is claimed for delivery by the caller, like
+        create. If the room is busy the announcements are held back to be merged with others, and the
+        drain_notifications command will deliver them once the coalescing window has passed.
+
+        Args:
+            instance (Instance): The instance whose room the announcement is for
+            recipients ([KarmicEntity]): The entities whose totals to announce, without duplicates
+            busy (bool): Whether the room is busy, from room_is_busy
+        Returns:
+            Notification: The notification if the caller should deliver it now, or None if it has been held back
+        Exceptions:
+            Instance.DoesNotExist: If the instance has been uninstalled
+        """
+        instance.check_installed()
+        messages = [cls.KARMA_TOTAL_MESSAGE.format(recipient=recipient.get_name(), total=recipient.karma)
+                    for recipient in recipients]
+        if not busy:
+            return cls.create(instance, '\n'.join(messages))
+
+        next_attempt = timezone.now() + timedelta(seconds=settings.COALESCE_WINDOW)
+        cls.objects.bulk_create([cls(instance=instance, recipient=recipient, message=message, next_attempt=next_attempt)
+                                 for recipient, message in zip(recipients, messages)])
+        return None
+
+    def coalesce(self):
+        """Merge this held karma announcement with all the others for the room which are due, into one notification
+        with the latest totals
+
+        Announcements which are still being held back are left alone, to be merged when they are due.
+
+        Returns:
+            Notification: The merged notification, claimed for delivery by the caller, or None if someone else has
+                already merged them
+        """
+        with transaction.atomic():
+            held = list(Notification.objects.select_for_update()
+                                            .filter(models.Q(next_attempt__lte=timezone.now()) | models.Q(pk=self.pk),
+                                                    instance=self.instance_id, recipient__isnull=False)
+                                            .order_by('pk')
+                                            .values_list('pk', 'recipient_id'))
+            if self.pk not in [pk for pk, _ in held]:
+                return None
+
+            # One line per recipient, in the order they first received karma, with their current totals
+            recipient_ids = []
+            for _, recipient_id in held:
+                if recipient_id not in recipient_ids:
+                    recipient_ids.append(recipient_id)
+            recipients = KarmicEntity.objects.in_bulk(recipient_ids)
+            KarmicEntity.load_totals(list(recipients.values()))
+            message = '\n'.join(
+                self.KARMA_TOTAL_MESSAGE.format(recipient=recipients[pk].get_name(), total=recipients[pk].karma)
+                for pk in recipient_ids if pk in recipients
+            )
+
+            Notification.objects.filter(pk__in=[pk for pk, _ in held]).delete()
+            if not message:
+                return None
+            return Notification.create(self.instance, message)
+
+    @classmethod
+    def due(cls, limit):
+        """Get notifications which are due to be delivered, oldest first
+
+        Args:
+            limit (int): The maximum number of notifications to get
+        Returns:
+            [Notification]: Up to limit notifications. They must be claimed before they are delivered.
+        """
+        return list(cls.objects.filter(next_attempt__lte=timezone.now())
+                               .select_related('instance')
+                               .order_by('next_attempt')[:limit])
+
+    def claim(self):
+        """Reserve this notification for delivery by the caller
+
+        Returns:
+            bool: True if we got the notification, False if someone else claimed it first
+        """
+        next_attempt = timezone.now() + timedelta(seconds=settings.OUTBOX_LEASE)
+        claimed = Notification.objects.filter(pk=self.pk, next_attempt=self.next_attempt) \
+                                      .update(next_attempt=next_attempt)
+        if claimed:
+            self.next_attempt = next_attempt
+        return bool(claimed)
+
+    def deliver(self):
+        """Try to deliver this notification, which the caller must have claimed
+
+        On success the notification is removed from the outbox. On failure it is rescheduled with backoff, unless the
+        error is one that retrying will not fix or it has run out of attempts, in which case it is dropped.
+
+        Returns:
+            bool: True if the notification was delivered
+        """
+        if self.recipient_id is not None:
+            # A held karma announcement. Deliver it merged with all the others for the room.
+            merged = self.coalesce()
+            return merged.deliver() if merged is not None else True
+
+        try:
+            self.instance.send_room_notification(self.message)
+        except HipChat.CircuitOpen as e:
+            # HipChat is known to be down, so this was not a real attempt. Try again once the breaker may have closed.
+            self._reschedule(HipChat.breaker.reset_timeout, e)
+            return False
+        except HipChat.RateLimit as e:
+            # Being throttled is not a failure of the notification, so it does not use up an attempt. Try again once
+            # the limit has reset, with jitter so that everything held back does not retry at the same moment.
+            delay = e.retry_after or settings.RATE_LIMIT_DEFAULT_WAIT
+            self._reschedule(random.uniform(delay, delay * 1.5), e)
+            return False
+        except (HipChat.BadRequest, HipChat.NotFound) as e:
+            logger.error('Dropping undeliverable notification {pk}: {error}'.format(pk=self.pk, error=e))
+            self.delete()
+            return False
+        except (HipChat.HipChatApiError, requests.RequestException) as e:
+            self.fail(e)
+            return False
+
+        self.delete()
+        return True
+
+    def fail(self, error):
+        """Count a failed delivery attempt, and reschedule it with backoff or drop it once it has run out of attempts
+
+        Args:
+            error (Exception): The error which caused the attempt to fail
+        """
+        self.attempts += 1
+        if self.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            logger.error('Dropping notification {pk} after {attempts} attempts: {error}'
+                         .format(pk=self.pk, attempts=self.attempts, error=error))
+            Notification.objects.filter(pk=self.pk).delete()
+            return
+        delay = min(settings.OUTBOX_BACKOFF_BASE * 2 ** (self.attempts - 1), settings.OUTBOX_BACKOFF_MAX)
+        # Jitter so that a backlog does not all retry at the same moment
+        self._reschedule(random.uniform(delay / 2, delay), error)
+
+    def _reschedule(self, delay, error):
+        """Schedule another delivery attempt
+
+        Does nothing if the notification has left the outbox in the meantime.
+
+        Args:
+            delay (float): Seconds from now until the next attempt
+            error (Exception): The error which caused this attempt to fail
+        """
+        self.next_attempt = timezone.now() + timedelta(seconds=delay)
+        self.last_error = str(error)
+        Notification.objects.filter(pk=self.pk).update(attempts=self.attempts, next_attempt=self.next_attempt,
+                                                        last_error=self.last_error)
+
+    def __str__(self):
+        return "Notification to room {room} ({attempts} failed attempts)".format(room=self.instance.room_id,
+                                                                                 attempts=self.attempts)
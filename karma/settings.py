@@ -5,7 +5,8 @@ Settings for the Karma app.
 import os
 import re
 
-HIPCHAT_API_URL = 'https://api.hipchat.com/v2'
+# Base URL of the HipChat API. Point it at a fake server (see karma.fakehipchat) to work offline.
+HIPCHAT_API_URL = os.environ.get('HIPCHAT_API_URL', 'https://api.hipchat.com/v2').rstrip('/')
 
 ADDON_NAME = os.environ.get('ADDON_NAME', 'Karma')
 ADDON_CHAT_NAME = os.environ.get('ADDON_CHAT_NAME', 'karma')
@@ -13,21 +14,163 @@ ADDON_KEY = os.environ.get('ADDON_KEY', 'com.johnfrench.hipchat.karma')
 
 NOTIFICATION_COLOR = 'green'
 
+# HTTP connection pooling for the HipChat API.
+# Connections are kept alive and shared by all HipChat clients in a process.
+HTTP_POOL_SIZE = int(os.environ.get('HIPCHAT_HTTP_POOL_SIZE', 10))
+# Seconds to wait for a connection to HipChat, and for a response once connected
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HIPCHAT_HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_READ_TIMEOUT = float(os.environ.get('HIPCHAT_HTTP_READ_TIMEOUT', 10))
+# Number of times to retry failed connections (requests that reached HipChat are never retried)
+HTTP_MAX_RETRIES = int(os.environ.get('HIPCHAT_HTTP_MAX_RETRIES', 2))
+
+# Instances are cached for webhook requests. Each process keeps up to INSTANCE_CACHE_SIZE instances for
+# INSTANCE_CACHE_TTL seconds, in front of Django's cache (shared between processes if CACHES is configured so) which
+# keeps them for INSTANCE_SHARED_CACHE_TTL seconds.
+INSTANCE_CACHE_SIZE = int(os.environ.get('INSTANCE_CACHE_SIZE', 256))
+INSTANCE_CACHE_TTL = float(os.environ.get('INSTANCE_CACHE_TTL', 60))
+INSTANCE_SHARED_CACHE_TTL = int(os.environ.get('INSTANCE_SHARED_CACHE_TTL', 600))
+
+# Each process caches the IDs of up to ENTITY_CACHE_SIZE recently used entities for ENTITY_CACHE_TTL seconds, so that
+# applying karma usually needs no lookups. An entity deleted or merged in one process may still be used by others
+# until their entry expires.
+ENTITY_CACHE_SIZE = int(os.environ.get('ENTITY_CACHE_SIZE', 10000))
+ENTITY_CACHE_TTL = float(os.environ.get('ENTITY_CACHE_TTL', 300))
+
+# Number of comments kept for each entity and type of karma, to show a sample of in "@karma for"
+RESERVOIR_SIZE = int(os.environ.get('RESERVOIR_SIZE', 10))
+
+# Leaderboards ("@karma top"). Up to LEADERBOARD_CACHE_SIZE entries per group and direction are kept in the database,
+# and rebuilt every LEADERBOARD_CACHE_TTL seconds. LEADERBOARD_DEFAULT entities are shown unless the user asks for
+# more, up to LEADERBOARD_MAX (which must not exceed LEADERBOARD_CACHE_SIZE).
+LEADERBOARD_CACHE_SIZE = int(os.environ.get('LEADERBOARD_CACHE_SIZE', 50))
+LEADERBOARD_CACHE_TTL = int(os.environ.get('LEADERBOARD_CACHE_TTL', 3600))
+LEADERBOARD_DEFAULT = int(os.environ.get('LEADERBOARD_DEFAULT', 5))
+LEADERBOARD_MAX = int(os.environ.get('LEADERBOARD_MAX', 20))
+
+# Daily karma rollups. If ROLLUP_LIVE is set they are updated as karma is applied; otherwise the rollup_karma command
+# must be run periodically to catch them up, and it only considers karma older than ROLLUP_CATCHUP_DELAY seconds so
+# that transactions still in progress are not skipped.
+ROLLUP_LIVE = os.environ.get('ROLLUP_LIVE', 'true').lower() in ('1', 'true', 'yes')
+ROLLUP_CATCHUP_DELAY = float(os.environ.get('ROLLUP_CATCHUP_DELAY', 60))
+
+# Sharded counters for hot entities. An entity which receives more than SHARD_PROMOTE_THRESHOLD karmas within
+# SHARD_PROMOTE_WINDOW seconds has its karma spread over SHARD_COUNT shard rows, so that concurrent karma for it does
+# not all wait for one row lock. Karmas are counted in the database, so every process sees the same counts. The
+# fold_shards command must be run periodically to fold the shards back into the entities (and stop sharding entities
+# which have cooled down). A SHARD_COUNT of 0 disables sharding.
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 0))
+SHARD_PROMOTE_THRESHOLD = int(os.environ.get('SHARD_PROMOTE_THRESHOLD', 60))
+SHARD_PROMOTE_WINDOW = float(os.environ.get('SHARD_PROMOTE_WINDOW', 60))
+
+# OAuth tokens are refreshed this many seconds before they expire, so requests are never made with an expired token
+TOKEN_REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN', 300))
+# A process refreshing a token holds a lease on it for at most this many seconds, while others wait for the new token.
+# It should be longer than a call to HipChat's token endpoint can take.
+TOKEN_REFRESH_LEASE = float(os.environ.get('TOKEN_REFRESH_LEASE', 30))
+
+# Client-side rate limits for HipChat notifications: at most ROOM_RATE_LIMIT per ROOM_RATE_PERIOD seconds to a room,
+# and TOKEN_RATE_LIMIT per TOKEN_RATE_PERIOD seconds with one token. HipChat's rate limit headers are honoured as well.
+ROOM_RATE_LIMIT = int(os.environ.get('HIPCHAT_ROOM_RATE_LIMIT', 30))
+ROOM_RATE_PERIOD = float(os.environ.get('HIPCHAT_ROOM_RATE_PERIOD', 60))
+TOKEN_RATE_LIMIT = int(os.environ.get('HIPCHAT_TOKEN_RATE_LIMIT', 100))
+TOKEN_RATE_PERIOD = float(os.environ.get('HIPCHAT_TOKEN_RATE_PERIOD', 300))
+# The limits are enforced in each process separately, so each process gets its share of them: the limits are divided by
+# the number of processes sending notifications. By default that is one dyno of gunicorn workers (WEB_CONCURRENCY) and
+# the drain_notifications worker; set it to the total across all dynos when running more.
+RATE_LIMIT_PROCESSES = int(os.environ.get('HIPCHAT_RATE_LIMIT_PROCESSES',
+                                          int(os.environ.get('WEB_CONCURRENCY', 1)) + 1))
+# Maximum number of rooms and tokens to keep rate limiters for
+RATE_LIMIT_BUCKETS = int(os.environ.get('HIPCHAT_RATE_LIMIT_BUCKETS', 1024))
+# Seconds to hold notifications back when HipChat throttles us (403) without saying when the limit resets
+RATE_LIMIT_DEFAULT_WAIT = float(os.environ.get('HIPCHAT_RATE_LIMIT_DEFAULT_WAIT', 5))
+
+# Circuit breaker for the HipChat API. After this many consecutive failures (5xx responses or connection errors) calls
+# to HipChat fail fast for CIRCUIT_BREAKER_RESET_TIMEOUT seconds.
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('HIPCHAT_CIRCUIT_BREAKER_FAILURE_THRESHOLD', 5))
+CIRCUIT_BREAKER_RESET_TIMEOUT = float(os.environ.get('HIPCHAT_CIRCUIT_BREAKER_RESET_TIMEOUT', 30))
+
+# How room notifications are sent: 'async' queues them for background worker threads so that webhooks return
+# immediately, 'sync' sends them before the webhook returns (used by tests).
+NOTIFICATION_DISPATCH_MODE = os.environ.get('NOTIFICATION_DISPATCH_MODE', 'async')
+NOTIFICATION_DISPATCH_WORKERS = int(os.environ.get('NOTIFICATION_DISPATCH_WORKERS', 4))
+NOTIFICATION_DISPATCH_QUEUE_SIZE = int(os.environ.get('NOTIFICATION_DISPATCH_QUEUE_SIZE', 1000))
+# Seconds to wait for each worker thread to deliver queued notifications when the process exits
+NOTIFICATION_DISPATCH_SHUTDOWN_TIMEOUT = float(os.environ.get('NOTIFICATION_DISPATCH_SHUTDOWN_TIMEOUT', 10))
+
+# Notification outbox. Notifications are saved to the database before being sent, and failed deliveries are retried by
+# the drain_notifications command with exponential backoff (in seconds) until OUTBOX_MAX_ATTEMPTS is reached.
+OUTBOX_BACKOFF_BASE = float(os.environ.get('OUTBOX_BACKOFF_BASE', 2))
+OUTBOX_BACKOFF_MAX = float(os.environ.get('OUTBOX_BACKOFF_MAX', 300))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 10))
+# Seconds a notification is reserved for whoever is delivering it before someone else may try
+OUTBOX_LEASE = float(os.environ.get('OUTBOX_LEASE', 60))
+
+# Karma announcements in a busy room are merged into one summary. A room is busy once it has had more than
+# COALESCE_THRESHOLD announcements within COALESCE_WINDOW seconds; its further announcements are then held for up to
+# COALESCE_WINDOW seconds (delivered by the drain_notifications command). A window of 0 disables coalescing.
+COALESCE_WINDOW = float(os.environ.get('COALESCE_WINDOW', 0))
+COALESCE_THRESHOLD = int(os.environ.get('COALESCE_THRESHOLD', 3))
+
+# Per-request metrics (wall time, database queries and HipChat calls by view), served in the Prometheus text format at
+# the metrics URL. Each process keeps its own, labelled with DYNO (set by Heroku, e.g. web.1) and its process ID. The
+# metrics URL requires METRICS_TOKEN as a bearer token, and refuses every request while it is not set.
+# Requests slower than SLOW_REQUEST_THRESHOLD seconds are logged with a breakdown of their time (0 disables this).
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+DYNO = os.environ.get('DYNO', '')
+SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD', 1))
+
+# Sampled profiling of webhook requests. If PROFILE_DIR is set, a fraction PROFILE_SAMPLE_RATE of webhook requests,
+# and any with an X-Karma-Profile header equal to PROFILE_TOKEN, are profiled with cProfile. The .pstats dumps are
+# written to a subdirectory of PROFILE_DIR for each webhook, keeping the newest PROFILE_MAX_FILES in each, and can be
+# summarized with the merge_profiles command.
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.01))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 200))
+
+# Recording of webhook traffic, for replaying with the replay_webhooks command. If WEBHOOK_RECORD_DIR is set, the
+# payloads of webhook requests (with secrets redacted) are written to NDJSON files there, one per process, each rotated
+# at WEBHOOK_RECORD_MAX_BYTES with WEBHOOK_RECORD_BACKUPS old files kept.
+WEBHOOK_RECORD_DIR = os.environ.get('WEBHOOK_RECORD_DIR', '')
+WEBHOOK_RECORD_MAX_BYTES = int(os.environ.get('WEBHOOK_RECORD_MAX_BYTES', 50 * 1024 * 1024))
+WEBHOOK_RECORD_BACKUPS = int(os.environ.get('WEBHOOK_RECORD_BACKUPS', 10))
+
 # Scopes to request when getting OAuth token.
 # This should match the scopes listed in capabilities.json.
 SCOPES = 'send_notification admin_room view_group view_messages'
 
+# A single karma operation, like "@phone++" or "(two words)--"
+# Capture group 0 should contain an '@' character iff the karma target is in the form of a mention
+# Capture group 1 or 2 should contain the name of the recipient (the other should be empty).
+# Capture group 3 should contain either '++' or '--'.
+_KARMA_OPERATION = r'(?:(@)?(\S{1,50}) ?|\(([^)\r\n]{1,48})\))(\+\+|--)'
+
+# An optional comment following the karma operations. Capture group 0 should contain the comment.
+_KARMA_COMMENT = r'(?:#|\/\/)\s*(\S.*)'
+
 REGEXES = {
     # Regex for chat command to give someone/something karma
-    # Capture group 0 should contain an '@' character iff the karma target is in the form of a mention
-    # Capture group 1 or 2 should contain the name of the recipient (the other should be empty).
-    # Capture group 3 should contain either '++' or '--'.
-    # Capture group 4 should contain an optional comment.
-    'give_karma': r'^(?:(@)?(\S{1,50}) ?|\(([^)\r\n]{1,48})\))(\+\+|--)(?: *(?:#|\/\/)\s*(\S.*))?$',
+    # The message is one or more karma operations separated by whitespace, followed by an optional comment for all of
+    # them. The individual operations are parsed with 'karma_operation' and the comment with 'karma_comment'.
+    'give_karma': r'^(?:{operation}\s+)*{operation}(?: *{comment})?$'.format(operation=_KARMA_OPERATION,
+                                                                          comment=_KARMA_COMMENT),
+
+    # Regexes for parsing the parts of a give_karma message, matching from a position within the message
+    'karma_operation': _KARMA_OPERATION,
+    'karma_comment': r' *' + _KARMA_COMMENT + '$',
 
     # Regex for chat command to show someone/something's karma
-    # Capture group 0 or 1 should contain the name to show karma for (the other should be empty)
-    'show_karma': r'^@{name} for (?:(@)?(\S{{1,50}}) ?|\(([^)\r\n]{{1,48}})\))$'.format(name=ADDON_CHAT_NAME),
+    # Capture group 0 should contain an '@' character iff the target is in the form of a mention
+    # Capture group 1 or 2 should contain the name to show karma for (the other should be empty)
+    # Capture group 3 should contain an optional period ('today', 'this week' or 'this month') to show karma for
+    'show_karma': r'^@{name} for (?:(@)?(\S{{1,50}})|\(([^)\r\n]{{1,48}})\))(?: (today|this week|this month))? ?$'
+                  .format(name=ADDON_CHAT_NAME),
+
+    # Regex for chat command to show the entities with the most or least karma
+    # Capture group 0 should contain either 'top' or 'bottom'.
+    # Capture group 1 should contain the optional number of entities to show.
+    'leaderboard': r'^@{name} (top|bottom)(?: (\d{{1,3}}))?$'.format(name=ADDON_CHAT_NAME),
 
     # Regex for chat command to show help
     'help': r'^@{name} help$'.format(name=ADDON_CHAT_NAME),
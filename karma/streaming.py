@@ -0,0 +1,43 @@
+"""
+Streaming reads of large querysets.
+"""
+
+import itertools
+
+from django.db import connection
+
+
+_cursor_names = itertools.count()
+
+
+def stream_queryset(queryset, batch_size=2000):
+    """Iterate over the rows of a values_list queryset without loading them all into memory
+
+    On PostgreSQL this uses a server-side (named) cursor, so at most batch_size rows are held in memory at a time.
+    Named cursors only live as long as their transaction, so iterate inside transaction.atomic().
+
+    Args:
+        queryset (QuerySet): A values_list queryset
+        batch_size (int): The number of rows to fetch from the database at a time
+    Returns:
+        iterator: The rows, as tuples
+    """
+    sql, params = queryset.query.sql_with_params()
+
+    connection.ensure_connection()
+    if connection.vendor == 'postgresql':
+        cursor = connection.connection.cursor(name='karma_stream_{n}'.format(n=next(_cursor_names)))
+        cursor.itersize = batch_size
+    else:
+        cursor = connection.cursor()
+
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
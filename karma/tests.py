@@ -1 +1,333 @@
-# Todo Write some tests
+import json
+import os
+import random
+import shutil
+import tempfile
+from datetime import timedelta
+from io import StringIO
+
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.utils import timezone
+from unittest import mock
+
+from . import metrics, settings
+from .benchmark import PayloadGenerator
+from .cache import LRUCache
+from .fakehipchat import FakeHipChat
+from .hipchat import HipChat
+from .middleware import REDACTED, redact
+from .models import Instance, Group, KarmicEntity, KarmicEntityShard, Karma, Leaderboard, Notification
+from .views import parse_karma_operations
+
+
+class ShowHookTests(TestCase):
+    """Tests for the show karma webhook"""
+
+    # Instance and group (or on a cache hit, checking the instance is still installed), entity, the names of the senders
+    # of the sampled comments, the mention lookup, and saving and deleting the outbox notification
+    QUERY_BUDGET = 6
+
+    def setUp(self):
+        self.group = Group.objects.create(group_id=1)
+        self.instance = Instance.objects.create(oauth_client_id='client', oauth_secret='secret', oauth_token='token',
+                                                room_id=1, group=self.group)
+        Instance.invalidate_cache('client')
+        self.recipient = KarmicEntity.objects.create(group=self.group, name='phone', type=KarmicEntity.STRING)
+        self.requester = KarmicEntity.objects.create(group=self.group, name='1', type=KarmicEntity.USER,
+                                                     mention_name='requester')
+
+    def give_karma(self, count):
+        start = Karma.objects.count()
+        karmas = []
+        for i in range(start, start + count):
+            sender = KarmicEntity.objects.create(group=self.group, name=str(100 + i), type=KarmicEntity.USER,
+                                                 mention_name='user{i}'.format(i=i))
+            karmas.append(Karma(recipient=self.recipient, sender=sender,
+                                value=Karma.GOOD if i % 2 else Karma.BAD, comment='comment {i}'.format(i=i)))
+        Karma.insert_batch(karmas)
+
+    def show(self):
+        payload = {
+            'event': 'room_message',
+            'oauth_client_id': 'client',
+            'item': {
+                'message': {
+                    'message': '@karma for phone',
+                    'mentions': [],
+                    'from': {'id': 1, 'mention_name': 'requester'},
+                },
+            },
+        }
+        with mock.patch.object(settings, 'NOTIFICATION_DISPATCH_MODE', 'sync'), \
+                mock.patch.object(Instance, 'send_room_notification') as send:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(reverse('karma.views.show_hook'), json.dumps(payload),
+                                            content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return send, queries
+
+    def test_query_budget(self):
+        self.give_karma(30)
+        send, queries = self.show()
+        self.assertLessEqual(len(queries), self.QUERY_BUDGET)
+        self.assertEqual(send.call_count, 1)
+        # The comments come from the reservoirs, along with their senders' names
+        self.assertIn(': comment ', send.call_args[0][0])
+
+    def test_webhook_is_recorded(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with mock.patch.object(settings, 'WEBHOOK_RECORD_DIR', directory):
+            self.show()
+        with open(os.path.join(directory, 'webhooks-{pid}.ndjson'.format(pid=os.getpid()))) as f:
+            record = json.loads(f.readline())
+        self.assertEqual(record['status'], 200)
+        self.assertEqual(record['body']['item']['message']['message'], '@karma for phone')
+        self.assertEqual(redact({'oauth_client_id': 'client', 'item': [{'access_token': 'token'}]}),
+                         {'oauth_client_id': 'client', 'item': [{'access_token': REDACTED}]})
+
+    def test_request_metrics(self):
+        before = metrics.REQUEST_DB_QUERIES.count('hooks.show')
+        self.show()
+        self.assertEqual(metrics.REQUEST_DB_QUERIES.count('hooks.show'), before + 1)
+
+        # Without a token the metrics are never served
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        with mock.patch.object(settings, 'METRICS_TOKEN', 'token'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('karma_request_db_queries_count{{view="hooks.show",dyno="{dyno}",pid="{pid}"}} '.format(
+            dyno=settings.DYNO, pid=os.getpid()), response.content.decode())
+
+    def test_request_is_profiled(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with mock.patch.object(settings, 'PROFILE_DIR', directory), \
+                mock.patch.object(settings, 'PROFILE_SAMPLE_RATE', 0), \
+                mock.patch.object(settings, 'PROFILE_TOKEN', 'token'):
+            self.show()
+            self.assertFalse(os.path.exists(os.path.join(directory, 'hooks.show')))
+            self.client.defaults['HTTP_X_KARMA_PROFILE'] = 'token'
+            self.show()
+        self.assertEqual(len(os.listdir(os.path.join(directory, 'hooks.show'))), 1)
+
+        output = StringIO()
+        call_command('merge_profiles', dir=directory, stdout=output)
+        self.assertIn('hooks.show: 1 profiles', output.getvalue())
+        self.assertIn('show_hook', output.getvalue())
+
+    def test_query_count_independent_of_history(self):
+        self.give_karma(4)
+        _, few = self.show()
+        self.give_karma(40)
+        _, many = self.show()
+        self.assertLessEqual(len(many), len(few))
+
+
+class ShardTests(TestCase):
+    """Tests for sharded counters of hot entities"""
+
+    def setUp(self):
+        self.group = Group.objects.create(group_id=1)
+        self.recipient = KarmicEntity.objects.create(group=self.group, name='coffee', type=KarmicEntity.STRING)
+        self.sender = KarmicEntity.objects.create(group=self.group, name='1', type=KarmicEntity.USER,
+                                                  mention_name='sender')
+
+    def give_karma(self, values, count_writes=True):
+        Karma.insert_batch([Karma(recipient=self.recipient, sender=self.sender, value=value, comment='comment')
+                            for value in values], count_writes)
+
+    def test_hot_entity_is_promoted(self):
+        with mock.patch.object(settings, 'SHARD_COUNT', 4), mock.patch.object(settings, 'SHARD_PROMOTE_THRESHOLD', 3):
+            # Imported history does not count
+            self.give_karma([Karma.GOOD] * 4, count_writes=False)
+            self.assertFalse(KarmicEntity.objects.get(pk=self.recipient.pk).sharded)
+            self.give_karma([Karma.GOOD] * 4)
+        self.assertTrue(KarmicEntity.objects.get(pk=self.recipient.pk).sharded)
+
+    def test_sharded_totals_and_fold(self):
+        self.recipient.sharded = True
+        self.recipient.save()
+        with mock.patch.object(settings, 'SHARD_COUNT', 4):
+            self.give_karma([Karma.GOOD, Karma.GOOD, Karma.GOOD, Karma.BAD])
+            # The entity's own row is untouched, and its totals are read together with its shards
+            self.assertEqual(KarmicEntity.objects.get(pk=self.recipient.pk).karma, 0)
+            entity = KarmicEntity.objects.get(pk=self.recipient.pk)
+            KarmicEntity.load_totals([entity])
+            self.assertEqual((entity.karma, entity.max_karma, entity.min_karma), (2, 3, 0))
+
+            KarmicEntity.fold_shards([self.recipient.pk])
+        entity = KarmicEntity.objects.get(pk=self.recipient.pk)
+        self.assertEqual((entity.karma, entity.max_karma, entity.min_karma), (2, 3, 0))
+        self.assertEqual(entity.good_comments_seen, 3)
+        self.assertFalse(KarmicEntityShard.objects.exists())
+
+    def test_cooled_entity_is_demoted(self):
+        self.recipient.sharded = True
+        self.recipient.save()
+        with mock.patch.object(settings, 'SHARD_COUNT', 4), mock.patch.object(settings, 'SHARD_PROMOTE_THRESHOLD', 4):
+            with mock.patch('karma.models.current_write_window', return_value=100):
+                self.give_karma([Karma.GOOD] * 4)
+            # It was not being counted for all of window 99, was still hot in 100, and received nothing in 101
+            for window, sharded in ((100, True), (101, True), (102, False)):
+                with mock.patch('karma.models.current_write_window', return_value=window):
+                    KarmicEntity.fold_shards()
+                self.assertEqual(KarmicEntity.objects.get(pk=self.recipient.pk).sharded, sharded)
+
+
+class LeaderboardTests(TestCase):
+    """Tests for the incrementally updated leaderboards"""
+
+    SIZE = 5
+
+    def setUp(self):
+        self.group = Group.objects.create(group_id=1)
+        self.random = random.Random(1)
+        self.pks = [KarmicEntity.objects.create(group=self.group, name=str(i), type=KarmicEntity.STRING,
+                                                karma=self.random.randint(-3, 3)).pk
+                    for i in range(12)]
+        patch = mock.patch.object(settings, 'LEADERBOARD_CACHE_SIZE', self.SIZE)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def ranking(self, direction):
+        return [list(entry) for entry in KarmicEntity.objects.filter(group=self.group)
+                                                              .order_by(*KarmicEntity._LEADERBOARD_ORDER[direction])
+                                                              .values_list('karma', 'pk')]
+
+    def test_updates_match_a_rebuild(self):
+        for direction in (KarmicEntity.TOP, KarmicEntity.BOTTOM):
+            KarmicEntity.get_leaderboard(self.group, direction, self.SIZE)
+
+        for _ in range(20):
+            changed = self.random.sample(self.pks, 3)
+            for pk in changed:
+                KarmicEntity.objects.filter(pk=pk).update(karma=self.random.randint(-3, 3))
+            KarmicEntity.update_leaderboards(self.group.pk, changed)
+
+            for direction in (KarmicEntity.TOP, KarmicEntity.BOTTOM):
+                # Whatever is left of each leaderboard is exactly the top of the ranking, however short it has got
+                leaderboard = Leaderboard.objects.filter(group=self.group, direction=direction).first()
+                if leaderboard is not None:
+                    entries = json.loads(leaderboard.entries)
+                    self.assertEqual(entries, self.ranking(direction)[:len(entries)])
+                n = self.random.randint(1, self.SIZE)
+                self.assertEqual([[entity.karma, entity.pk]
+                                  for entity in KarmicEntity.get_leaderboard(self.group, direction, n)],
+                                 self.ranking(direction)[:n])
+
+        for direction in (KarmicEntity.TOP, KarmicEntity.BOTTOM):
+            self.assertEqual(KarmicEntity._rebuild_leaderboard(self.group.pk, direction),
+                             self.ranking(direction)[:self.SIZE])
+
+
+class BenchmarkTests(TestCase):
+    """Tests for the synthetic traffic of the benchmark"""
+
+    def test_generated_messages_match_hooks(self):
+        generator = PayloadGenerator([('client', 1)], users=10, entities=500, skew=1.1, comment_rate=0.5, seed=1)
+        for _ in range(200):
+            self.assertIsNotNone(parse_karma_operations(generator.payload('give')['item']['message']['message']))
+            for endpoint, regex in (('show', 'show_karma'), ('leaderboard', 'leaderboard'), ('help', 'help')):
+                message = generator.payload(endpoint)['item']['message']['message']
+                self.assertTrue(settings.COMPILED_REGEXES[regex].match(message), message)
+
+
+class FakeHipChatTests(TestCase):
+    """Tests for talking to HipChat, against the fake HipChat API"""
+
+    def setUp(self):
+        self.fake = FakeHipChat(clients={'client': 1}).start()
+        self.addCleanup(self.fake.stop)
+        # The fake's tokens are numbered from 1 again, so do not share rate limiters with other tests
+        for patch in (mock.patch.object(settings, 'HIPCHAT_API_URL', self.fake.url),
+                      mock.patch.object(HipChat, '_buckets', LRUCache(settings.RATE_LIMIT_BUCKETS))):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.group = Group.objects.create(group_id=1)
+        self.instance = Instance.objects.create(oauth_client_id='client', oauth_secret='secret', room_id=1,
+                                                group=self.group)
+
+    def token_calls(self):
+        return len([call for call in self.fake.calls if call.path == '/oauth/token'])
+
+    def test_rejected_token_is_refreshed(self):
+        self.instance.send_room_notification('hello')
+        self.fake.fail_next(401)
+        self.instance.send_room_notification('again')
+        self.assertEqual(self.fake.notifications(), [('1', 'hello'), ('1', 'again')])
+        self.assertEqual(self.token_calls(), 2)
+
+    def test_expired_refresh_lease_is_taken_over(self):
+        # Another process took the lease and died before refreshing the token
+        Instance.objects.filter(pk=self.instance.pk).update(
+            oauth_token='expired', oauth_token_expires=timezone.now() - timedelta(minutes=1),
+            oauth_token_refreshing=timezone.now() - timedelta(seconds=1))
+        instance = Instance.objects.get(pk=self.instance.pk)
+        with mock.patch('karma.models.time.sleep') as sleep:
+            token = instance.get_token()
+        self.assertFalse(sleep.called)
+        self.assertEqual(self.token_calls(), 1)
+        instance = Instance.objects.get(pk=self.instance.pk)
+        self.assertEqual(instance.oauth_token, token)
+        self.assertIsNone(instance.oauth_token_refreshing)
+
+    def test_live_refresh_lease_is_waited_for(self):
+        Instance.objects.filter(pk=self.instance.pk).update(
+            oauth_token='expired', oauth_token_expires=timezone.now() - timedelta(minutes=1),
+            oauth_token_refreshing=timezone.now() + timedelta(seconds=settings.TOKEN_REFRESH_LEASE))
+        instance = Instance.objects.get(pk=self.instance.pk)
+
+        def refreshed_elsewhere(seconds):
+            Instance.objects.filter(pk=self.instance.pk).update(
+                oauth_token='fresh', oauth_token_expires=timezone.now() + timedelta(hours=1),
+                oauth_token_refreshing=None)
+
+        with mock.patch('karma.models.time.sleep', side_effect=refreshed_elsewhere) as sleep:
+            self.assertEqual(instance.get_token(), 'fresh')
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(self.token_calls(), 0)
+
+    def test_room_rate_limit_paces_notifications(self):
+        with mock.patch.object(settings, 'ROOM_RATE_LIMIT', 2), mock.patch.object(settings, 'RATE_LIMIT_PROCESSES', 1):
+            self.instance.send_room_notification('one')
+            self.instance.send_room_notification('two')
+            with self.assertRaises(HipChat.RateLimit) as raised:
+                self.instance.send_room_notification('three')
+        self.assertGreater(raised.exception.retry_after, 0)
+        self.assertEqual(self.fake.notifications(), [('1', 'one'), ('1', 'two')])
+
+    def test_throttled_notification_is_rescheduled_without_using_an_attempt(self):
+        notification = Notification.create(self.instance, 'hello')
+        self.fake.fail_next(403)
+        self.assertFalse(notification.deliver())
+
+        # HipChat's rate limit headers say to wait up to a second, and jitter adds up to half as much again
+        notification = Notification.objects.get(pk=notification.pk)
+        self.assertEqual(notification.attempts, 0)
+        self.assertIsNotNone(notification.last_error)
+        self.assertLessEqual(notification.next_attempt,
+                             timezone.now() + timedelta(seconds=settings.RATE_LIMIT_DEFAULT_WAIT * 1.5))
+        self.assertEqual(self.fake.notifications(), [])
+
+    def test_only_due_announcements_are_coalesced(self):
+        coffee, tea, cake = [KarmicEntity.objects.create(group=self.group, name=name, type=KarmicEntity.STRING, karma=1)
+                             for name in ('coffee', 'tea', 'cake')]
+        with mock.patch.object(settings, 'COALESCE_WINDOW', 60):
+            Notification.announce_karma(self.instance, [coffee, tea], busy=True)
+            Notification.objects.update(next_attempt=timezone.now() - timedelta(seconds=1))
+            Notification.announce_karma(self.instance, [cake], busy=True)
+        # The totals announced are the latest ones, not those when the karma was given
+        KarmicEntity.objects.filter(pk=coffee.pk).update(karma=2)
+
+        due = Notification.due(10)
+        self.assertCountEqual([notification.recipient_id for notification in due], [coffee.pk, tea.pk])
+        self.assertTrue(due[0].claim())
+        self.assertTrue(due[0].deliver())
+        self.assertEqual(self.fake.notifications(), [('1', 'coffee has 2 total karma.\ntea has 1 total karma.')])
+        self.assertEqual(list(Notification.objects.values_list('recipient', flat=True)), [cake.pk])
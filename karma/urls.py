@@ -9,4 +9,6 @@ urlpatterns = patterns('karma',
                        url(r'^install/(?P<client_id>\S*$)', views.uninstall, name='uninstall'),
                        url(r'^hooks/give/?$', views.give_hook, name='hooks.give'),
                        url(r'^hooks/show/?$', views.show_hook, name='hooks.show'),
-                       url(r'^hooks/help/?$', views.help_hook, name='hooks.help'))
+                       url(r'^hooks/leaderboard/?$', views.leaderboard_hook, name='hooks.leaderboard'),
+                       url(r'^hooks/help/?$', views.help_hook, name='hooks.help'),
+                       url(r'^metrics/?$', views.metrics, name='metrics'))
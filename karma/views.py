@@ -1,18 +1,89 @@
+import datetime
 import logging
 import json
+import os
+import re
 
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.http.response import HttpResponseNotAllowed
 from django.shortcuts import render
+from django.utils.crypto import constant_time_compare
+from django.db import transaction
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
-from . import settings
-from .models import Instance, KarmicEntity, Karma
+from . import dispatch, settings
+from .metrics import REGISTRY
+from .models import Instance, KarmicEntity, Karma, KarmaRollup, Notification
 
 
 logger = logging.getLogger(__name__)
 
 
+# Helpers
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def parse_karma_operations(message_text):
+    """Parse a give karma message into its karma operations and comment
+
+    Args:
+        message_text (str): The text of the message
+    Returns:
+        ([(str, str, str)], str): For each operation, the '@' if the target is a mention (or None), the name of the
+            target, and the operator ('++' or '--'); and the comment, or None. None if the message is not valid.
+    """
+    if not settings.COMPILED_REGEXES['give_karma'].match(message_text):
+        return None
+
+    operations = []
+    pos = 0
+    while True:
+        match = settings.COMPILED_REGEXES['karma_operation'].match(message_text, pos)
+        if not match:
+            return None
+        groups = match.groups()
+        operations.append((groups[0], groups[1] or groups[2], groups[3]))
+        pos = match.end()
+
+        # The operations end at the end of the message or at the comment
+        if pos == len(message_text):
+            return operations, None
+        comment = settings.COMPILED_REGEXES['karma_comment'].match(message_text, pos)
+        if comment:
+            return operations, comment.group(1)
+
+        # Otherwise there must be whitespace before the next operation
+        whitespace = _WHITESPACE.match(message_text, pos)
+        if not whitespace:
+            return None
+        pos = whitespace.end()
+
+
+def resolve_target(mention, name, mentions):
+    """Work out which entity a karma target refers to
+
+    Args:
+        mention (str): '@' if the target was written as a mention, otherwise empty or None
+        name (str): The name of the target, without the '@'
+        mentions ([{}]): The mentions from the message. Each dict must have 'id' and 'mention_name' keys.
+    Returns:
+        (str, str): The type of the entity (one of KarmicEntity.KARMIC_ENTITY_TYPES) and its name
+    Exceptions:
+        KeyError: If the mentions are missing data
+    """
+    mention = mention or ''
+
+    # Determine if name is a valid mention
+    if mention:
+        for m in mentions:
+            if m['mention_name'].lower() == name.lower():
+                return KarmicEntity.USER, m['id']
+
+    return KarmicEntity.STRING, mention + name
+
+
 # Views
 
 def index(request):
@@ -43,12 +114,32 @@ def capabilities(request):
                    'show_hook_url': json.dumps(request.build_absolute_uri(reverse(show_hook))),
                    'show_hook_regex': json.dumps(settings.REGEXES['show_karma']),
                    'show_hook_name': json.dumps(settings.ADDON_KEY + '.hooks.show'),
+                   'leaderboard_hook_url': json.dumps(request.build_absolute_uri(reverse(leaderboard_hook))),
+                   'leaderboard_hook_regex': json.dumps(settings.REGEXES['leaderboard']),
+                   'leaderboard_hook_name': json.dumps(settings.ADDON_KEY + '.hooks.leaderboard'),
                    'help_hook_url': json.dumps(request.build_absolute_uri(reverse(help_hook))),
                    'help_hook_regex': json.dumps(settings.REGEXES['help']),
                    'help_hook_name': json.dumps(settings.ADDON_KEY + '.hooks.help')},
                   content_type='application/json')
 
 
+def metrics(request):
+    """Performance metrics of this process, in the Prometheus text format
+
+    Requires settings.METRICS_TOKEN as a bearer token, so the metrics are never public. Every sample is labelled with
+    the dyno and process ID, since each gunicorn worker keeps its own metrics.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    if not settings.METRICS_TOKEN or scheme.lower() != 'bearer' or \
+            not constant_time_compare(token, settings.METRICS_TOKEN):
+        return HttpResponseForbidden('')
+
+    return HttpResponse(REGISTRY.render([('dyno', settings.DYNO), ('pid', os.getpid())]),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @csrf_exempt
 def install(request):
     """Callback to install or uninstall HipKarma in a room"""
@@ -80,7 +171,8 @@ def install(request):
         return HttpResponseBadRequest('Invalid capabilities')
 
     # Send notification to room announcing installation
-    instance.send_room_notification(
+    dispatch.send_room_notification(
+        instance,
         'The {addon_name} addon has been installed in this room.\n'
         'Say "@{addon_chat_name} help" for help on using karma.'
         .format(
@@ -103,6 +195,7 @@ def uninstall(request, client_id=None):
         return HttpResponseBadRequest('Client ID not provided')
     instance = Instance.objects.get(oauth_client_id=client_id)
     instance.delete()
+    Instance.invalidate_cache(client_id)
     return HttpResponse('Installed successfully')
 
 
@@ -110,8 +203,8 @@ def uninstall(request, client_id=None):
 def give_hook(request):
     """Callback for give karma webhook
 
-    Applies karma to an entity.
-    Triggered by a message in chat like "@phone++ #comment".
+    Applies karma to one or more entities.
+    Triggered by a message in chat like "@phone++ #comment" or "@phone++ @tablet++ #comment".
     """
     if request.method != 'POST':
         return HttpResponseNotAllowed(['POST'])
@@ -141,68 +234,63 @@ def give_hook(request):
         return HttpResponseBadRequest('Invalid payload data')
 
     # Get the instance from the OAuth ID
-    instance = Instance.objects.get(oauth_client_id=oauth_client_id)
+    instance = Instance.get_cached(oauth_client_id)
 
-    # Apply the regex to get each part of the message
-    match_result = settings.COMPILED_REGEXES['give_karma'].match(message_text)
-    if not match_result:
+    # Parse the message into its karma operations and comment
+    parsed = parse_karma_operations(message_text)
+    if not parsed:
         logger.error('Message does not match regex')
         return HttpResponseBadRequest('Message does not match regex')
-    groups = match_result.groups()
-    mention = groups[0] or ''
-    recipient_name = groups[1] or groups[2]
-    karma_operator = groups[3]
-    comment = groups[4]
+    karma_operations, comment = parsed
 
-    # Determine if recipient_name is a valid mention and set recipient_id and recipient_type accordingly
-    matching_mention = {}
-    if mention:
+    # Work out the recipient and value of each karma
+    operations = []
+    for mention, recipient_name, karma_operator in karma_operations:
         try:
-            for m in mentions:
-                if m['mention_name'].lower() == recipient_name.lower():
-                    matching_mention = m
-                    break
+            recipient_type, recipient_id = resolve_target(mention, recipient_name, mentions)
         except KeyError:
             logger.error('Invalid payload data')
             return HttpResponseBadRequest('Invalid payload data')
 
-    if matching_mention:
-        recipient_type = KarmicEntity.USER
-        recipient_id = matching_mention['id']
-    else:
-        recipient_type = KarmicEntity.STRING
-        recipient_id = mention + recipient_name
-
-    # Get the karma value from the operator
-    value = {
-        '++': Karma.GOOD,
-        '--': Karma.BAD,
-    }[karma_operator]
+        # Get the karma value from the operator
+        value = {
+            '++': Karma.GOOD,
+            '--': Karma.BAD,
+        }[karma_operator]
+        operations.append((recipient_id, recipient_type, value))
 
     # Update mentions now so that the mention name for the recipient (if a user) is already there before we apply karma
     KarmicEntity.update_mentions(instance.group, mentions + [sender])
 
-    # Process the new karma
-    try:
-        karma = Karma.apply_new(instance=instance,
-                                sender=sender_id,
-                                recipient=recipient_id,
-                                recipient_type=recipient_type,
-                                value=value,
-                                comment=comment)
-    except Karma.SelfKarma:
-        instance.send_room_notification('Nice try, @{name}.'.format(name=sender_mention_name))
+    # Count the announcement for the room now, so that its count is not locked for the whole transaction
+    busy = Notification.room_is_busy(instance)
+
+    # Process the new karma, saving the notification about it in the same transaction
+    with transaction.atomic():
+        karmas, rejected = Karma.apply_batch(instance=instance,
+                                             sender=sender_id,
+                                             operations=operations,
+                                             comment=comment)
+        recipients = []
+        for karma in karmas:
+            if karma.recipient not in recipients:
+                recipients.append(karma.recipient)
+        notification = Notification.announce_karma(instance, recipients, busy) if recipients else None
+
+    # Now that the karma has been committed, move its recipients (and the sender, who may be new) on the leaderboards
+    if karmas:
+        KarmicEntity.update_leaderboards(instance.group_id, [recipient.pk for recipient in recipients] +
+                                         [karmas[0].sender.pk])
+
+    if rejected:
+        dispatch.send_room_notification(instance, 'Nice try, @{name}.'.format(name=sender_mention_name))
         logger.info('Foiling dastardly narcissism')
-        return HttpResponse('Karma was invalid due to narcissism')
+        if not karmas:
+            return HttpResponse('Karma was invalid due to narcissism')
 
-    # Notify room about the karma
-    instance.send_room_notification(
-        '{recipient} has {total} total karma.'
-        .format(
-            recipient=karma.recipient.get_name(),
-            total=karma.recipient.karma
-        )
-    )
+    # Notify room about the karma, unless the announcement is being held back to be merged with others
+    if notification is not None:
+        dispatch.deliver(notification)
 
     # Update any mentions we can
     return HttpResponse('Applied karma successfully')
@@ -213,7 +301,7 @@ def show_hook(request):
     """Callback for show karma webhook
 
     Sends a room notification with some karma info about an entity.
-    Triggered by a message like "@karma for @phone".
+    Triggered by a message like "@karma for @phone", or "@karma for @phone this week" to see karma from a period.
     """
     if request.method != 'POST':
         return HttpResponseNotAllowed(['POST'])
@@ -241,7 +329,7 @@ def show_hook(request):
         return HttpResponseBadRequest('Invalid payload data')
 
     # Get the instance from the OAuth ID, and the group from the instance
-    instance = Instance.objects.get(oauth_client_id=oauth_client_id)
+    instance = Instance.get_cached(oauth_client_id)
     group = instance.group
 
     # Check that the regex is matched and use it to extract the name
@@ -252,31 +340,21 @@ def show_hook(request):
     groups = match_result.groups()
     mention = groups[0] or ''
     name = groups[1] or groups[2]
+    period = groups[3]
 
-    # Determine if recipient_name is a valid mention and set recipient_id and recipient_type accordingly
-    matching_mention = {}
-    if mention:
-        try:
-            for m in mentions:
-                if m['mention_name'].lower() == name.lower():
-                    matching_mention = m
-                    break
-        except KeyError:
-            logger.error('Invalid payload data')
-            return HttpResponseBadRequest('Invalid payload data')
-
-    if matching_mention:
-        type_ = KarmicEntity.USER
-        id_ = matching_mention['id']
-    else:
-        type_ = KarmicEntity.STRING
-        id_ = mention + name
+    # Determine if name is a valid mention and set id_ and type_ accordingly
+    try:
+        type_, id_ = resolve_target(mention, name, mentions)
+    except KeyError:
+        logger.error('Invalid payload data')
+        return HttpResponseBadRequest('Invalid payload data')
 
     try:
         entity = KarmicEntity.objects.get(group=group, type=type_, name=id_)
     except KarmicEntity.DoesNotExist:
         # Notify room that entity does not exist
-        instance.send_room_notification(
+        dispatch.send_room_notification(
+            instance,
             '{symbol}{name} has never received any karma.'
             .format(
                 symbol=mention,
@@ -285,24 +363,49 @@ def show_hook(request):
         )
         return HttpResponse('Target did not exist, notified room.')
 
-    # Get a sample of karma for the entity
-    good_sample, bad_sample = entity.get_karma_sample(3)
+    # For a period, show what the entity received in that period from the daily rollups
+    if period:
+        today = timezone.now().date()
+        since = {
+            'today': today,
+            'this week': today - datetime.timedelta(days=today.weekday()),
+            'this month': today.replace(day=1),
+        }[period]
+        good, bad = KarmaRollup.totals(entity, since)
+        dispatch.send_room_notification(
+            instance,
+            '{name} has received {good} good and {bad} bad karma {period}, for a net change of {net:+d}.'
+            .format(
+                name=entity.get_name(),
+                good=good,
+                bad=bad,
+                period=period,
+                net=good - bad,
+            )
+        )
+        KarmicEntity.update_mentions(instance.group, mentions + [sender])
+        return HttpResponse('Showed karma for period successfully')
+
+    # Get a sample of karma comments for the entity, and its totals including anything in its shards
+    good_sample, bad_sample = entity.get_reservoir_sample(3)
+    KarmicEntity.load_totals([entity])
 
     KarmicEntity.update_mentions(instance.group, mentions + [sender])
 
     # Build strings showing sample of karma comments
     good_sample_string = ''
-    for karma in good_sample:
-        string = '{name}: {comment}\n'.format(name=karma.sender.get_name(), comment=karma.comment)
+    for sender_name, comment in good_sample:
+        string = '{name}: {comment}\n'.format(name=sender_name, comment=comment)
         good_sample_string += string
 
     bad_sample_string = ''
-    for karma in bad_sample:
-        string = '{name}: {comment}\n'.format(name=karma.sender.get_name(), comment=karma.comment)
+    for sender_name, comment in bad_sample:
+        string = '{name}: {comment}\n'.format(name=sender_name, comment=comment)
         bad_sample_string += string
 
     # Notify room about the karma
-    instance.send_room_notification(
+    dispatch.send_room_notification(
+        instance,
         '{name} has {karma} total karma. The highest it has ever been is {max} and the lowest it has ever been '
         'is {min}.\n\n'
         'Good:\n'
@@ -321,6 +424,72 @@ def show_hook(request):
     return HttpResponse('Showed karma successfully')
 
 
+@csrf_exempt
+def leaderboard_hook(request):
+    """Callback for leaderboard webhook
+
+    Sends a room notification listing the entities with the most (or least) karma.
+    Triggered by a message like "@karma top" or "@karma bottom 10".
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    # Load the webhook payload from JSON
+    try:
+        payload = json.loads(request.body.decode())
+    except ValueError:
+        logger.error('Invalid JSON')
+        return HttpResponseBadRequest('Invalid JSON')
+
+    # Get the necessary data out of the payload
+    try:
+        if payload['event'] != 'room_message':
+            logger.error('Unexpected event type ({type})').format(type=payload['event'])
+            return HttpResponseBadRequest('')
+        item = payload['item']
+        message = item['message']
+        message_text = message['message']
+        oauth_client_id = payload['oauth_client_id']
+        sender = message['from']
+        mentions = message['mentions']
+    except KeyError:
+        logger.error('Invalid payload data')
+        return HttpResponseBadRequest('Invalid payload data')
+
+    # Get the instance from the OAuth ID
+    instance = Instance.get_cached(oauth_client_id)
+
+    # Check that the regex is matched and use it to extract the direction and count
+    match_result = settings.COMPILED_REGEXES['leaderboard'].match(message_text)
+    if not match_result:
+        logger.error('Message does not match regex')
+        return HttpResponseBadRequest('Message does not match regex')
+    direction, count = match_result.groups()
+    count = min(int(count), settings.LEADERBOARD_MAX) if count else settings.LEADERBOARD_DEFAULT
+
+    entities = KarmicEntity.get_leaderboard(instance.group, direction, count)
+
+    # Build string listing the entities
+    leaderboard_string = ''
+    for rank, entity in enumerate(entities, 1):
+        string = '{rank}. {name} ({karma})\n'.format(rank=rank, name=entity.get_name(), karma=entity.karma)
+        leaderboard_string += string
+
+    # Send the leaderboard notification
+    dispatch.send_room_notification(
+        instance,
+        '{title} karma:\n'
+        '{leaderboard}'
+        .format(
+            title='Most' if direction == KarmicEntity.TOP else 'Least',
+            leaderboard=leaderboard_string or 'Nobody has any karma yet!\n',
+        )
+    )
+    # Update any mentions we can
+    KarmicEntity.update_mentions(instance.group, mentions + [sender])
+    return HttpResponse('Showed leaderboard successfully')
+
+
 @csrf_exempt
 def help_hook(request):
     """Callback for help webhook
@@ -354,7 +523,7 @@ def help_hook(request):
         return HttpResponseBadRequest('Invalid payload data')
 
     # Get the instance from the OAuth ID, and the group from the instance
-    instance = Instance.objects.get(oauth_client_id=oauth_client_id)
+    instance = Instance.get_cached(oauth_client_id)
 
     # Check that the regex is matched and use it to extract the name
     match_result = settings.COMPILED_REGEXES['help'].match(message_text)
@@ -363,13 +532,18 @@ def help_hook(request):
         return HttpResponseBadRequest('Message does not match regex')
 
     # Send the help notification
-    instance.send_room_notification(
+    dispatch.send_room_notification(
+        instance,
         'Give karma like this: "target++ #comment"\n'
+        'You can give karma to several targets at once, like this: "target++ other_target-- #comment"\n'
         'Remember to use an @mention for the target if the target is a person!\n'
         'Use "++" for good karma and "--" for bad karma.\n'
         'The comment can start with either "//" or "#" and is optional.\n'
         'If your target has whitespace in it, surround it with parentheses, like this: "(two words)++"\n'
         'To check the karma for someone (or something), use: "@{addon_chat_name} for target"\n'
+        'To see the karma they received recently, add "today", "this week" or "this month"\n'
+        'To see who has the most (or least) karma, use: "@{addon_chat_name} top" (or "bottom"), optionally followed '
+        'by how many to show\n'
         'For more information, see {index_url}.'
         .format(
             index_url=request.build_absolute_uri(reverse(index)),